@@ -0,0 +1,60 @@
+# plugins/ai_rag_retriever/chunk_store.py
+"""
+Lettura del chunk store locale (preprocessing/chunk_store.py) per i punti payload-lite:
+in Qdrant c'è solo chunk_id, testo e metadati si recuperano qui con una sola
+query per i top-k finali.
+"""
+import json, os, sqlite3, threading
+
+CHUNK_STORE = os.getenv("RAG_CHUNK_STORE", "/app/cat/data/chunk_store.sqlite")
+
+_lock = threading.Lock()
+_db = None
+
+
+def _connect():
+    global _db
+    if _db is None:
+        if not os.path.isfile(CHUNK_STORE):
+            return None
+        # sola lettura: l'uploader può scrivere in parallelo (WAL)
+        _db = sqlite3.connect(f"file:{CHUNK_STORE}?mode=ro", uri=True, check_same_thread=False)
+    return _db
+
+
+def lookup(chunk_ids) -> dict:
+    """chunk_id -> {"text", "metadata"} per gli id presenti nello store."""
+    uniq = [c for c in dict.fromkeys(chunk_ids) if c]
+    if not uniq:
+        return {}
+    found = {}
+    try:
+        with _lock:
+            db = _connect()
+            if db is None:
+                return {}
+            marks = ",".join("?" * len(uniq))
+            for cid, text, meta in db.execute(
+                f"SELECT chunk_id, text, meta FROM chunks WHERE chunk_id IN ({marks})", uniq
+            ):
+                found[cid] = {"text": text, "metadata": json.loads(meta)}
+    except Exception as e:
+        print("[ai_rag_retriever] chunk store error:", e)
+    return found
+
+
+def hydrate(passages):
+    """Completa testo e metadati dei passaggi senza testo; scarta quelli non trovati."""
+    missing = [p for p in passages if not p.get("text") and (p.get("metadata") or {}).get("chunk_id")]
+    if not missing:
+        return passages
+    found = lookup([p["metadata"]["chunk_id"] for p in missing])
+    out = []
+    for p in passages:
+        if not p.get("text"):
+            hit = found.get((p.get("metadata") or {}).get("chunk_id"))
+            if not hit:
+                continue
+            p = {**p, "text": hit["text"], "metadata": {**hit["metadata"], **p["metadata"]}}
+        out.append(p)
+    return out
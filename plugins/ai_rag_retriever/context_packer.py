@@ -0,0 +1,149 @@
+# plugins/ai_rag_retriever/context_packer.py
+"""
+Impacchetta i passaggi recuperati nel contesto del prompt entro un budget di token
+(RAG_CONTEXT_TOKENS; se manca si ricava dal vecchio RAG_MAX_CHARS / RAG_CHARS_PER_TOKEN,
+0 = nessun limite):
+- token contati col tokenizer del modello servito da Ollama: il tokenizer.json di HF
+  (es. meta-llama/Llama-3.1-8B-Instruct) va copiato in data/models/llm/tokenizer.json,
+  cioè /app/cat/data/models/llm/ nel container (o RAG_CONTEXT_TOKENIZER); senza
+  tokenizer si stima len/RAG_CHARS_PER_TOKEN, con un avviso una sola volta
+- chunk consecutivi della stessa sorgente (source_dir/source_name, chunk_index n, n+1, ...)
+  uniti in un solo blocco, togliendo la sovrapposizione tra un chunk e il successivo
+- riempimento greedy per rilevanza (ordine di arrivo dei passaggi = score decrescente):
+  un blocco che non entra nel budget viene scartato per intero, mai troncato; un blocco
+  unito che non entra viene riprovato chunk per chunk
+"""
+import os, threading
+
+TOKENIZER       = os.getenv("RAG_CONTEXT_TOKENIZER", "/app/cat/data/models/llm/tokenizer.json")
+CHARS_PER_TOKEN = float(os.getenv("RAG_CHARS_PER_TOKEN", "4"))
+MAX_CHARS       = os.getenv("RAG_MAX_CHARS")   # budget in caratteri delle versioni precedenti
+CONTEXT_TOKENS  = int(os.getenv("RAG_CONTEXT_TOKENS")
+                      or (int(int(MAX_CHARS) / CHARS_PER_TOKEN) if MAX_CHARS else 800))
+MIN_OVERLAP     = 20      # caratteri: sotto questa soglia non è sovrapposizione ma coincidenza
+MAX_OVERLAP     = 600     # chunk_texts.py: 150 caratteri o qualche frase (OVERLAP_TOKENS)
+SEPARATOR       = "\n\n---\n\n"
+
+_lock = threading.Lock()
+_tokenizer = False   # False = non ancora cercato, None = non disponibile
+
+
+def _get_tokenizer():
+    global _tokenizer
+    if _tokenizer is False:
+        with _lock:
+            if _tokenizer is False:
+                try:
+                    from tokenizers import Tokenizer
+                    _tokenizer = Tokenizer.from_file(TOKENIZER)
+                except Exception as e:
+                    _tokenizer = None
+                    print(f"[ai_rag_retriever] [warn] Tokenizer del contesto non disponibile in {TOKENIZER}"
+                          f" ({e}): budget stimato a {CHARS_PER_TOKEN:g} caratteri/token. Copia il"
+                          f" tokenizer.json del modello in data/models/llm/ o imposta RAG_CONTEXT_TOKENIZER")
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    tok = _get_tokenizer()
+    if tok is not None:
+        return len(tok.encode(text, add_special_tokens=False).ids)
+    return int(len(text) / CHARS_PER_TOKEN + 0.999)
+
+
+def _overlap(a: str, b: str) -> int:
+    """Lunghezza del più lungo suffisso di `a` che è anche prefisso di `b`."""
+    for n in range(min(len(a), len(b), MAX_OVERLAP), MIN_OVERLAP - 1, -1):
+        if a.endswith(b[:n]):
+            return n
+    return 0
+
+
+def merge_texts(texts) -> str:
+    out = ""
+    for t in texts:
+        t = (t or "").strip()
+        n = _overlap(out, t) if out else 0
+        out = (out + t[n:]) if n else (out + "\n" + t if out else t)
+    return out
+
+
+def _source_key(meta: dict):
+    if meta.get("source_name") is None or meta.get("chunk_index") is None:
+        return None
+    try:
+        return (meta.get("source_dir") or "", meta["source_name"]), int(meta["chunk_index"])
+    except (TypeError, ValueError):
+        return None
+
+
+def build_spans(passages):
+    """
+    Raggruppa i passaggi in blocchi: [{"rank", "members": [passaggi in ordine di chunk]}].
+    rank = miglior posizione tra i membri; passaggi duplicati (stesso chunk) contati una volta.
+    """
+    seen, by_source, spans = set(), {}, []
+    for rank, p in enumerate(passages):
+        meta = p.get("metadata") or {}
+        key = _source_key(meta)
+        dedup = key or " ".join((p.get("text") or "").split())
+        if dedup in seen:
+            continue
+        seen.add(dedup)
+        if key is None:
+            spans.append({"rank": rank, "members": [p]})
+        else:
+            by_source.setdefault(key[0], []).append((key[1], rank, p))
+    for items in by_source.values():
+        items.sort(key=lambda x: x[0])
+        run = [items[0]]
+        for it in items[1:]:
+            if it[0] == run[-1][0] + 1:
+                run.append(it)
+            else:
+                spans.append({"rank": min(r for _, r, _ in run), "members": [p for _, _, p in run]})
+                run = [it]
+        spans.append({"rank": min(r for _, r, _ in run), "members": [p for _, _, p in run]})
+    spans.sort(key=lambda s: s["rank"])
+    return spans
+
+
+def _header(i: int, members) -> str:
+    meta = members[0].get("metadata") or {}
+    src  = meta.get("source") or meta.get("file") or meta.get("url") or meta.get("source_name") or ""
+    if len(members) > 1 and meta.get("chunk_index") is not None:
+        # blocco unito: intervallo dei chunk (le pagine non sono note per tutti i membri)
+        where = f"chunk {meta['chunk_index']}–{(members[-1].get('metadata') or {}).get('chunk_index')}"
+    else:
+        page = meta.get("page") or meta.get("chunk_id") or ""
+        where = f"p.{page}" if page else ""
+    return (f"[{i}] {src}" + (f" ({where})" if where else "")).strip()
+
+
+def pack(passages, budget: int = None):
+    """(contesto, statistiche): blocchi interi finché c'è budget, in ordine di rilevanza."""
+    budget = CONTEXT_TOKENS if budget is None else budget
+    passages = list(passages or [])
+    rank_of = {id(p): i for i, p in enumerate(passages)}
+    queue = build_spans(passages)
+    blocks, used = [], 0
+    stats = {"passages": len(passages), "spans": len(queue), "merged": 0,
+             "dropped": 0, "tokens": 0, "budget": budget}
+    while queue:
+        span = queue.pop(0)
+        members = span["members"]
+        block = _header(len(blocks) + 1, members) + "\n" + merge_texts(m.get("text") for m in members)
+        cost = count_tokens((SEPARATOR if blocks else "") + block)
+        if budget <= 0 or used + cost <= budget:
+            blocks.append(block)
+            used += cost
+            stats["merged"] += len(members) - 1
+        elif len(members) > 1:
+            # il blocco unito non entra: si riprovano i singoli chunk, ognuno col proprio rank
+            queue += [{"rank": rank_of[id(m)], "members": [m]} for m in members]
+            queue.sort(key=lambda s: s["rank"])
+        else:
+            stats["dropped"] += 1
+    stats["tokens"] = used
+    stats["blocks"] = len(blocks)
+    return SEPARATOR.join(blocks), stats
@@ -0,0 +1,102 @@
+# plugins/ai_rag_retriever/direct_search.py
+"""
+Ricerca diretta su Qdrant (RAG_MODE=direct), senza passare da /memory/recall:
+- embedding della query in-process con il modello dell'ingestione (query_embedder.py), non
+  con l'embedder del Cat: la dimensione si confronta una volta con quella della collection
+- QdrantClient persistente, via gRPC se RAG_QDRANT_GRPC=1
+- filtro `domain` lato server e payload limitato ai campi di RAG_PAYLOAD_FIELDS
+- parametri di ricerca (hnsw_ef, rescore, oversampling) da search_profile.json, lo stesso
+  file letto da preprocessing/create_collection.py; le variabili RAG_* lo sovrascrivono
+- restituisce passaggi già nel formato di retrieval.recall: {"text", "metadata", "score"}
+"""
+import json, os, threading
+from pathlib import Path
+
+from . import query_embedder
+
+RAG_MODE       = os.getenv("RAG_MODE", "http")   # "http" | "direct"
+QDRANT_URL     = os.getenv("RAG_QDRANT_URL", "http://qdrant:6333")
+QDRANT_GRPC    = os.getenv("RAG_QDRANT_GRPC", "1") == "1"
+GRPC_PORT      = int(os.getenv("RAG_QDRANT_GRPC_PORT", "6334"))
+COLLECTION     = os.getenv("RAG_COLLECTION", "kb_legale_it")
+PAYLOAD_FIELDS = [f.strip() for f in os.getenv(
+    "RAG_PAYLOAD_FIELDS", "text,chunk_id,source_name,source_dir,chunk_index,sources,domain").split(",") if f.strip()]
+SEARCH_TIMEOUT = int(os.getenv("RAG_SEARCH_TIMEOUT", "5"))
+SEARCH_PROFILE = json.loads(Path(__file__).with_name("search_profile.json").read_text(encoding="utf-8"))
+HNSW_EF        = int(os.getenv("RAG_HNSW_EF", str(SEARCH_PROFILE.get("hnsw_ef") or 0))) or None
+RESCORE        = os.getenv("RAG_RESCORE", "1" if SEARCH_PROFILE.get("rescore", True) else "0") == "1"
+OVERSAMPLING   = float(os.getenv("RAG_OVERSAMPLING", str(SEARCH_PROFILE.get("oversampling") or 1.0)))
+
+_lock = threading.Lock()
+_client = None
+_dim = None   # dimensione dei vettori della collection, letta al primo uso
+
+
+def enabled() -> bool:
+    return RAG_MODE == "direct"
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                from qdrant_client import QdrantClient
+                _client = QdrantClient(url=QDRANT_URL, grpc_port=GRPC_PORT, prefer_grpc=QDRANT_GRPC,
+                                       timeout=SEARCH_TIMEOUT)
+    return _client
+
+
+def _filter(domain: str):
+    if not domain:
+        return None
+    from qdrant_client.http import models
+    return models.Filter(must=[models.FieldCondition(key="domain", match=models.MatchValue(value=domain))])
+
+
+def _params():
+    from qdrant_client.http import models
+    quant = models.QuantizationSearchParams(rescore=RESCORE, oversampling=OVERSAMPLING) if RESCORE else None
+    return models.SearchParams(hnsw_ef=HNSW_EF, quantization=quant)
+
+
+def collection_dim() -> int:
+    """Dimensione dei vettori di COLLECTION (vectors_config), letta una volta."""
+    global _dim
+    if _dim is None:
+        vectors = get_client().get_collection(COLLECTION).config.params.vectors
+        if isinstance(vectors, dict):   # named vectors: la collection ne usa uno solo
+            vectors = next(iter(vectors.values()))
+        _dim = int(vectors.size)
+    return _dim
+
+
+def search(query: str, k: int, domain: str = "", embed_fn=None, vector=None):
+    """
+    Top-k dalla collection; `vector` evita di ricalcolare un embedding già disponibile.
+    Senza `embed_fn` la query si embedda con query_embedder (modello dell'ingestione).
+    """
+    if vector is None:
+        vector = (embed_fn or query_embedder.embed_fn())(query)
+    if len(vector) != collection_dim():
+        msg = (f"embedding della query di dimensione {len(vector)}, la collection {COLLECTION} ne ha"
+               f" {collection_dim()}: la query va embeddata con il modello dell'ingestione"
+               f" (RAG_QUERY_MODEL={query_embedder.QUERY_MODEL})")
+        print(f"[ai_rag_retriever] ERRORE {msg}")
+        raise ValueError(msg)
+    res = get_client().query_points(
+        collection_name=COLLECTION,
+        query=[float(x) for x in vector],
+        query_filter=_filter(domain),
+        search_params=_params(),
+        limit=k,
+        with_payload=PAYLOAD_FIELDS or True,
+        with_vectors=False,
+    )
+    out = []
+    for p in res.points:
+        payload = dict(p.payload or {})
+        text = (payload.pop("text", "") or "").strip()
+        meta = payload.get("metadata") if isinstance(payload.get("metadata"), dict) else payload
+        out.append({"text": text, "metadata": meta, "score": p.score})
+    return out
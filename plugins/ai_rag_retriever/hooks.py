@@ -1,14 +1,21 @@
 # plugins/ai_rag_retriever/hooks.py
-import os, requests
+import os, threading
+from collections import OrderedDict
 from cat.mad_hatter.decorators import hook
 from cat.log import logger
 
+from . import speculative, tracing
+from .context_packer import CHARS_PER_TOKEN, pack
+from .http_client import pool_stats
+from .recall_cache import CACHE
+from .retrieval import TOP_K, cached_recall
+
 
 # === Config ===
-CC_URL    = os.getenv("RAG_CC_URL", "http://127.0.0.1")
-TOP_K     = int(os.getenv("RAG_TOP_K", "5"))
-MAX_CHARS = int(os.getenv("RAG_MAX_CHARS", "3200"))
-DOMAIN    = os.getenv("RAG_DOMAIN", "")
+# "cache": parte statica byte-identica in testa e contesto RAG in coda (prefisso riusabile
+# dalla KV cache di Ollama); "legacy": contesto tra system prompt ed elenco documenti
+PROMPT_LAYOUT     = os.getenv("RAG_PROMPT_LAYOUT", "cache")
+PREFIX_USERS      = 256   # ultimi prompt tenuti per il calcolo del prefisso riusabile (uno per utente)
 
 # === System WeSafe (MAIN PROMPT) ===
 PRO_SYSTEM_WESAFE = """
@@ -59,54 +66,78 @@ Parla SEMPRE in italiano, con tono professionale, sintetico e orientato all’az
 """.strip()
 
 
-# === Recall helpers ===
-def _recall(q: str, k: int = TOP_K):
-    logger.info(f"[ai_rag_retriever] Eseguo recall su Qdrant: '{q}' (k={k}, domain='{DOMAIN}')")
-    try:
-        params = {"text": q, "k": k}
-        if DOMAIN:
-            params["domain"] = DOMAIN
-        r = requests.get(f"{CC_URL}/memory/recall", params=params, timeout=10)
-        r.raise_for_status()
-        items = r.json() or []
-        norm = []
-        for it in items:
-            if isinstance(it, str):
-                norm.append({"text": it, "metadata": {}, "score": None})
-            elif isinstance(it, dict):
-                text = (it.get("text") or "").strip()
-                meta = it.get("metadata") or it.get("meta") or {}
-                score = it.get("score")
-                if not text and isinstance(it.get("payload"), dict):
-                    text = (it["payload"].get("text") or "").strip()
-                    meta = it["payload"].get("metadata") or meta
-                if not text:
-                    text = str(it)
-                norm.append({"text": text, "metadata": meta or {}, "score": score})
-            else:
-                norm.append({"text": str(it), "metadata": {}, "score": None})
-        return norm
-    except Exception as e:
-        print("[ai_rag_retriever] recall error:", e)
-        return []
+# Lista chiusa dei documenti da cui il modello può scegliere
+DOC_LIST = """
+### Elenco documenti disponibili
+- Certificazione notarile ventennale
+- Copia di un atto notarile/giudiziario
+- Ispezione ipotecaria per immobile
+- Ispezione ipotecaria per soggetto
+- Mappa catastale
+- Nota di iscrizione (es. ipoteca)
+- Nota di trascrizione compravendita
+- Visura catastale attuale
+- Visura catastale storica
+- Visura ipocatastale attuale
+- Planimetria catastale
+- Dichiarazione di successione / Nota trascrizione donazione
+
+Il tuo compito: in base alla domanda e al contesto, seleziona solo i documenti pertinenti dall’elenco sopra. Non inventarne di nuovi.
+"""
+
+FINAL_INSTRUCTIONS = (
+    "\nIstruzioni finali: rispondi solo con le evidenze del contesto; "
+    "se insufficienti, spiega cosa manca e proponi comunque un documento iniziale utile dall’elenco.\n"
+)
+
+# Layout "cache": prefisso identico a ogni turno, il contesto recuperato va in fondo
+STATIC_PREFIX  = PRO_SYSTEM_WESAFE + "\n" + DOC_LIST + FINAL_INSTRUCTIONS
+CONTEXT_HEADER = "\n### Contesto (documenti recuperati per questa domanda)\n"
+
+_prefix_lock = threading.Lock()
+_prefix_stats = {"requests": 0, "prompt_tokens": 0, "reused_tokens": 0}
+_last_prompt = OrderedDict()   # user_id -> prompt del turno precedente (LRU, PREFIX_USERS voci)
+
+
+def _track_prefix(prompt: str, cat=None):
+    """
+    Token del prompt in comune col turno precedente dello stesso utente: è la parte che
+    Ollama non deve rivalutare (prompt eval) se la KV cache del modello è ancora in memoria
+    (il modello resta caricato per OLLAMA_KEEP_ALIVE, impostato sul servizio ollama in compose.yaml).
+    Token stimati dai caratteri (RAG_CHARS_PER_TOKEN): è solo una statistica e tokenizzare
+    l'intero prompt due volte a ogni turno costava più di quanto misurava.
+    """
+    user = getattr(cat, "user_id", None)
+    with _prefix_lock:
+        common = os.path.commonprefix([_last_prompt.pop(user, ""), prompt])
+        _last_prompt[user] = prompt
+        while len(_last_prompt) > PREFIX_USERS:
+            _last_prompt.popitem(last=False)
+    total, reused = int(len(prompt) / CHARS_PER_TOKEN), int(len(common) / CHARS_PER_TOKEN)
+    tracing.observe("rag_prompt_tokens", total, layout=PROMPT_LAYOUT)
+    tracing.observe("rag_prompt_chars", len(prompt), layout=PROMPT_LAYOUT)
+    with _prefix_lock:
+        _prefix_stats["requests"] += 1
+        _prefix_stats["prompt_tokens"] += total
+        _prefix_stats["reused_tokens"] += reused
+        st = dict(_prefix_stats)
+    logger.debug(f"[ai_rag_retriever] Prompt prefix ({PROMPT_LAYOUT}, utente {user}): {total} token,"
+                 f" riusabili {reused} | cumulato: {st['reused_tokens']}/{st['prompt_tokens']}"
+                 f" token (stimati) di prompt eval risparmiati")
 
 
 def _render(passages):
-    parts = []
-    for i, it in enumerate(passages, start=1):
-        text = (it.get("text") or "").strip()
-        meta = it.get("metadata") or {}
-        src  = meta.get("source") or meta.get("file") or meta.get("url") or ""
-        page = meta.get("page") or meta.get("chunk_id") or ""
-        head = f"[{i}] {src}" + (f" (p.{page})" if page else "")
-        parts.append((head + "\n" + text).strip())
-    body = "\n\n---\n\n".join(parts).strip()
-    return (body[:MAX_CHARS] + " …[troncato]") if (MAX_CHARS and len(body) > MAX_CHARS) else body
+    # budget in token (RAG_CONTEXT_TOKENS): chunk contigui uniti, passaggi interi o niente
+    ctx, st = pack(passages)
+    logger.info(f"[ai_rag_retriever] Contesto: {st['tokens']}/{st['budget']} token, {st['blocks']} blocchi"
+                f" ({st['merged']} chunk uniti, {st['dropped']} scartati)")
+    return ctx
 
 
 # === Hook: prepara il contesto RAG solo se l'intento è "info" ===
-# === Hook: prepara il contesto RAG solo se l'intento è "info" ===
-@hook(priority=6)
+# Il Cat esegue prima le priorità più alte: 10 recall speculativo (speculative.py),
+# 5 intent_classifier, 4 questo hook (che deve leggere l'intento del messaggio corrente)
+@hook(priority=4)
 def before_cat_reads_message(message, cat):
     logger.info("[ai_rag_retriever] Hook before_cat_reads_message attivato")
     q = (message or {}).get("text") or ""
@@ -117,12 +148,20 @@ def before_cat_reads_message(message, cat):
     # Verifica l'intento impostato da intent_classifier
     intent = getattr(cat, "vars", {}).get("intent")
     if intent != "info":
-        logger.info(f"[ai_rag_retriever] Saltato: intent={intent}")
+        speculative.discard(cat)
+        logger.info(f"[ai_rag_retriever] Saltato: intent={intent} | speculativo: {speculative.stats()}")
         return message
 
-    # Se l'intento è "info", procedi con RAG
-    passages = _recall(q, k=TOP_K)
-    ctx = _render(passages) if passages else ""
+    # Se l'intento è "info", procedi con RAG (risultato speculativo se già avviato)
+    with tracing.stage("recall"):
+        passages = speculative.take(cat, q)
+        if passages is None:
+            passages = cached_recall(q, cat, k=TOP_K)
+        else:
+            logger.info(f"[ai_rag_retriever] Recall speculativo usato | {speculative.stats()}")
+    tracing.observe("rag_recall_passages", len(passages))
+    with tracing.stage("render"):
+        ctx = _render(passages) if passages else ""
 
     if not hasattr(cat, "vars") or cat.vars is None:
         cat.vars = {}
@@ -140,7 +179,11 @@ def before_cat_reads_message(message, cat):
     else:
         logger.info("[ai_rag_retriever] Nessun documento recuperato")
 
-    print(f"[ai_rag_retriever] Recall eseguito: {len(passages)} passages")
+    st, cs = pool_stats(), CACHE.stats()
+    print(f"[ai_rag_retriever] Recall eseguito: {len(passages)} passages"
+          f" (http: {st['requests']} req, {st['errors']} err, avg {st['avg_ms']} ms,"
+          f" connessioni aperte {sum(p['connections_opened'] for p in st['pools'])};"
+          f" cache: hit rate {cs['hit_rate']:.0%}, esatti {cs['exact_hits']}, semantici {cs['semantic_hits']})")
     return message
 
 
@@ -151,34 +194,16 @@ def before_cat_reads_message(message, cat):
 def agent_prompt_prefix(prefix: str, cat) -> str:
     ctx = getattr(cat, "vars", {}).get("rag_context") or ""
     logger.info("[ai_rag_retriever] Hook agent_prompt_prefix attivato, contesto RAG lungo", len(ctx), "caratteri")
-    core = PRO_SYSTEM_WESAFE + "\n"
-
-    if ctx:
-        core += "\n### Contesto\n" + ctx + "\n"
-
-    # Lista chiusa dei documenti da cui il modello può scegliere
-    core += """
-### Elenco documenti disponibili
-- Certificazione notarile ventennale
-- Copia di un atto notarile/giudiziario
-- Ispezione ipotecaria per immobile
-- Ispezione ipotecaria per soggetto
-- Mappa catastale
-- Nota di iscrizione (es. ipoteca)
-- Nota di trascrizione compravendita
-- Visura catastale attuale
-- Visura catastale storica
-- Visura ipocatastale attuale
-- Planimetria catastale
-- Dichiarazione di successione / Nota trascrizione donazione
-
-Il tuo compito: in base alla domanda e al contesto, seleziona solo i documenti pertinenti dall’elenco sopra. Non inventarne di nuovi.
-"""
-
-    core += (
-        "\nIstruzioni finali: rispondi solo con le evidenze del contesto; "
-        "se insufficienti, spiega cosa manca e proponi comunque un documento iniziale utile dall’elenco.\n"
-    )
+    with tracing.stage("prompt_assembly"):
+        if PROMPT_LAYOUT == "legacy":
+            core = PRO_SYSTEM_WESAFE + "\n"
+            if ctx:
+                core += "\n### Contesto\n" + ctx + "\n"
+            core += DOC_LIST + FINAL_INSTRUCTIONS
+        else:
+            # tutto ciò che non cambia tra i messaggi sta prima del contesto
+            core = STATIC_PREFIX + (CONTEXT_HEADER + ctx + "\n" if ctx else "")
+    _track_prefix(core, cat)
     return core
 
 
@@ -0,0 +1,159 @@
+# plugins/ai_rag_retriever/http_client.py
+"""
+Client HTTP condiviso per il recall:
+- una sola requests.Session con pool keep-alive (niente handshake TCP a ogni messaggio)
+- timeout di connessione e di lettura separati (RAG_HTTP_CONNECT_TIMEOUT / RAG_HTTP_READ_TIMEOUT)
+- retry solo sugli errori di connessione, mai su una lettura lenta
+- statistiche: richieste, errori, latenza, connessioni aperte/riusate per host
+- variante async (httpx, opzionale) per i contesti async
+"""
+import atexit, os, threading, time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+CONNECT_TIMEOUT = float(os.getenv("RAG_HTTP_CONNECT_TIMEOUT", "2"))
+READ_TIMEOUT    = float(os.getenv("RAG_HTTP_READ_TIMEOUT", "10"))
+POOL_SIZE       = int(os.getenv("RAG_HTTP_POOL_SIZE", "16"))
+CONNECT_RETRIES = int(os.getenv("RAG_HTTP_CONNECT_RETRIES", "1"))
+
+_lock = threading.Lock()
+_session = None
+_async = {}   # event loop -> httpx.AsyncClient (uno per loop, tolti quando il loop è chiuso)
+_stats = {"requests": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+
+def _record(start: float, ok: bool):
+    ms = (time.perf_counter() - start) * 1000.0
+    with _lock:
+        _stats["requests"] += 1
+        _stats["errors"] += 0 if ok else 1
+        _stats["total_ms"] += ms
+        _stats["max_ms"] = max(_stats["max_ms"], ms)
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=4,
+                    pool_maxsize=POOL_SIZE,
+                    pool_block=False,   # oltre POOL_SIZE apre connessioni extra invece di attendere
+                    max_retries=Retry(total=CONNECT_RETRIES, connect=CONNECT_RETRIES, read=0,
+                                      status=0, backoff_factor=0.1),
+                )
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                _session = s
+    return _session
+
+
+def _timeout(read: float = None):
+    return (CONNECT_TIMEOUT, READ_TIMEOUT if read is None else read)
+
+
+def get_json(url: str, params: dict = None, read_timeout: float = None):
+    """GET sincrono sul pool condiviso; solleva requests.RequestException in caso di errore."""
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        r = get_session().get(url, params=params, timeout=_timeout(read_timeout))
+        r.raise_for_status()
+        data = r.json()
+        ok = True
+        return data
+    finally:
+        _record(t0, ok)
+
+
+def _async_client():
+    """httpx.AsyncClient del loop corrente (un client è legato al suo event loop)."""
+    import asyncio
+    import httpx   # opzionale: serve solo per aget_json
+
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async.get(loop)
+        if client is None:
+            # i client dei loop già chiusi (es. asyncio.run terminati) non sono più usabili:
+            # si rilasciano, altrimenti client e socket si accumulano a ogni nuovo loop.
+            # Il client tiene un riferimento al suo loop: senza questa pulizia non verrebbe
+            # mai raccolto (per questo non basta un WeakKeyDictionary)
+            for old in [lp for lp in _async if lp.is_closed()]:
+                del _async[old]
+            client = _async[loop] = httpx.AsyncClient(
+                timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+                transport=httpx.AsyncHTTPTransport(retries=CONNECT_RETRIES),
+            )
+    return client
+
+
+async def aclose():
+    """Chiude il client async del loop corrente (da chiamare prima di chiudere il loop)."""
+    import asyncio
+
+    with _lock:
+        client = _async.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def aget_json(url: str, params: dict = None, read_timeout: float = None):
+    """GET async (httpx) con gli stessi timeout e statistiche della versione sincrona."""
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        kwargs = {}
+        if read_timeout is not None:
+            import httpx
+            kwargs["timeout"] = httpx.Timeout(read_timeout, connect=CONNECT_TIMEOUT)
+        r = await _async_client().get(url, params=params, **kwargs)
+        r.raise_for_status()
+        data = r.json()
+        ok = True
+        return data
+    finally:
+        _record(t0, ok)
+
+
+def pool_stats() -> dict:
+    """Contatori delle richieste + stato dei pool urllib3 (connessioni create vs richieste servite)."""
+    with _lock:
+        st = dict(_stats)
+    st["avg_ms"] = round(st["total_ms"] / st["requests"], 2) if st["requests"] else 0.0
+    st["total_ms"] = round(st["total_ms"], 2)
+    st["max_ms"] = round(st["max_ms"], 2)
+    pools = []
+    if _session is not None:
+        for adapter in _session.adapters.values():
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None or any(p["host"] == f"{pool.scheme}://{pool.host}:{pool.port}" for p in pools):
+                    continue
+                pools.append({
+                    "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                    "connections_opened": pool.num_connections,
+                    "requests": pool.num_requests,
+                    # la coda del pool contiene None come segnaposto degli slot liberi
+                    "idle": sum(1 for c in list(pool.pool.queue) if c is not None) if pool.pool is not None else 0,
+                    "maxsize": POOL_SIZE,
+                })
+    st["pools"] = pools
+    return st
+
+
+def close():
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+        _async.clear()
+
+
+atexit.register(close)
@@ -0,0 +1,269 @@
+# plugins/ai_rag_retriever/lexical_index.py
+"""
+Indice lessicale in memoria (BM25) sui chunk della knowledge base:
+- tokenizzazione italiana: minuscole, accenti rimossi, stopword, stemmer leggero
+  (plurale/genere: visura/visure → visur, ipoteca/ipoteche → ipotec)
+- costruito dal chunk store (data/chunk_store.sqlite, scritto da upload_to_qdrant.py
+  nella cartella montata come /app/cat/data) o, in mancanza, da un manifest dei chunk
+  indicato in RAG_LEXICAL_MANIFEST (data_chunks/ non è montata da compose: va copiata
+  sotto data/); ricostruito quando cambia la sorgente o il file di versione della collection
+- RAG_LEXICAL=auto (default): attivo solo se una delle due sorgenti esiste (il chunk store
+  c'è solo con PAYLOAD_MODE="lite"); con RAG_LEXICAL=1 un indice vuoto dà un avviso nel log
+- chunk con lo stesso testo (es. la stessa pagina sotto più sorgenti) contano una volta sola,
+  sia nei risultati BM25 sia in ciascuna lista prima della fusione RRF (rrf_fuse)
+- confident(): match lessicale netto → il chiamante può saltare la ricerca vettoriale
+"""
+import hashlib, json, math, os, re, sqlite3, threading, time, unicodedata
+from collections import Counter, defaultdict
+from pathlib import Path, PureWindowsPath
+
+from .chunk_store import CHUNK_STORE
+from .recall_cache import VERSION_FILE
+
+LEXICAL          = os.getenv("RAG_LEXICAL", "auto")                 # "auto" | "1" | "0"
+LEXICAL_FASTPATH = os.getenv("RAG_LEXICAL_FASTPATH", "1") == "1"    # vale solo con l'indice attivo
+LEXICAL_MANIFEST = os.getenv("RAG_LEXICAL_MANIFEST", "")   # es. /app/cat/data/data_chunks/manifest.jsonl
+CANDIDATES       = int(os.getenv("RAG_LEXICAL_CANDIDATES", "20"))
+RRF_K            = int(os.getenv("RAG_RRF_K", "60"))
+MIN_SCORE        = float(os.getenv("RAG_LEXICAL_MIN_SCORE", "0.5"))  # score normalizzato per il fast path
+MAX_TERMS        = int(os.getenv("RAG_LEXICAL_MAX_TERMS", "4"))     # fast path solo per query brevi
+BM25_K1, BM25_B  = 1.2, 0.75
+RELOAD_CHECK     = 5.0   # sec tra due controlli della sorgente
+
+STOPWORDS = set("""
+a ad al allo alla ai agli alle all anche avere abbiamo avete aveva c che chi ci come con col coi contro
+cosa cui da dal dallo dalla dai dagli dalle dall de degli dei del dell della delle dello di dove e ed
+era essere fa fare fra gli ha hanno ho i il in io la le lei li lo loro lui ma mi mia mie miei mio ne
+nei nel nell nella nelle nello no noi non o per perche piu po poi puo qual quale quali quando quanto
+quella quelle quelli quello questa queste questi questo se si sia siamo sono su sua sue sui sul sull
+sulla sulle sullo suo suoi ti tra tu tua tue tuo tuoi tutti tutto un una uno vi voi cos
+""".split())
+
+_WORD = re.compile(r"[a-z0-9]+")
+_EXT = re.compile(r"\.(txt|html?|pdf)$", re.I)
+_HEADER = re.compile(r"\A---\n.*?\n---\n", re.S)   # metadati di trafilatura in testa ai .txt
+
+
+def _fold(text: str) -> str:
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def stem(word: str) -> str:
+    """Stemmer leggero: solo desinenze di genere/numero (evita di fondere parole diverse)."""
+    if len(word) <= 4 or word.isdigit():
+        return word
+    for suf, rep in (("zioni", "zion"), ("zione", "zion"), ("che", "c"), ("chi", "c"),
+                     ("ghe", "g"), ("ghi", "g")):
+        if word.endswith(suf):
+            return word[:-len(suf)] + rep
+    return word[:-1] if word[-1] in "aeio" else word
+
+
+def tokenize(text: str):
+    return [stem(w) for w in _WORD.findall(_fold(text)) if w not in STOPWORDS and len(w) > 1]
+
+
+def _chunk_key(rec: dict) -> str:
+    """Stesso id di preprocessing/upload_to_qdrant.py (chunk_key)."""
+    if rec.get("source_name") and rec.get("chunk_index") is not None:
+        return f"{rec.get('source_dir') or ''}/{rec['source_name']}#{rec['chunk_index']}"
+    return rec.get("chunk_id") or rec.get("chunk_path") or ""
+
+
+def _iter_chunk_store(path: str):
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        for cid, text, meta in db.execute("SELECT chunk_id, text, meta FROM chunks"):
+            yield cid, text, json.loads(meta)
+    finally:
+        db.close()
+
+
+def _iter_manifest(path: str):
+    base = Path(path).parent
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            p = Path(rec.get("chunk_path") or "")
+            if not p.is_file():   # path assoluti di un'altra macchina: relativi al manifest
+                p = base / (rec.get("source_dir") or "") / PureWindowsPath(rec.get("chunk_path") or "").name
+            if p.is_file():
+                meta = {k: v for k, v in rec.items() if k != "chunk_path"}
+                meta["chunk_id"] = _chunk_key(rec)
+                yield meta["chunk_id"], p.read_text(encoding="utf-8", errors="ignore"), meta
+
+
+class LexicalIndex:
+    def __init__(self, chunk_store: str = CHUNK_STORE, manifest: str = LEXICAL_MANIFEST):
+        self.sources = (chunk_store, manifest)
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._checked = 0.0
+        # (docs, postings, doc_len, avg_len) sostituiti insieme: una ricerca concorrente
+        # vede sempre un indice intero, il vecchio o il nuovo
+        # docs: [(chunk_id, testo, metadati)], postings: termine -> [(doc, tf)]
+        self.data = ([], {}, [], 0.0)
+
+    def _source(self):
+        for path in self.sources:
+            if path and os.path.isfile(path):
+                return path
+        return None
+
+    def _current_stamp(self):
+        stamp = []
+        for path in (self._source(), VERSION_FILE):
+            try:
+                st = os.stat(path)
+                stamp.append((path, st.st_mtime_ns, st.st_size))
+            except (OSError, TypeError):
+                stamp.append((path, None, None))
+        return tuple(stamp)
+
+    def build(self, items):
+        docs, postings, lens = [], defaultdict(list), []
+        for cid, text, meta in items:
+            tf = Counter(tokenize(_HEADER.sub("", text)))
+            doc = len(docs)
+            docs.append((cid, text.strip(), meta))
+            lens.append(sum(tf.values()))
+            for term, n in tf.items():
+                postings[term].append((doc, n))
+        self.data = (docs, dict(postings), lens, (sum(lens) / len(lens)) if lens else 0.0)
+
+    def ensure_fresh(self):
+        now = time.monotonic()
+        if self._stamp is not None and now - self._checked < RELOAD_CHECK:
+            return
+        with self._lock:
+            self._checked = now
+            stamp = self._current_stamp()
+            if stamp == self._stamp:
+                return
+            src = self._source()
+            t0 = time.perf_counter()
+            try:
+                if src is None:
+                    items = []
+                elif src.endswith(".sqlite"):
+                    items = list(_iter_chunk_store(src))
+                else:
+                    items = list(_iter_manifest(src))
+                self.build(items)
+                self._stamp = stamp
+                n = len(self.data[0])
+                if src is None:
+                    print(f"[ai_rag_retriever] [warn] Indice lessicale vuoto: nessuna sorgente tra"
+                          f" {[p for p in self.sources if p]} (RAG_CHUNK_STORE / RAG_LEXICAL_MANIFEST)")
+                elif n == 0:
+                    print(f"[ai_rag_retriever] [warn] Indice lessicale vuoto: nessun chunk leggibile da {src}")
+                else:
+                    print(f"[ai_rag_retriever] Indice lessicale: {n} chunk da {src}"
+                          f" ({(time.perf_counter() - t0) * 1000:.0f} ms)")
+            except Exception as e:
+                print("[ai_rag_retriever] lexical index error:", e)
+
+    def search(self, query: str, k: int = CANDIDATES, domain: str = ""):
+        """
+        Top-k BM25 come passaggi {"text", "metadata", "score"}, un solo chunk per testo.
+        `norm_score` = score / massimo BM25 possibile per i termini della query (0..1).
+        """
+        self.ensure_fresh()
+        docs, postings, doc_len, avg_len = self.data
+        terms = set(tokenize(query))
+        if not terms or not docs:
+            return []
+        n = len(docs)
+        scores = defaultdict(float)
+        matched = defaultdict(int)
+        best = 0.0   # tf → ∞ in ogni termine: idf * (k1 + 1)
+        for term in terms:
+            plist = postings.get(term) or []
+            idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            best += idf * (BM25_K1 + 1)
+            for doc, tf in plist:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len[doc] / (avg_len or 1))
+                scores[doc] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+                matched[doc] += 1
+        ranked = sorted(scores.items(), key=lambda x: -x[1])
+        out, seen = [], set()
+        for doc, score in ranked:
+            cid, text, meta = docs[doc]
+            if domain and meta.get("domain") and meta.get("domain") != domain:
+                continue
+            key = _pid({"text": text, "metadata": {"chunk_id": cid}})
+            if key in seen:
+                continue
+            seen.add(key)
+            out.append({"text": text, "metadata": {**meta, "chunk_id": cid}, "score": round(score, 4),
+                        "norm_score": round(score / best, 4) if best else 0.0,
+                        "matched_terms": matched[doc], "query_terms": len(terms)})
+            if len(out) >= k:
+                break
+        return out
+
+
+def enabled() -> bool:
+    """RAG_LEXICAL=1 sempre, "auto" solo se esiste una sorgente per l'indice."""
+    return LEXICAL == "1" or (LEXICAL == "auto" and INDEX._source() is not None)
+
+
+def confident(query: str, results) -> bool:
+    """
+    Match lessicale netto: query breve (≤ MAX_TERMS termini), tutti i termini nel primo
+    risultato e in più
+    - tutti i termini nel nome della sua sorgente (es. "intavolazione" → Intavolazione.txt), oppure
+    - norm_score ≥ MIN_SCORE: il chunk è "fatto" di quei termini, non li cita di passaggio.
+    Niente distacco dal secondo risultato: il secondo è spesso un altro chunk della stessa
+    pagina con score quasi uguale, e il fast path non scattava mai.
+    """
+    if not results:
+        return False
+    top = results[0]
+    if top["query_terms"] > MAX_TERMS or top["matched_terms"] < top["query_terms"]:
+        return False
+    name = _EXT.sub("", top["metadata"].get("source_name") or "")
+    if name and set(tokenize(query)) <= set(tokenize(name)):
+        return True
+    return top.get("norm_score", 0.0) >= MIN_SCORE
+
+
+def _pid(p) -> str:
+    # il testo identifica il chunk in entrambe le liste (i risultati di /memory/recall
+    # non sempre hanno chunk_id); chunk_id solo come ripiego. Hash del testo intero: i primi
+    # caratteri non bastano, i chunk iniziali di pagine dello stesso sito hanno la stessa
+    # intestazione di trafilatura
+    text = " ".join((p.get("text") or "").split())
+    if text:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+    return (p.get("metadata") or {}).get("chunk_id") or ""
+
+
+def dedupe(passages):
+    """Un solo passaggio per testo (il primo, cioè quello con il rank migliore)."""
+    seen, out = set(), []
+    for p in passages:
+        key = _pid(p)
+        if key not in seen:
+            seen.add(key)
+            out.append(p)
+    return out
+
+
+def rrf_fuse(dense, lexical, k: int, rrf_k: int = RRF_K):
+    """
+    Reciprocal Rank Fusion: score = somma 1/(rrf_k + rank) sulle due liste, ciascuna senza
+    duplicati (un testo ripetuto prenderebbe più posti e sommerebbe il proprio score).
+    """
+    scores, items = defaultdict(float), {}
+    for results in (dedupe(dense), dedupe(lexical)):
+        for rank, p in enumerate(results, start=1):
+            key = _pid(p)
+            scores[key] += 1.0 / (rrf_k + rank)
+            items.setdefault(key, p)   # a parità si tiene il passaggio denso (metadati del Cat)
+    fused = sorted(scores, key=lambda key: -scores[key])[:k]
+    return [{**items[key], "score": round(scores[key], 6)} for key in fused]
+
+
+INDEX = LexicalIndex()
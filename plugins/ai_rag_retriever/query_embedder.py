@@ -0,0 +1,98 @@
+# plugins/ai_rag_retriever/query_embedder.py
+"""
+Embedding delle query per la ricerca diretta (RAG_MODE=direct) con lo stesso modello
+usato per indicizzare kb_legale_it (la collection non è quella del Cat):
+- RAG_QUERY_MODEL="auto": modello scritto dall'ingestione nel file di versione
+  (data/kb_legale_it.version, campo model_name; vedi preprocessing/upload_to_qdrant.py)
+- RAG_QUERY_MODEL="cat": embedder del Cat (solo se è davvero lo stesso modello)
+- altrimenti id HF o cartella del modello
+- jina-embeddings-v4: adapter "retrieval" e prefisso "Query" del processor, come
+  embed_chunks_v4.py; gli altri (es. multilingual-e5-large): mean pooling + L2 come
+  embed_chunks_2.py, con RAG_QUERY_PREFIX davanti al testo (es. "query: " per e5)
+"""
+import json, os, threading
+
+import numpy as np
+
+from .recall_cache import VERSION_FILE
+
+QUERY_MODEL  = os.getenv("RAG_QUERY_MODEL", "auto")
+QUERY_PREFIX = os.getenv("RAG_QUERY_PREFIX", "")
+MAX_LEN      = int(os.getenv("RAG_QUERY_MAX_LEN", "512"))
+DEVICE       = os.getenv("RAG_QUERY_DEVICE", "cpu")
+
+_lock = threading.Lock()
+_models = {}   # model id -> funzione testo -> vettore
+
+
+def model_name() -> str:
+    """Modello da usare: RAG_QUERY_MODEL, o con "auto" quello dell'ultima ingestione."""
+    if QUERY_MODEL != "auto":
+        return QUERY_MODEL
+    try:
+        with open(VERSION_FILE, "r", encoding="utf-8") as f:
+            name = json.load(f).get("model_name")
+    except (OSError, ValueError):
+        name = None
+    if not name:
+        raise RuntimeError(f"RAG_QUERY_MODEL=auto ma {VERSION_FILE} non indica il modello dell'ingestione:"
+                           " rilancia l'upload o imposta RAG_QUERY_MODEL")
+    return name
+
+
+def _load_jina_v4(name: str):
+    import torch
+    from transformers import AutoModel, AutoProcessor
+
+    model = AutoModel.from_pretrained(name, trust_remote_code=True, dtype=torch.float32).to(DEVICE).eval()
+    processor = AutoProcessor.from_pretrained(name, trust_remote_code=True)
+
+    def embed(text: str):
+        batch = processor.process_texts(texts=[text], prefix="Query", max_length=MAX_LEN)
+        with torch.no_grad():
+            out = model.model(**{k: v.to(DEVICE) for k, v in batch.items()}, task_label="retrieval")
+            vec = torch.nn.functional.normalize(out.single_vec_emb, p=2, dim=1)
+        return vec[0].to(torch.float32).cpu().numpy()
+
+    return embed
+
+
+def _load_mean_pooling(name: str):
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(name)
+    model = AutoModel.from_pretrained(name).to(DEVICE).eval()
+
+    def embed(text: str):
+        inputs = tokenizer([QUERY_PREFIX + text], truncation=True, max_length=MAX_LEN,
+                           return_tensors="pt").to(DEVICE)
+        with torch.no_grad():
+            out = model(**inputs)
+            mask = inputs["attention_mask"].unsqueeze(-1).to(out.last_hidden_state.dtype)
+            vec = (out.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            vec = torch.nn.functional.normalize(vec, p=2, dim=1)
+        return vec[0].cpu().numpy()
+
+    return embed
+
+
+def _load(name: str):
+    if name not in _models:
+        with _lock:
+            if name not in _models:
+                loader = _load_jina_v4 if "jina-embeddings-v4" in name else _load_mean_pooling
+                _models[name] = loader(name)
+                print(f"[ai_rag_retriever] Embedder delle query: {name} ({DEVICE})")
+    return _models[name]
+
+
+def embed_fn(cat=None):
+    """Funzione testo -> vettore (lista di float) per la ricerca diretta."""
+    if QUERY_MODEL == "cat":
+        embedder = getattr(cat, "embedder", None)
+        if embedder is None:
+            raise RuntimeError("RAG_QUERY_MODEL=cat ma il Cat non ha un embedder")
+        return lambda text: list(map(float, embedder.embed_query(QUERY_PREFIX + text)))
+    name = model_name()
+    return lambda text: np.asarray(_load(name)(text), dtype=np.float32).tolist()
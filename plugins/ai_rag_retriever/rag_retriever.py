@@ -1,57 +1,76 @@
 # plugins/ai_rag_retriever/rag_retriever.py
-import os, requests
+import os
 from datetime import datetime
 
+from . import direct_search, tracing
+from .chunk_store import hydrate
+from .context_packer import pack
+from .http_client import aget_json, get_json
+
 CC_URL    = os.getenv("RAG_CC_URL", "http://127.0.0.1")
 TOP_K     = int(os.getenv("RAG_TOP_K", "5"))
-MAX_CHARS = int(os.getenv("RAG_MAX_CHARS", "3000"))
 LOG_FILE  = "/app/cat/data/rag_retriever.log"
 
-def recall(query: str, k: int = TOP_K, timeout: int = 10):
+def _normalize(items):
+    norm = []
+    for it in items or []:
+        print(it)
+        if isinstance(it, str):
+            norm.append({"text": it, "metadata": {}, "score": None})
+        elif isinstance(it, dict):
+            text = (it.get("text") or "").strip()
+            meta = it.get("metadata") or it.get("meta") or {}
+            score = it.get("score")
+            payload = it.get("payload") if isinstance(it.get("payload"), dict) else {}
+            if not text and payload:
+                text = (payload.get("text") or "").strip()
+                meta = payload.get("metadata") or meta
+            # punti payload-lite: solo chunk_id, il testo arriva dal chunk store
+            cid = it.get("chunk_id") or meta.get("chunk_id") or payload.get("chunk_id")
+            if not text and cid:
+                meta = {**meta, "chunk_id": cid}
+            elif not text:
+                text = str(it)
+            norm.append({"text": text, "metadata": meta or {}, "score": score})
+        else:
+            norm.append({"text": str(it), "metadata": {}, "score": None})
+    return hydrate(norm)
+
+def recall(query: str, k: int = TOP_K, timeout: float = None, embed_fn=None):
+    """
+    Recall sincrono sul pool condiviso; `timeout` = timeout di lettura (None = RAG_HTTP_READ_TIMEOUT).
+    Con RAG_MODE=direct interroga Qdrant direttamente; senza `embed_fn` la query si embedda
+    con il modello dell'ingestione (query_embedder.py).
+    """
+    if not (query or "").strip():
+        return []
+    if direct_search.enabled():
+        try:
+            return hydrate(direct_search.search(query, k, embed_fn=embed_fn))
+        except Exception as e:
+            print("[ai_rag_retriever] direct search error, ripiego su HTTP:", e)
+    try:
+        items = get_json(f"{CC_URL}/memory/recall", {"text": query, "k": k}, read_timeout=timeout)
+        return _normalize(items)
+    except Exception as e:
+        print("[ai_rag_retriever] recall error:", e)
+        return []
+
+async def arecall(query: str, k: int = TOP_K, timeout: float = None):
+    """Come recall(), ma non blocca l'event loop (richiede httpx)."""
     if not (query or "").strip():
         return []
     try:
-        r = requests.get(f"{CC_URL}/memory/recall", params={"text": query, "k": k}, timeout=timeout)
-        r.raise_for_status()
-        items = r.json() or []
-        norm = []
-        for it in items:
-            print(it)
-            if isinstance(it, str):
-                norm.append({"text": it, "metadata": {}, "score": None})
-            elif isinstance(it, dict):
-                text = (it.get("text") or "").strip()
-                meta = it.get("metadata") or it.get("meta") or {}
-                score = it.get("score")
-                if not text and isinstance(it.get("payload"), dict):
-                    text = (it["payload"].get("text") or "").strip()
-                    meta = it["payload"].get("metadata") or meta
-                if not text:
-                    text = str(it)
-                norm.append({"text": text, "metadata": meta or {}, "score": score})
-            else:
-                norm.append({"text": str(it), "metadata": {}, "score": None})
-        return norm
+        items = await aget_json(f"{CC_URL}/memory/recall", {"text": query, "k": k}, read_timeout=timeout)
+        return _normalize(items)
     except Exception as e:
         print("[ai_rag_retriever] recall error:", e)
         return []
 
-def render(passages):
-    parts = []
-    for i, it in enumerate(passages, start=1):
-        text = (it.get("text") or "").strip()
-        meta = it.get("metadata") or {}
-        src  = meta.get("source") or meta.get("file") or meta.get("url") or ""
-        page = meta.get("page") or meta.get("chunk_id") or ""
-        head = f"[{i}] {src}" + (f" (p.{page})" if page else "")
-        parts.append((head.strip() + "\n" + text).strip())
-    body = "\n\n---\n\n".join(parts).strip()
-    return (body[:MAX_CHARS] + " …[troncato]") if (MAX_CHARS and len(body) > MAX_CHARS) else body
+def render(passages, budget: int = None):
+    """Contesto entro `budget` token (None = RAG_CONTEXT_TOKENS), vedi context_packer.pack."""
+    return pack(passages, budget)[0]
 
 def log(msg: str):
-    try:
-        os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(f"{datetime.now().isoformat()} {msg}\n")
-    except Exception:
-        pass
+    # append e rotazione nel thread di tracing.py: nessun open() nel percorso della richiesta
+    tracing.write_line(LOG_FILE, f"{datetime.now().isoformat()} {msg}")
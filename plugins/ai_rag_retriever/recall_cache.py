@@ -0,0 +1,161 @@
+# plugins/ai_rag_retriever/recall_cache.py
+"""
+Cache dei risultati di recall, a due livelli:
+- hit esatto: stessa query normalizzata (minuscole, spazi, punteggiatura finale) + k + domain
+- hit semantico: embedding della query con similarità coseno >= RAG_CACHE_SIM
+  rispetto a una query già in cache (stessi k e domain) e, con RAG_CACHE_LEXICAL=1,
+  stesse parole di contenuto (radici di 5 lettere delle parole di almeno 4): cambiano
+  ordine, articoli, singolare/plurale, ma "visura catastale attuale" non diventa "storica"
+
+L'embedding della query si calcola solo dopo un miss esatto e solo se c'è almeno una query
+candidata (stessi k/domain e, col guard lessicale, stesse parole): le voci in cache senza
+embedding lo ricevono alla prima volta che fanno da candidate.
+
+LRU limitata (RAG_CACHE_SIZE) con TTL (RAG_CACHE_TTL secondi). Si svuota quando
+cambia il file di versione scritto dall'ingestione (data/kb_legale_it.version,
+vedi preprocessing/upload_to_qdrant.py), cioè dopo ogni re-ingest della collection.
+"""
+import os, re, threading, time
+from collections import OrderedDict
+
+import numpy as np
+
+CACHE_SIZE     = int(os.getenv("RAG_CACHE_SIZE", "256"))
+CACHE_TTL      = float(os.getenv("RAG_CACHE_TTL", "900"))
+CACHE_SIM      = float(os.getenv("RAG_CACHE_SIM", "0.97"))
+CACHE_SEMANTIC = os.getenv("RAG_CACHE_SEMANTIC", "1") == "1"
+CACHE_LEXICAL  = os.getenv("RAG_CACHE_LEXICAL", "1") == "1"
+VERSION_FILE   = os.getenv("RAG_KB_VERSION_FILE", "/app/cat/data/kb_legale_it.version")
+VERSION_CHECK  = 2.0    # sec tra due controlli del file di versione
+
+_WS = re.compile(r"\s+")
+_TRAIL = re.compile(r"[\s?!.;:,…]+$")
+_WORD = re.compile(r"\w+")
+
+
+def normalize_query(q: str) -> str:
+    return _TRAIL.sub("", _WS.sub(" ", (q or "").lower())).strip()
+
+
+def content_terms(normalized: str) -> frozenset:
+    """Radici delle parole di contenuto: due query con radici diverse non sono la stessa domanda."""
+    return frozenset(w[:5] for w in _WORD.findall(normalized) if len(w) >= 4)
+
+
+def _unit(vec):
+    v = np.asarray(vec, dtype=np.float32).ravel()
+    n = float(np.linalg.norm(v))
+    return v / n if n > 0 else v
+
+
+class RecallCache:
+    def __init__(self, size: int = CACHE_SIZE, ttl: float = CACHE_TTL, sim: float = CACHE_SIM,
+                 version_file: str = VERSION_FILE):
+        self.size, self.ttl, self.sim = size, ttl, sim
+        self.version_file = version_file
+        self._items = OrderedDict()   # key -> [scadenza, passages, embedding | None, query originale]
+        self._lock = threading.Lock()
+        self._version = self._read_version()
+        self._checked = time.monotonic()
+        self._stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0,
+                       "evictions": 0, "expired": 0, "invalidations": 0}
+
+    # --- versione della collection ---
+    def _read_version(self):
+        try:
+            st = os.stat(self.version_file)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _check_version(self):
+        now = time.monotonic()
+        if now - self._checked < VERSION_CHECK:
+            return
+        self._checked = now
+        v = self._read_version()
+        if v != self._version:
+            self._version = v
+            if self._items:
+                self._items.clear()
+                self._stats["invalidations"] += 1
+
+    # --- API ---
+    @staticmethod
+    def _key(query, k, domain):
+        return (normalize_query(query), int(k), domain or "")
+
+    def get(self, query: str, k: int, domain: str = "", embed_fn=None):
+        """(passages | None, "exact" | "semantic" | None, embedding della query se calcolato | None)."""
+        key = self._key(query, k, domain)
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            hit = self._items.get(key)
+            if hit is not None:
+                if hit[0] > now:
+                    self._items.move_to_end(key)
+                    self._stats["exact_hits"] += 1
+                    return [dict(p) for p in hit[1]], "exact", hit[2]
+                del self._items[key]
+                self._stats["expired"] += 1
+            candidates = [(kk, v) for kk, v in self._items.items() if kk[1:] == key[1:] and v[0] > now]
+        if CACHE_LEXICAL:
+            terms = content_terms(key[0])
+            candidates = [(kk, v) for kk, v in candidates if content_terms(kk[0]) == terms]
+        else:
+            # senza guard lessicale i candidati sono tutta la cache: solo quelli già embeddati
+            candidates = [(kk, v) for kk, v in candidates if v[2] is not None]
+
+        emb = None
+        if embed_fn is not None and CACHE_SEMANTIC and candidates:
+            try:
+                emb = _unit(embed_fn(query))
+                for _, v in candidates:
+                    if v[2] is None:
+                        v[2] = _unit(embed_fn(v[3]))   # pochi: stesse parole di contenuto
+            except Exception as e:
+                print("[ai_rag_retriever] cache embed error:", e)
+                emb = None
+        if emb is not None:
+            sims = np.stack([v[2] for _, v in candidates]) @ emb
+            best = int(np.argmax(sims))
+            if sims[best] >= self.sim:
+                kk, v = candidates[best]
+                with self._lock:
+                    # l'embedding ha richiesto tempo: si ricontrolla la versione e che la voce
+                    # sia ancora quella (non invalidata, scaduta o sostituita) prima di usarla
+                    self._check_version()
+                    if self._items.get(kk) is v:
+                        self._items.move_to_end(kk)
+                        self._stats["semantic_hits"] += 1
+                        return [dict(p) for p in v[1]], "semantic", emb
+        with self._lock:
+            self._stats["misses"] += 1
+        return None, None, emb
+
+    def put(self, query: str, k: int, domain: str, passages, emb=None):
+        if not passages:
+            return   # risultati vuoti (o errori) non vanno in cache
+        key = self._key(query, k, domain)
+        with self._lock:
+            self._items[key] = [time.time() + self.ttl, [dict(p) for p in passages],
+                                _unit(emb) if emb is not None else None, query]
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            st = dict(self._stats, size=len(self._items))
+        lookups = st["exact_hits"] + st["semantic_hits"] + st["misses"]
+        st["hit_rate"] = round((st["exact_hits"] + st["semantic_hits"]) / lookups, 4) if lookups else 0.0
+        return st
+
+
+CACHE = RecallCache()
@@ -0,0 +1,166 @@
+# plugins/ai_rag_retriever/reranker.py
+"""
+Reranking dei passaggi recuperati con un cross-encoder ONNX su CPU (RAG_RERANK=1):
+- il recall chiede RAG_RERANK_CANDIDATES candidati, il cross-encoder li rimette in
+  ordine e nel prompt vanno solo i primi RAG_RERANK_TOP_K
+- modello in RAG_RERANK_MODEL: cartella con tokenizer.json + model*.onnx (preferite le
+  varianti quantizzate int8) oppure path diretto al file .onnx
+- tutte le coppie (query, passaggio) in un solo batch, una sola chiamata al modello
+- budget di tempo per richiesta (RAG_RERANK_BUDGET_MS): se scade, o se il modello non è
+  ancora caricato / è occupato, si tiene l'ordine vettoriale
+"""
+import os, threading, time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from pathlib import Path
+
+import numpy as np
+
+RERANK        = os.getenv("RAG_RERANK", "0") == "1"
+RERANK_MODEL  = os.getenv("RAG_RERANK_MODEL", "/app/cat/data/models/reranker")
+CANDIDATES    = int(os.getenv("RAG_RERANK_CANDIDATES", "20"))
+TOP_K         = int(os.getenv("RAG_RERANK_TOP_K", "3"))
+BUDGET_MS     = float(os.getenv("RAG_RERANK_BUDGET_MS", "300"))
+MAX_LEN       = int(os.getenv("RAG_RERANK_MAX_LEN", "256"))
+NUM_THREADS   = int(os.getenv("RAG_RERANK_THREADS", "0")) or None
+
+# in ordine di preferenza: quantizzate int8, poi ottimizzate, poi fp32
+ONNX_VARIANTS = ("model_quantized.onnx", "model_qint8_avx512_vnni.onnx", "model_qint8_avx512.onnx",
+                 "model_quint8_avx2.onnx", "model_qint8_arm64.onnx", "model_int8.onnx",
+                 "model_O3.onnx", "model_O2.onnx", "model.onnx")
+
+_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rag-rerank")
+_lock = threading.Lock()
+_model = None
+_load_error = None   # modello mancante / runtime non installato: niente rerank, un solo avviso
+_pending = None   # future dell'ultimo batch (o del caricamento)
+_stats = {"reranked": 0, "timeouts": 0, "busy": 0, "errors": 0, "total_ms": 0.0}
+
+
+def _is_model_file(p: Path) -> bool:
+    """Esclude i puntatori git-lfs non scaricati."""
+    if not p.is_file():
+        return False
+    with p.open("rb") as f:
+        return not f.read(64).startswith(b"version https://git-lfs")
+
+
+def _find_model(path: str):
+    p = Path(path)
+    if p.suffix == ".onnx":
+        return p, p.parent
+    for name in ONNX_VARIANTS:
+        for cand in (p / name, p / "onnx" / name):
+            if _is_model_file(cand):
+                return cand, p
+    raise FileNotFoundError(f"Nessun cross-encoder ONNX utilizzabile in {p}")
+
+
+class CrossEncoder:
+    """Tokenizzazione a coppie + forward ONNX; restituisce un logit di rilevanza per coppia."""
+
+    def __init__(self, path: str = RERANK_MODEL, max_len: int = MAX_LEN, num_threads: int = NUM_THREADS):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_path, model_dir = _find_model(path)
+        self.tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_len)
+        pad = next((t for t in ("[PAD]", "<pad>") if self.tokenizer.token_to_id(t) is not None), "[PAD]")
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id(pad) or 0, pad_token=pad)
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            opts.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(str(model_path), sess_options=opts,
+                                            providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.variant = model_path.name
+
+    def score(self, query: str, texts) -> np.ndarray:
+        if not texts:
+            return np.empty((0,), dtype=np.float32)
+        encs = self.tokenizer.encode_batch([(query, t) for t in texts])
+        feed = {
+            "input_ids": np.array([e.ids for e in encs], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encs], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encs], dtype=np.int64),
+        }
+        logits = np.asarray(self.session.run(None, {k: v for k, v in feed.items() if k in self.input_names})[0],
+                            dtype=np.float32)
+        # (B, 1) → logit di rilevanza; (B, 2) → classe "rilevante"
+        return logits.reshape(len(texts), -1)[:, -1]
+
+
+def _load():
+    global _model, _load_error
+    if _model is None:
+        t0 = time.perf_counter()
+        try:
+            _model = CrossEncoder()
+        except Exception as e:
+            _load_error = f"{type(e).__name__}: {e}"
+            print("[ai_rag_retriever] reranker non disponibile, ordine vettoriale:", _load_error)
+            raise
+        print(f"[ai_rag_retriever] Reranker caricato: {_model.variant}"
+              f" ({(time.perf_counter() - t0) * 1000:.0f} ms)")
+    return _model
+
+
+def enabled() -> bool:
+    return RERANK
+
+
+def warmup():
+    """Carica il modello in background (il primo recall non deve pagarne il caricamento)."""
+    global _pending
+    if RERANK and _model is None:
+        with _lock:
+            if _pending is None:
+                _pending = _pool.submit(_load)
+
+
+def rerank(query: str, passages, top_k: int = TOP_K, budget_ms: float = BUDGET_MS):
+    """Primi top_k passaggi per rilevanza; entro budget_ms, altrimenti ordine vettoriale."""
+    global _pending
+    fallback = list(passages)[:top_k]
+    if not RERANK or _load_error or len(passages) <= 1:
+        return fallback
+    texts = [(p.get("text") or "") for p in passages]
+    with _lock:
+        # un batch alla volta: se il precedente (o il caricamento) non è finito non si accoda
+        if _pending is not None and not _pending.done():
+            _stats["busy"] += 1
+            return fallback
+        t0 = time.perf_counter()
+        _pending = fut = _pool.submit(lambda: _load().score(query, texts))
+    try:
+        scores = fut.result(timeout=budget_ms / 1000.0)
+    except FutureTimeout:
+        with _lock:
+            _stats["timeouts"] += 1
+        print(f"[ai_rag_retriever] rerank oltre il budget ({budget_ms:.0f} ms), ordine vettoriale")
+        return fallback
+    except Exception as e:
+        with _lock:
+            _stats["errors"] += 1
+        print("[ai_rag_retriever] rerank error:", e)
+        return fallback
+    ms = (time.perf_counter() - t0) * 1000.0
+    with _lock:
+        _stats["reranked"] += 1
+        _stats["total_ms"] += ms
+    order = np.argsort(-scores, kind="stable")[:top_k]
+    return [{**passages[i], "score": round(float(scores[i]), 4), "vector_rank": int(i) + 1} for i in order]
+
+
+def stats() -> dict:
+    with _lock:
+        st = dict(_stats)
+    st["avg_ms"] = round(st["total_ms"] / st["reranked"], 2) if st["reranked"] else 0.0
+    st["total_ms"] = round(st["total_ms"], 2)
+    st["loaded"] = _model is not None
+    st["load_error"] = _load_error
+    return st
+
+
+warmup()
@@ -0,0 +1,103 @@
+# plugins/ai_rag_retriever/retrieval.py
+"""
+Recall della knowledge base per il turno, condiviso da hooks.py e speculative.py:
+- recall(): ricerca diretta su Qdrant (RAG_MODE=direct) o /memory/recall del Cat via HTTP
+- cached_recall(): cache (esatta/semantica), BM25 con fast path o fusione RRF, reranker
+"""
+import os
+from cat.log import logger
+
+from . import direct_search, lexical_index, query_embedder, reranker, tracing
+from .chunk_store import hydrate
+from .http_client import get_json
+from .recall_cache import CACHE
+
+CC_URL    = os.getenv("RAG_CC_URL", "http://127.0.0.1")
+TOP_K     = int(os.getenv("RAG_TOP_K", "5"))
+DOMAIN    = os.getenv("RAG_DOMAIN", "")
+
+
+def recall(q: str, k: int = TOP_K, embed_fn=None, vector=None):
+    logger.info(f"[ai_rag_retriever] Eseguo recall su Qdrant: '{q}' (k={k}, domain='{DOMAIN}',"
+                f" mode={direct_search.RAG_MODE})")
+    if direct_search.enabled():
+        # ricerca diretta su kb_legale_it: niente hop HTTP verso /memory/recall
+        try:
+            with tracing.stage("recall_direct"):
+                return hydrate(direct_search.search(q, k, DOMAIN, embed_fn, vector))
+        except Exception as e:
+            print("[ai_rag_retriever] direct search error, ripiego su HTTP:", e)
+    try:
+        params = {"text": q, "k": k}
+        if DOMAIN:
+            params["domain"] = DOMAIN
+        # pool keep-alive condiviso, timeout connect/read separati (http_client.py)
+        with tracing.stage("recall_http"):
+            items = get_json(f"{CC_URL}/memory/recall", params) or []
+        norm = []
+        for it in items:
+            if isinstance(it, str):
+                norm.append({"text": it, "metadata": {}, "score": None})
+            elif isinstance(it, dict):
+                text = (it.get("text") or "").strip()
+                meta = it.get("metadata") or it.get("meta") or {}
+                score = it.get("score")
+                payload = it.get("payload") if isinstance(it.get("payload"), dict) else {}
+                if not text and payload:
+                    text = (payload.get("text") or "").strip()
+                    meta = payload.get("metadata") or meta
+                # punti payload-lite: solo chunk_id, il testo arriva dal chunk store
+                cid = it.get("chunk_id") or meta.get("chunk_id") or payload.get("chunk_id")
+                if not text and cid:
+                    meta = {**meta, "chunk_id": cid}
+                elif not text:
+                    text = str(it)
+                norm.append({"text": text, "metadata": meta or {}, "score": score})
+            else:
+                norm.append({"text": str(it), "metadata": {}, "score": None})
+        return hydrate(norm)
+    except Exception as e:
+        print("[ai_rag_retriever] recall error:", e)
+        return []
+
+
+def cached_recall(q: str, cat, k: int = TOP_K):
+    """Recall con cache: hit esatto, poi per similarità dell'embedding della query."""
+    # stesso embedding per la cache e per la ricerca diretta: in modalità diretta quello del
+    # modello dell'ingestione (la collection non è del Cat), altrimenti basta l'embedder del Cat.
+    # La cache lo calcola solo se ha query candidate, altrimenti emb resta None
+    embed_fn = None
+    if direct_search.enabled():
+        try:
+            embed_fn = query_embedder.embed_fn(cat)
+        except Exception as e:
+            logger.error(f"[ai_rag_retriever] Embedder delle query non disponibile: {e}")
+    elif getattr(cat, "embedder", None) is not None:
+        embed_fn = cat.embedder.embed_query
+    with tracing.stage("cache_lookup"):
+        passages, kind, emb = CACHE.get(q, k, DOMAIN, embed_fn)
+    if passages is not None:
+        logger.info(f"[ai_rag_retriever] Recall da cache ({kind})")
+        return passages
+
+    # con il reranker si recuperano più candidati e nel prompt ne vanno meno (reranker.TOP_K)
+    fetch = max(k, reranker.CANDIDATES) if reranker.enabled() else k
+    final = min(k, reranker.TOP_K) if reranker.enabled() else k
+
+    # BM25 in memoria: match netto → niente ricerca vettoriale, altrimenti fusione RRF
+    lex = []
+    if lexical_index.enabled():
+        with tracing.stage("lexical"):
+            lex = lexical_index.INDEX.search(q, max(fetch, lexical_index.CANDIDATES), DOMAIN)
+    if lex and lexical_index.LEXICAL_FASTPATH and lexical_index.confident(q, lex):
+        logger.info(f"[ai_rag_retriever] Fast path lessicale (BM25 top={lex[0]['score']})")
+        passages = lex[:final]
+    else:
+        dense = recall(q, k=fetch, embed_fn=embed_fn, vector=emb)
+        passages = lexical_index.rrf_fuse(dense, lex, fetch) if lex else lexical_index.dedupe(dense)
+        if reranker.enabled():
+            with tracing.stage("rerank"):
+                passages = reranker.rerank(q, passages, top_k=final)
+            logger.info(f"[ai_rag_retriever] Rerank: {len(passages)}/{fetch} passaggi | {reranker.stats()}")
+    CACHE.put(q, k, DOMAIN, passages, emb)
+    return passages
@@ -0,0 +1,123 @@
+# plugins/ai_rag_retriever/speculative.py
+"""
+Recall speculativo (RAG_SPECULATIVE=1, disattivo di default): il recall del messaggio parte in un thread
+appena il messaggio arriva (hook a priorità 10, prima di intent_classifier), in parallelo
+alla classificazione dell'intento.
+- intento "info"  → before_cat_reads_message del retriever usa il risultato (take)
+- altro intento   → il risultato si scarta (discard) e il lavoro è contato come sprecato
+Latenza del turno ≈ max(intento, recall) invece della somma, al prezzo di un recall (embedding
++ Qdrant) anche per i messaggi "download": va attivato dove il carico lo permette.
+Statistiche: avviati, usati, scartati, obsoleti, falliti, ms sprecati, ms risparmiati;
+waste_rate = (scartati + obsoleti) / avviati.
+"""
+import os, threading, time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from cat.mad_hatter.decorators import hook
+from cat.log import logger
+
+from . import tracing
+from .retrieval import TOP_K, cached_recall
+
+SPECULATIVE = os.getenv("RAG_SPECULATIVE", "0") == "1"
+WORKERS     = int(os.getenv("RAG_SPECULATIVE_WORKERS", "4"))
+WAIT        = float(os.getenv("RAG_SPECULATIVE_WAIT", "15"))   # sec max di attesa del risultato
+VAR_KEY     = "rag_speculative"
+
+_pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="rag-speculative")
+_lock = threading.Lock()
+_stats = {"started": 0, "used": 0, "discarded": 0, "failed": 0, "stale": 0,
+          "wasted_ms": 0.0, "saved_ms": 0.0}
+
+
+def _count(key: str, value=1):
+    with _lock:
+        _stats[key] += value
+
+
+def _timed(fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - t0) * 1000.0
+
+
+def start(cat, q: str, fn, *args):
+    """Avvia fn(*args) in background e lo lega al turno corrente (cat.vars)."""
+    if not hasattr(cat, "vars") or cat.vars is None:
+        cat.vars = {}
+    discard(cat)   # un eventuale speculativo rimasto dal turno precedente
+    cat.vars[VAR_KEY] = {"q": q, "future": _pool.submit(_timed, fn, *args), "t0": time.perf_counter()}
+    _count("started")
+
+
+def take(cat, q: str):
+    """Risultato dello speculativo per `q` (attende al più WAIT sec); None = ricalcolare."""
+    spec = (getattr(cat, "vars", None) or {}).pop(VAR_KEY, None)
+    if spec is None:
+        return None
+    if spec["q"] != q:
+        _count("stale")
+        _discard(spec)
+        return None
+    t_wait = time.perf_counter()
+    try:
+        result, ms = spec["future"].result(timeout=WAIT)
+    except FutureTimeout:
+        _count("failed")
+        _discard(spec)
+        print(f"[ai_rag_retriever] recall speculativo oltre {WAIT:g}s, lo rifaccio")
+        return None
+    except Exception as e:
+        _count("failed")
+        print("[ai_rag_retriever] recall speculativo fallito:", e)
+        return None
+    waited = (time.perf_counter() - t_wait) * 1000.0
+    _count("used")
+    _count("saved_ms", max(0.0, ms - waited))   # parte del recall nascosta dietro l'intento
+    tracing.event("speculative", outcome="used", recall_ms=round(ms, 3), waited_ms=round(waited, 3))
+    return result
+
+
+def _discard(spec):
+    fut = spec["future"]
+    if fut.cancel():   # ancora in coda: nessun lavoro sprecato
+        return
+
+    def _account(f):
+        try:
+            _, ms = f.result()
+        except Exception:
+            return
+        _count("wasted_ms", ms)
+        tracing.event("speculative", outcome="discarded", recall_ms=round(ms, 3))
+
+    fut.add_done_callback(_account)   # se è in corso, lo spreco si conta quando finisce
+
+
+def discard(cat):
+    """Scarta lo speculativo del turno (intento diverso da "info")."""
+    spec = (getattr(cat, "vars", None) or {}).pop(VAR_KEY, None)
+    if spec is not None:
+        _count("discarded")
+        _discard(spec)
+
+
+def stats() -> dict:
+    with _lock:
+        st = dict(_stats)
+    st["wasted_ms"] = round(st["wasted_ms"], 1)
+    st["saved_ms"] = round(st["saved_ms"], 1)
+    # anche un risultato obsoleto (calcolato per un'altra domanda) è lavoro buttato
+    st["waste_rate"] = round((st["discarded"] + st["stale"]) / st["started"], 4) if st["started"] else 0.0
+    return st
+
+
+# === Hook: avvia il recall prima (e durante) la classificazione dell'intento ===
+@hook(priority=10)
+def before_cat_reads_message(message, cat):
+    q = (message or {}).get("text") or ""
+    if not SPECULATIVE or not q.strip() or q.strip() == "/start":
+        return message
+    start(cat, q, cached_recall, q, cat, TOP_K)
+    logger.info("[ai_rag_retriever] Recall speculativo avviato")
+    return message
@@ -0,0 +1,254 @@
+# plugins/ai_rag_retriever/tracing.py
+"""
+Tracing leggero condiviso dai plugin (ai_rag_retriever, intent_classifier):
+- stage(nome): context manager che misura la durata di una fase del turno
+  (intent LLM, recall, render, assemblaggio del prompt, ...)
+- observe(metrica, valore): dimensioni (passaggi recuperati, token/caratteri del prompt)
+- istogrammi in memoria a bucket fissi + campione recente per p50/p90/p99
+- export in formato testo Prometheus (prometheus_text(), o file per il textfile
+  collector in RAG_METRICS_FILE) e JSONL a rotazione (RAG_TRACE_FILE)
+- la scrittura su disco la fa un thread in background: nel percorso della richiesta
+  c'è solo un put_nowait su una coda (se piena l'evento si scarta e si conta)
+
+Dall'altro plugin: `from cat.plugins.ai_rag_retriever import tracing`.
+"""
+import atexit, json, os, queue, threading, time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+TRACE            = os.getenv("RAG_TRACE", "1") == "1"
+TRACE_FILE       = os.getenv("RAG_TRACE_FILE", "/app/cat/data/rag_trace.jsonl")   # "" = niente JSONL
+METRICS_FILE     = os.getenv("RAG_METRICS_FILE", "/app/cat/data/rag_metrics.prom")  # "" = solo in memoria
+METRICS_INTERVAL = float(os.getenv("RAG_METRICS_INTERVAL", "15"))
+MAX_BYTES        = int(os.getenv("RAG_TRACE_MAX_BYTES", str(5 * 1024 * 1024)))
+BACKUPS          = int(os.getenv("RAG_TRACE_BACKUPS", "3"))
+QUEUE_SIZE       = 10000
+RESERVOIR        = 1024   # ultimi valori per serie, per i quantili
+
+MS_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+METRICS = {
+    # nome: (help, bucket)
+    "rag_stage_duration_ms": ("Durata delle fasi del turno (ms)", MS_BUCKETS),
+    "rag_recall_passages":   ("Passaggi recuperati per richiesta", (0, 1, 2, 3, 5, 8, 10, 20, 50)),
+    "rag_prompt_tokens":     ("Token del prompt prefix (stimati dai caratteri)", (128, 256, 512, 768, 1024, 1536, 2048, 4096, 8192)),
+    "rag_prompt_chars":      ("Caratteri del prompt prefix", (500, 1000, 2000, 3000, 4000, 6000, 8000, 16000, 32000)),
+}
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count, self.sum = 0, 0.0
+        self.recent = deque(maxlen=RESERVOIR)
+
+    def observe(self, value: float):
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def quantile(self, q: float):
+        if not self.recent:
+            return None
+        vals = sorted(self.recent)
+        return vals[min(len(vals) - 1, int(q * len(vals)))]
+
+
+_lock = threading.Lock()
+_series = {}   # (metrica, etichette ordinate) -> Histogram
+_queue = queue.Queue(maxsize=QUEUE_SIZE)
+_dropped = 0
+_writer = None
+
+
+def observe(metric: str, value: float, **labels):
+    if not TRACE or value is None:
+        return
+    if METRICS_FILE and _writer is None:
+        _start_writer()   # il file delle metriche lo aggiorna il thread in background
+    key = (metric, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with _lock:
+        h = _series.get(key)
+        if h is None:
+            h = _series[key] = Histogram(METRICS.get(metric, ("", MS_BUCKETS))[1])
+        h.observe(float(value))
+
+
+def event(kind: str, **fields):
+    """Record JSONL (scritto dal thread in background)."""
+    if TRACE and TRACE_FILE:
+        _enqueue(TRACE_FILE, json.dumps({"ts": datetime.now().isoformat(timespec="milliseconds"),
+                                         "kind": kind, **fields}, ensure_ascii=False, default=str))
+
+
+def write_line(path: str, line: str):
+    """Append asincrono di una riga di testo (con rotazione) su un file qualsiasi."""
+    _enqueue(path, line)
+
+
+@contextmanager
+def stage(name: str, **fields):
+    """Misura la durata del blocco → rag_stage_duration_ms{stage=name} + evento JSONL."""
+    t0 = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        ms = (time.perf_counter() - t0) * 1000.0
+        observe("rag_stage_duration_ms", ms, stage=name)
+        event("stage", stage=name, ms=round(ms, 3), status=status, **fields)
+
+
+def snapshot() -> dict:
+    """{metrica: {etichette: {count, sum, p50, p90, p99}}} per log e debug."""
+    out = {}
+    with _lock:
+        for (metric, labels), h in _series.items():
+            out.setdefault(metric, {})[",".join(f"{k}={v}" for k, v in labels) or "-"] = {
+                "count": h.count, "sum": round(h.sum, 3),
+                **{f"p{int(q * 100)}": h.quantile(q) for q in QUANTILES}}
+    return out
+
+
+def _fmt_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}" if items else ""
+
+
+def prometheus_text() -> str:
+    lines = []
+    with _lock:
+        by_metric = {}
+        for (metric, labels), h in sorted(_series.items()):
+            by_metric.setdefault(metric, []).append((labels, h))
+        for metric, series in by_metric.items():
+            lines.append(f"# HELP {metric} {METRICS.get(metric, (metric,))[0]}")
+            lines.append(f"# TYPE {metric} histogram")
+            for labels, h in series:
+                cum = 0
+                for b, n in zip(h.buckets, h.counts):
+                    cum += n
+                    lines.append(f"{metric}_bucket{_fmt_labels(labels, [('le', f'{b:g}')])} {cum}")
+                lines.append(f"{metric}_bucket{_fmt_labels(labels, [('le', '+Inf')])} {h.count}")
+                lines.append(f"{metric}_sum{_fmt_labels(labels)} {h.sum:.3f}")
+                lines.append(f"{metric}_count{_fmt_labels(labels)} {h.count}")
+            # quantili sugli ultimi RESERVOIR valori (gli istogrammi Prometheus non li danno esatti)
+            lines.append(f"# TYPE {metric}_recent gauge")
+            for labels, h in series:
+                for q in QUANTILES:
+                    v = h.quantile(q)
+                    if v is not None:
+                        lines.append(f"{metric}_recent{_fmt_labels(labels, [('quantile', f'{q:g}')])} {v:.3f}")
+        lines.append("# TYPE rag_trace_dropped_total counter")
+        lines.append(f"rag_trace_dropped_total {_dropped}")
+    return "\n".join(lines) + "\n"
+
+
+# === writer in background ===
+def _enqueue(path: str, line: str):
+    global _dropped
+    if not path:
+        return
+    _start_writer()
+    try:
+        _queue.put_nowait((path, line))
+    except queue.Full:
+        with _lock:
+            _dropped += 1
+
+
+def _rotate(path: str):
+    try:
+        if os.path.getsize(path) < MAX_BYTES:
+            return
+    except OSError:
+        return
+    for i in range(BACKUPS - 1, 0, -1):
+        if os.path.exists(f"{path}.{i}"):
+            os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+    if BACKUPS > 0:
+        os.replace(path, f"{path}.1")
+    else:
+        os.remove(path)
+
+
+def _flush(batch):
+    by_path = {}
+    for path, line in batch:
+        by_path.setdefault(path, []).append(line)
+    for path, lines in by_path.items():
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            _rotate(path)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+        except Exception as e:
+            print("[ai_rag_retriever] trace write error:", e)
+
+
+def _write_metrics():
+    if not (TRACE and METRICS_FILE):
+        return
+    try:
+        os.makedirs(os.path.dirname(METRICS_FILE) or ".", exist_ok=True)
+        tmp = METRICS_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(prometheus_text())
+        os.replace(tmp, METRICS_FILE)   # il collector non vede mai un file a metà
+    except Exception as e:
+        print("[ai_rag_retriever] metrics write error:", e)
+
+
+def _drain(block_until: float):
+    batch = []
+    try:
+        batch.append(_queue.get(timeout=max(0.0, block_until - time.monotonic())))
+        while len(batch) < 1000:
+            batch.append(_queue.get_nowait())
+    except queue.Empty:
+        pass
+    if batch:
+        _flush(batch)
+
+
+def _run():
+    next_metrics = time.monotonic() + METRICS_INTERVAL
+    while True:
+        _drain(min(next_metrics, time.monotonic() + 1.0))
+        if time.monotonic() >= next_metrics:
+            _write_metrics()
+            next_metrics = time.monotonic() + METRICS_INTERVAL
+
+
+def _start_writer():
+    global _writer
+    if _writer is None:
+        with _lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_run, name="rag-trace-writer", daemon=True)
+                _writer.start()
+
+
+def flush():
+    """Scrive subito quanto è in coda (e le metriche); usato all'uscita."""
+    batch = []
+    try:
+        while True:
+            batch.append(_queue.get_nowait())
+    except queue.Empty:
+        pass
+    if batch:
+        _flush(batch)
+    _write_metrics()
+
+
+atexit.register(flush)
@@ -3,6 +3,15 @@ import json
 from cat.mad_hatter.decorators import hook
 from cat.log import logger
 
+from .local_intent import classify
+try:
+    # tracing condiviso col plugin ai_rag_retriever (istogrammi + export Prometheus/JSONL)
+    from cat.plugins.ai_rag_retriever import tracing
+except ImportError:
+    from contextlib import nullcontext
+
+    class tracing:  # no-op se il retriever non è installato
+        stage = staticmethod(lambda name, **fields: nullcontext())
 
 PROMPT_INTENT = """
 Sei un classificatore di richieste relative a documenti notarili e catastali.
@@ -44,11 +53,18 @@ def before_cat_reads_message(message, cat):
     if not user_text.strip():
         return message
 
-    intent = _ask_llm_for_intent(cat, user_text)
+    # prima il classificatore locale (embedding + centroidi); l'LLM solo se poco sicuro
+    with tracing.stage("intent_local"):
+        intent, conf = classify(user_text, cat)
+    source = "locale"
+    if intent is None:
+        source = f"LLM (confidenza locale {conf:.2f})"
+        with tracing.stage("intent_llm"):
+            intent = _ask_llm_for_intent(cat, user_text)
 
     if not hasattr(cat, "vars") or cat.vars is None:
         cat.vars = {}
     cat.vars["intent"] = intent
 
-    logger.info(f"[intent_router] Intent rilevato dal LLM: {intent}")
+    logger.info(f"[intent_router] Intent rilevato ({source}): {intent}")
     return message
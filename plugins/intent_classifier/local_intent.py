@@ -0,0 +1,125 @@
+# plugins/intent_classifier/local_intent.py
+"""
+Classificatore d'intento locale ("info" / "download") senza chiamata all'LLM:
+- embedding della frase con all-MiniLM-L6-v2 (ONNX su CPU) con onnx_embedder.py del plugin,
+  lo stesso codice usato da preprocessing/embedders.py; il modello arriva dalla cartella
+  models/ montata in compose.yaml (RAG_INTENT_MODEL); se manca si usa l'embedder del Cat
+- nearest-centroid: un centroide per intento, media degli esempi di intent_examples.json
+- confidenza = softmax delle similarità coseno con i centroidi (temperatura
+  RAG_INTENT_TEMPERATURE); sotto RAG_INTENT_THRESHOLD decide l'LLM
+"""
+import json, os, threading
+from pathlib import Path
+
+import numpy as np
+from cat.log import logger
+
+from .onnx_embedder import OnnxEmbedder
+
+_REPO = Path(__file__).resolve().parents[2]   # esecuzione fuori dal container (models/ del repo)
+
+LOCAL_INTENT     = os.getenv("RAG_LOCAL_INTENT", "1") == "1"
+INTENT_MODEL     = os.getenv("RAG_INTENT_MODEL", "/app/cat/models/all-MiniLM-L6-v2")
+INTENT_EXAMPLES  = os.getenv("RAG_INTENT_EXAMPLES", str(Path(__file__).with_name("intent_examples.json")))
+INTENT_THRESHOLD = float(os.getenv("RAG_INTENT_THRESHOLD", "0.75"))
+TEMPERATURE      = float(os.getenv("RAG_INTENT_TEMPERATURE", "0.05"))
+MAX_LEN          = 128
+
+
+def _unit(m: np.ndarray) -> np.ndarray:
+    return m / np.clip(np.linalg.norm(m, axis=-1, keepdims=True), 1e-12, None)
+
+
+def _first_existing(*paths) -> Path:
+    return next((Path(p) for p in paths if Path(p).exists()), Path(paths[0]))
+
+
+class MiniLM:
+    """all-MiniLM-L6-v2 con OnnxEmbedder (onnx_embedder.py)."""
+
+    def __init__(self, model_dir: str = INTENT_MODEL, num_threads: int = 1):
+        model_dir = _first_existing(model_dir, _REPO / "models" / "all-MiniLM-L6-v2")
+        # frasi brevi: un thread basta, niente contesa col Cat
+        self.embedder = OnnxEmbedder(model_dir, MAX_LEN, num_threads)
+        self.name = f"minilm/{self.embedder.variant}"
+
+    def encode(self, texts) -> np.ndarray:
+        return self.embedder.encode(list(texts))
+
+
+class CatEmbedder:
+    """Ripiego: l'embedder configurato nel Cat (stessa interfaccia di MiniLM.encode)."""
+
+    def __init__(self, embedder):
+        self.embedder = embedder
+        self.name = f"cat/{type(embedder).__name__}"
+
+    def encode(self, texts) -> np.ndarray:
+        texts = list(texts)
+        if len(texts) > 1 and hasattr(self.embedder, "embed_documents"):
+            vecs = self.embedder.embed_documents(texts)
+        else:
+            vecs = [self.embedder.embed_query(t) for t in texts]
+        return _unit(np.asarray(vecs, dtype=np.float32))
+
+
+class CentroidClassifier:
+    def __init__(self, encoder, examples: dict):
+        self.encoder = encoder
+        self.labels = sorted(examples)
+        self.centroids = _unit(np.stack([encoder.encode(examples[lab]).mean(axis=0) for lab in self.labels]))
+
+    def predict(self, text: str):
+        """(intento, confidenza, {intento: similarità})."""
+        sims = self.centroids @ self.encoder.encode([text])[0]
+        p = np.exp((sims - sims.max()) / TEMPERATURE)
+        p /= p.sum()
+        best = int(np.argmax(p))
+        return self.labels[best], float(p[best]), {lab: round(float(s), 4) for lab, s in zip(self.labels, sims)}
+
+
+_lock = threading.Lock()
+_classifier = None
+_error = None   # nessun encoder disponibile: sempre LLM, un solo avviso
+
+
+def load_examples(path: str = INTENT_EXAMPLES) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return {lab: [t for t in texts if t.strip()] for lab, texts in json.load(f).items()}
+
+
+def get_classifier(cat=None):
+    global _classifier, _error
+    if _classifier is None and _error is None:
+        with _lock:
+            if _classifier is None and _error is None:
+                try:
+                    try:
+                        encoder = MiniLM()
+                    except Exception as e:
+                        embedder = getattr(cat, "embedder", None)
+                        if embedder is None:
+                            raise
+                        print(f"[intent_router] MiniLM non disponibile ({e}), uso l'embedder del Cat")
+                        encoder = CatEmbedder(embedder)
+                    _classifier = CentroidClassifier(encoder, load_examples())
+                    print(f"[intent_router] Classificatore locale pronto ({encoder.name},"
+                          f" {', '.join(_classifier.labels)})")
+                except Exception as e:
+                    _error = f"{type(e).__name__}: {e}"
+                    print("[intent_router] Classificatore locale non disponibile, uso l'LLM:", _error)
+    return _classifier
+
+
+def classify(text: str, cat=None, threshold: float = INTENT_THRESHOLD):
+    """(intento | None, confidenza): None = confidenza sotto soglia o classificatore assente."""
+    clf = get_classifier(cat) if LOCAL_INTENT else None
+    if clf is None:
+        return None, 0.0
+    try:
+        intent, conf, sims = clf.predict(text)
+    except Exception as e:
+        print("[intent_router] Errore classificatore locale:", e)
+        return None, 0.0
+    logger.debug(f"[intent_router] Locale: {intent} (p={conf:.2f}, sim={sims})")
+    return (intent if conf >= threshold else None), conf
@@ -0,0 +1,126 @@
+# plugins/intent_classifier/onnx_embedder.py
+"""
+Embedder ONNX su CPU per all-MiniLM-L6-v2 (tokenizers + onnxruntime, niente torch):
+- variante ONNX scelta in base alle flag della CPU (avx512_vnni, avx512, avx2, arm64)
+- pooling come 1_Pooling/config.json: mean sui token (mask) + L2 normalize
+
+Vive nel plugin perché il Cat lo usa a runtime (local_intent.py) e nel container c'è solo
+la cartella plugins/; preprocessing/embedders.py lo carica da qui e ci aggiunge i backend
+torch e OpenVINO per gli script offline. Nessun import del Cat: deve restare caricabile
+anche fuori dal container.
+"""
+from abc import ABC, abstractmethod
+from pathlib import Path
+import json, platform
+
+import numpy as np
+
+
+def cpu_flags() -> set:
+    """Flag della CPU (Linux: /proc/cpuinfo); insieme vuoto se non disponibili."""
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+
+def _is_model_file(p: Path) -> bool:
+    """Esclude i puntatori git-lfs non scaricati (file di poche decine di byte)."""
+    if not p.is_file():
+        return False
+    with p.open("rb") as f:
+        return not f.read(64).startswith(b"version https://git-lfs")
+
+
+def pick_onnx_variant(model_dir: Path, flags: set = None) -> Path:
+    """Variante ONNX più adatta alla CPU: quantizzate int8 se supportate, poi O3, poi fp32."""
+    flags = cpu_flags() if flags is None else flags
+    machine = platform.machine().lower()
+    candidates = []
+    if machine in ("arm64", "aarch64"):
+        candidates.append("model_qint8_arm64.onnx")
+    if "avx512_vnni" in flags or "avx512vnni" in flags:
+        candidates.append("model_qint8_avx512_vnni.onnx")
+    if "avx512f" in flags and "avx512bw" in flags:
+        candidates.append("model_qint8_avx512.onnx")
+    if "avx2" in flags:
+        candidates.append("model_quint8_avx2.onnx")
+    # O4 è fp16 (pensato per GPU): su CPU O3 è l'ottimizzazione più spinta
+    candidates += ["model_O3.onnx", "model_O2.onnx", "model_O1.onnx", "model.onnx"]
+    for name in candidates:
+        p = Path(model_dir) / "onnx" / name
+        if _is_model_file(p):
+            return p
+    raise FileNotFoundError(f"Nessun modello ONNX utilizzabile in {Path(model_dir) / 'onnx'}")
+
+
+class Embedder(ABC):
+    """Tokenizzazione + forward del backend + mean pooling + L2 normalize."""
+
+    backend = None
+
+    def __init__(self, model_dir: Path, max_len: int = 256):
+        from tokenizers import Tokenizer
+
+        self.model_dir = Path(model_dir)
+        self.max_len = max_len
+        self.tokenizer = Tokenizer.from_file(str(self.model_dir / "tokenizer.json"))
+        # tokenizer.json ha padding fisso a 128: qui padding solo fino al più lungo del batch
+        self.tokenizer.enable_truncation(max_length=max_len)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+        pooling = json.loads((self.model_dir / "1_Pooling" / "config.json").read_text(encoding="utf-8"))
+        if not pooling.get("pooling_mode_mean_tokens"):
+            raise ValueError(f"Pooling non supportato: {pooling}")
+        self.dim = int(pooling["word_embedding_dimension"])
+        self.variant = None
+
+    def tokenize(self, texts):
+        encs = self.tokenizer.encode_batch(list(texts))
+        ids  = np.array([e.ids for e in encs], dtype=np.int64)
+        mask = np.array([e.attention_mask for e in encs], dtype=np.int64)
+        types = np.array([e.type_ids for e in encs], dtype=np.int64)
+        return ids, mask, types
+
+    def token_lengths(self, texts):
+        return [int(sum(e.attention_mask)) for e in self.tokenizer.encode_batch(list(texts))]
+
+    @abstractmethod
+    def _forward(self, ids, mask, types) -> np.ndarray:
+        """Token embeddings (B, T, H)."""
+
+    def encode(self, texts) -> np.ndarray:
+        if not texts:
+            return np.empty((0, self.dim), dtype=np.float32)
+        ids, mask, types = self.tokenize(texts)
+        tokens = np.asarray(self._forward(ids, mask, types), dtype=np.float32)
+        m = mask[..., None].astype(np.float32)
+        emb = (tokens * m).sum(axis=1) / np.clip(m.sum(axis=1), 1e-9, None)
+        emb /= np.clip(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12, None)
+        return emb
+
+
+class OnnxEmbedder(Embedder):
+    backend = "onnxruntime"
+
+    def __init__(self, model_dir: Path, max_len: int = 256, num_threads: int = None, variant: str = None):
+        super().__init__(model_dir, max_len)
+        import onnxruntime as ort
+
+        path = (self.model_dir / "onnx" / variant) if variant else pick_onnx_variant(self.model_dir)
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            opts.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(str(path), sess_options=opts,
+                                            providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.variant = path.name
+
+    def _forward(self, ids, mask, types):
+        feed = {"input_ids": ids, "attention_mask": mask, "token_type_ids": types}
+        feed = {k: v for k, v in feed.items() if k in self.input_names}
+        return self.session.run(None, feed)[0]
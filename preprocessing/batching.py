@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Helper per l'embedding a batch:
+- ordina i chunk per lunghezza in token
+- li raggruppa in batch di dimensione configurabile
+  (opzionalmente con un tetto di token per batch: batch_size * lunghezza max)
+
+Così il padding avviene solo dentro batch di testi con lunghezza simile
+e ogni forward pass lavora su tensori "pieni".
+"""
+
+from typing import Iterator, List, Optional, Sequence
+
+
+def length_sorted_batches(
+    lengths: Sequence[int],
+    batch_size: int,
+    max_batch_tokens: Optional[int] = None,
+) -> Iterator[List[int]]:
+    """Restituisce liste di indici (riferiti a `lengths`) ordinate per lunghezza."""
+    if batch_size < 1:
+        raise ValueError(f"batch_size non valido: {batch_size}")
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batch: List[int] = []
+    for i in order:
+        if batch:
+            # gli indici sono ordinati: il nuovo elemento è il più lungo del batch
+            padded = (len(batch) + 1) * max(lengths[i], 1)
+            if len(batch) >= batch_size or (max_batch_tokens and padded > max_batch_tokens):
+                yield batch
+                batch = []
+        batch.append(i)
+    if batch:
+        yield batch
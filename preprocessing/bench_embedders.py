@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark dei backend di embedding sul corpus reale (data_chunks):
+- MiniLM (embedders.py): torch fp32, ogni variante ONNX e OpenVINO scaricata
+- script torch del repo (INCLUDE_MODULES: e5-large, jina v4)
+- per ogni combinazione backend/variante x BATCH_SIZES x THREADS, in un processo
+  separato (RSS e tempo di caricamento non si sommano tra le prove):
+  frasi/sec, latenza per batch p50/p95, RSS di picco, tempo di caricamento del modello
+- accordo col riferimento: coseno medio/minimo rispetto a MiniLM torch fp32
+
+Le varianti non scaricate (puntatori git-lfs) o con runtime non installato
+compaiono nel report come [skip] / errore.
+
+Esegui:
+    python preprocessing/bench_embedders.py
+"""
+
+from pathlib import Path
+import importlib, json, multiprocessing as mp, os, sys, tempfile, time
+import numpy as np
+
+import embedders
+
+# ====== CONFIG ======
+CHUNKS_DIR      = Path("data_chunks")
+MAX_TEXTS       = 512          # chunk del corpus usati (None = tutti)
+BATCH_SIZES     = (1, 8, 32)
+THREADS         = tuple(sorted({1, 4, os.cpu_count() or 1}))
+INCLUDE_MODULES = ("embed_chunks_2", "embed_chunks_v4")   # modelli grandi: solo MODULE_BATCH/THREADS
+MODULE_BATCH    = (8,)
+MODULE_THREADS  = (os.cpu_count() or 1,)
+RUN_TIMEOUT     = 1800         # sec per singola prova
+REPORT          = Path("bench_results") / "embedders.json"
+# ====================
+
+
+def peak_rss_mb():
+    """RSS di picco del processo corrente in MB (None se non misurabile)."""
+    try:
+        import resource
+        r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return r / 1024 ** 2 if sys.platform == "darwin" else r / 1024   # macOS: byte, Linux: KB
+    except ImportError:
+        try:
+            import psutil   # Windows
+            return psutil.Process().memory_info().peak_wset / 1024 ** 2
+        except Exception:
+            return None
+
+
+def load_corpus(root: Path = None, limit: int = None):
+    root = root or CHUNKS_DIR
+    limit = MAX_TEXTS if limit is None else limit
+    texts = []
+    for f in sorted(Path(root).rglob("*.txt")):
+        t = f.read_text(encoding="utf-8", errors="ignore").strip()
+        if t:
+            texts.append(t)
+        if limit and len(texts) >= limit:
+            break
+    return texts
+
+
+def minilm_variants(model_dir: Path = embedders.MODEL_DIR):
+    """(backend, variante) da provare; le varianti non utilizzabili sono riportate a parte."""
+    runs, skipped = [("torch", None)], []
+    for sub, backend, pattern in (("onnx", "onnxruntime", "*.onnx"), ("openvino", "openvino", "*.xml")):
+        for p in sorted((Path(model_dir) / sub).glob(pattern)):
+            weights = p if backend == "onnxruntime" else p.with_suffix(".bin")
+            if embedders._is_model_file(weights):
+                runs.append((backend, p.name))
+            else:
+                skipped.append((backend, p.name))
+    return runs, skipped
+
+
+def _run(spec: dict, texts, out_path: str, q):
+    """Processo figlio: carica il modello, embedda il corpus, misura e salva i vettori."""
+    try:
+        base_rss = peak_rss_mb()
+        t0 = time.perf_counter()
+        if spec["module"] == "embedders":
+            emb = embedders.load_embedder(spec["backend"], variant=spec["variant"],
+                                          num_threads=spec["threads"])
+            encode, variant = emb.encode, emb.variant
+        else:
+            import torch
+            torch.set_num_threads(spec["threads"])
+            mod = importlib.import_module(spec["module"])
+            model, tok = mod.load_model()
+            encode, variant = (lambda batch: mod.embed_texts(model, tok, batch)), mod.MODEL_ID
+        load_sec = time.perf_counter() - t0
+
+        bs = spec["batch_size"]
+        encode(texts[:bs])   # warm-up (allocazioni, ottimizzazione del grafo)
+        lat, vecs = [], []
+        t0 = time.perf_counter()
+        for s in range(0, len(texts), bs):
+            t = time.perf_counter()
+            vecs.append(np.asarray(encode(texts[s:s + bs]), dtype=np.float32))
+            lat.append(time.perf_counter() - t)
+        total = time.perf_counter() - t0
+        np.save(out_path, np.concatenate(vecs))
+        q.put({
+            "variant": variant,
+            "load_sec": round(load_sec, 3),
+            "sentences_per_sec": round(len(texts) / total, 2),
+            "batch_ms": {"p50": round(float(np.percentile(lat, 50)) * 1000, 2),
+                         "p95": round(float(np.percentile(lat, 95)) * 1000, 2)},
+            "rss_base_mb": round(base_rss, 1) if base_rss else None,
+            "rss_peak_mb": round(peak_rss_mb() or 0, 1) or None,
+        })
+    except Exception as e:
+        q.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def run_isolated(spec: dict, texts, out_path: Path) -> dict:
+    ctx = mp.get_context("spawn")
+    q = ctx.Queue()
+    p = ctx.Process(target=_run, args=(spec, texts, str(out_path), q))
+    p.start()
+    p.join(RUN_TIMEOUT)
+    if p.is_alive():
+        p.terminate()
+        p.join()
+        return {"error": f"timeout dopo {RUN_TIMEOUT}s"}
+    try:
+        return q.get(timeout=5)
+    except Exception:
+        return {"error": f"processo terminato (exit code {p.exitcode})"}
+
+
+def agreement(vecs: np.ndarray, ref: np.ndarray):
+    """Coseno medio e minimo riga per riga tra due matrici L2-normalizzate."""
+    if ref is None or vecs.shape != ref.shape:
+        return None
+    cos = np.sum(vecs * ref, axis=1)
+    return {"mean": round(float(cos.mean()), 5), "min": round(float(cos.min()), 5)}
+
+
+def main():
+    texts = load_corpus()
+    if not texts:
+        raise SystemExit(f"Nessun chunk in {CHUNKS_DIR}. Esegui prima: python chunk_texts.py")
+    runs, skipped = minilm_variants()
+    for backend, variant in skipped:
+        print(f"[skip] {backend}/{variant}: modello non scaricato (puntatore git-lfs)")
+    print(f"✅ Corpus: {len(texts)} chunk | CPU: {os.cpu_count()} core | prove MiniLM: {len(runs)} varianti")
+
+    specs = [{"module": "embedders", "backend": b, "variant": v, "batch_size": bs, "threads": th}
+             for b, v in runs for bs in BATCH_SIZES for th in THREADS]
+    specs += [{"module": m, "backend": "torch", "variant": None, "batch_size": bs, "threads": th}
+              for m in INCLUDE_MODULES for bs in MODULE_BATCH for th in MODULE_THREADS]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        # riferimento: MiniLM torch fp32, stesso corpus
+        ref_path = Path(tmp) / "ref.npy"
+        ref_res = run_isolated({"module": "embedders", "backend": "torch", "variant": None,
+                                "batch_size": 32, "threads": os.cpu_count()}, texts, ref_path)
+        ref = np.load(ref_path) if ref_path.exists() else None
+        if ref is None:
+            print(f"[warn] Riferimento torch fp32 non disponibile: {ref_res.get('error')}")
+
+        for n, spec in enumerate(specs):
+            out = Path(tmp) / f"run{n}.npy"
+            res = run_isolated(spec, texts, out)
+            if "error" not in res and spec["module"] == "embedders":
+                res["agreement"] = agreement(np.load(out), ref)
+            row = {**spec, **res}
+            results.append(row)
+            label = f"{spec['module']}/{spec['backend']}/{res.get('variant') or spec['variant'] or '-'}"
+            if "error" in res:
+                print(f"[warn] {label} bs={spec['batch_size']} th={spec['threads']}: {res['error']}")
+            else:
+                print(f"[ok] {label} bs={spec['batch_size']} th={spec['threads']}:"
+                      f" {res['sentences_per_sec']} frasi/s")
+
+    ok = [r for r in results if "error" not in r]
+    print(f"\n{'modello/variante':<44} {'bs':>3} {'th':>3} {'frasi/s':>9} {'p50 ms':>8} {'p95 ms':>8}"
+          f" {'RSS MB':>8} {'load s':>7} {'cos':>8}")
+    for r in sorted(ok, key=lambda r: -r["sentences_per_sec"]):
+        name = r["variant"] if r["module"] == "embedders" else r["module"]
+        cos = (r.get("agreement") or {}).get("mean")
+        print(f"{(r['backend'] + '/' + name)[:44]:<44} {r['batch_size']:>3} {r['threads']:>3}"
+              f" {r['sentences_per_sec']:>9.1f} {r['batch_ms']['p50']:>8.1f} {r['batch_ms']['p95']:>8.1f}"
+              f" {r['rss_peak_mb'] or float('nan'):>8.0f} {r['load_sec']:>7.2f}"
+              f" {cos if cos is not None else float('nan'):>8.4f}")
+
+    REPORT.parent.mkdir(parents=True, exist_ok=True)
+    REPORT.write_text(json.dumps({
+        "n_texts": len(texts),
+        "cpu_count": os.cpu_count(),
+        "cpu_flags": sorted(embedders.cpu_flags() & {"avx2", "avx512f", "avx512bw", "avx512_vnni", "avx512vnni"}),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "skipped": [f"{b}/{v}" for b, v in skipped],
+        "reference": ref_res,
+        "results": results,
+    }, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"\nFATTO ✓  Report: {REPORT}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark del retrieval (latenza + qualità) su un set di query versionato:
+- carica i vettori di data_embeddings_v4 (manifest_embeddings.jsonl) in Qdrant,
+  una collection per configurazione di CONFIGS (profilo di create_collection.py
+  + dimensione Matryoshka opzionale)
+- query: bench/queries_v1.jsonl, con le sorgenti rilevanti ("relevant" = source_name);
+  gli embedding delle query vengono calcolati una volta (EMBED_MODULE) e messi in cache
+- per ogni configurazione: latenza p50/p95/p99, QPS con CONCURRENCY thread,
+  recall@k (sorgenti rilevanti trovate nei primi k) e MRR
+
+QDRANT_URL=":memory:" usa la modalità locale di qdrant_client (ricerca esatta:
+HNSW e quantizzazione non hanno effetto, utile per recall e confronto dimensioni);
+con un server (es. "http://localhost:6333") si misurano davvero i profili.
+
+Esegui:
+    python preprocessing/bench_retrieval.py
+"""
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import hashlib, importlib, json, time
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import PointStruct
+
+from compress_embeddings import normalize, truncate
+from create_collection import PROFILE, apply_profile, search_params
+from embedding_store import iter_manifest_vectors
+from upload_to_qdrant import DEFAULT_DOMAIN, point_id
+
+# ====== CONFIG ======
+EMB_DIR      = Path("data_embeddings_v4")
+MANIFEST     = EMB_DIR / "manifest_embeddings.jsonl"
+QUERIES      = Path("preprocessing") / "bench" / "queries_v1.jsonl"
+EMBED_MODULE = "embed_chunks_v4"
+QUERY_PREFIX = "Query"   # prefisso query di jina v4 (None per modelli senza prefisso)
+QDRANT_URL   = ":memory:"
+RECALL_K     = (1, 5, 10)
+REPEAT       = 5         # ripetizioni per query nella misura di latenza
+WARMUP       = 1
+CONCURRENCY  = 8
+QPS_ROUNDS   = 20        # passate sull'intero set di query nel test di throughput
+KEEP_COLLECTIONS = False
+REPORT       = EMB_DIR / f"bench_retrieval_{QUERIES.stem}.json"
+
+CONFIGS = [
+    {"name": "exact",         "exact": True},
+    {"name": "hnsw",          "profile": {"quantization": None}},
+    {"name": "hnsw_int8",     "profile": {}},   # PROFILE di create_collection.py
+    {"name": "hnsw_binary",   "profile": {"quantization": {"type": "binary", "always_ram": True}}},
+    {"name": "dim1024_int8",  "dim": 1024},
+    {"name": "dim512_int8",   "dim": 512},
+    {"name": "dim256_int8",   "dim": 256},
+]
+# ====================
+
+
+def load_queries(path: Path):
+    with path.open("r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def query_vectors(queries) -> np.ndarray:
+    """Embedding delle query (cache su disco per set di query + modello)."""
+    texts = [q["query"] for q in queries]
+    h = hashlib.sha1(("\n".join(texts) + f"\x1f{EMBED_MODULE}\x1f{QUERY_PREFIX}").encode("utf-8")).hexdigest()[:10]
+    path = EMB_DIR / f"bench_{QUERIES.stem}_{h}.npy"
+    if path.exists():
+        return np.load(path)
+    emb = importlib.import_module(EMBED_MODULE)
+    print(f"🔹 Embedding di {len(texts)} query con {emb.MODEL_ID} …")
+    model, tok = emb.load_model()
+    kwargs = {"prefix": QUERY_PREFIX} if QUERY_PREFIX else {}
+    vecs = np.concatenate([emb.embed_texts(model, tok, texts[s:s + emb.BATCH_SIZE], **kwargs)
+                           for s in range(0, len(texts), emb.BATCH_SIZE)])
+    np.save(path, vecs)
+    return vecs
+
+
+def percentile_ms(samples, p: float) -> float:
+    return float(np.percentile(np.asarray(samples) * 1000.0, p)) if samples else float("nan")
+
+
+def load_collection(client, name: str, rows, vecs, dim: int, profile):
+    apply_profile(client, name, dim, profile, recreate=True)
+    points = [
+        PointStruct(
+            id=point_id(rec),
+            vector=v.tolist(),
+            payload={"source_name": rec.get("source_name"), "source_dir": rec.get("source_dir"),
+                     "chunk_index": rec.get("chunk_index"), "domain": DEFAULT_DOMAIN},
+        )
+        for rec, v in zip(rows, vecs)
+    ]
+    for s in range(0, len(points), 256):
+        client.upsert(collection_name=name, points=points[s:s + 256], wait=True)
+
+
+def score_query(sources, relevant, ks=RECALL_K):
+    """recall@k sulle sorgenti distinte e reciprocal rank del primo chunk rilevante."""
+    rel = set(relevant)
+    rr = next((1.0 / r for r, s in enumerate(sources, start=1) if s in rel), 0.0)
+    recall = {k: len(rel & set(sources[:k])) / len(rel) for k in ks} if rel else {k: 0.0 for k in ks}
+    return recall, rr
+
+
+def run_config(client, cfg, rows, full, queries, qvecs):
+    dim = cfg.get("dim") or full.shape[1]
+    profile = {**PROFILE, **cfg.get("profile", {})}
+    name = f"bench_{cfg['name']}"
+    docs = truncate(full, dim) if dim != full.shape[1] else full
+    qs = truncate(qvecs, dim) if dim != full.shape[1] else qvecs
+
+    t0 = time.perf_counter()
+    load_collection(client, name, rows, docs, dim, profile)
+    load_sec = time.perf_counter() - t0
+
+    params = search_params(profile)
+    if cfg.get("exact"):
+        params.exact = True
+    kmax = max(RECALL_K)
+
+    def search(v):
+        res = client.query_points(collection_name=name, query=v.tolist(), limit=kmax,
+                                  search_params=params, with_payload=["source_name"])
+        return [(p.payload or {}).get("source_name") for p in res.points]
+
+    # qualità + latenza sequenziale
+    lat, recalls, rrs = [], {k: [] for k in RECALL_K}, []
+    for q, v in zip(queries, qs):
+        for _ in range(WARMUP):
+            search(v)
+        for _ in range(REPEAT):
+            t = time.perf_counter()
+            sources = search(v)
+            lat.append(time.perf_counter() - t)
+        recall, rr = score_query(sources, q.get("relevant") or [])
+        for k in RECALL_K:
+            recalls[k].append(recall[k])
+        rrs.append(rr)
+
+    # throughput con richieste concorrenti
+    work = [v for _ in range(QPS_ROUNDS) for v in qs]
+    t = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+        list(pool.map(search, work))
+    qps = len(work) / (time.perf_counter() - t)
+
+    if not KEEP_COLLECTIONS:
+        client.delete_collection(name)
+    return {
+        "name": cfg["name"],
+        "dim": int(dim),
+        "exact": bool(cfg.get("exact")),
+        "hnsw": profile.get("hnsw"),
+        "quantization": (profile.get("quantization") or {}).get("type"),
+        "load_sec": round(load_sec, 3),
+        "latency_ms": {f"p{p}": round(percentile_ms(lat, p), 3) for p in (50, 95, 99)},
+        "qps": round(qps, 1),
+        "recall": {f"@{k}": round(float(np.mean(recalls[k])), 4) for k in RECALL_K},
+        "mrr": round(float(np.mean(rrs)), 4),
+    }
+
+
+def main():
+    if not MANIFEST.exists():
+        raise SystemExit(f"Manifest non trovato: {MANIFEST}")
+    queries = load_queries(QUERIES)
+    rows, vecs = [], []
+    for rec, vec in iter_manifest_vectors(MANIFEST, EMB_DIR):
+        rows.append(rec)
+        vecs.append(np.asarray(vec, dtype=np.float32))
+    if not vecs:
+        raise SystemExit(f"Nessun vettore leggibile da {MANIFEST}")
+    full = normalize(np.stack(vecs))
+    qvecs = normalize(query_vectors(queries))
+    print(f"✅ Chunk: {len(full)} x {full.shape[1]} | query: {len(queries)} ({QUERIES.name}) | Qdrant: {QDRANT_URL}")
+
+    client = QdrantClient(location=QDRANT_URL) if QDRANT_URL == ":memory:" else QdrantClient(url=QDRANT_URL)
+    results = []
+    for cfg in CONFIGS:
+        if (cfg.get("dim") or 0) > full.shape[1]:
+            print(f"[skip] {cfg['name']}: dim {cfg['dim']} > {full.shape[1]}")
+            continue
+        r = run_config(client, cfg, rows, full, queries, qvecs)
+        results.append(r)
+        print(f"[ok] {r['name']}")
+
+    print(f"\n{'config':<14} {'dim':>5} {'p50':>7} {'p95':>7} {'p99':>7} {'QPS':>8}  "
+          + "  ".join(f"R@{k:<3}" for k in RECALL_K) + "   MRR")
+    for r in results:
+        lat = r["latency_ms"]
+        print(f"{r['name']:<14} {r['dim']:>5} {lat['p50']:>7.2f} {lat['p95']:>7.2f} {lat['p99']:>7.2f}"
+              f" {r['qps']:>8.1f}  " + "  ".join(f"{r['recall'][f'@{k}']:.3f}" for k in RECALL_K)
+              + f"  {r['mrr']:.3f}")
+
+    report = {
+        "queries": str(QUERIES),
+        "n_queries": len(queries),
+        "n_chunks": len(full),
+        "embed_module": EMBED_MODULE,
+        "qdrant": QDRANT_URL,
+        "repeat": REPEAT,
+        "concurrency": CONCURRENCY,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "results": results,
+    }
+    REPORT.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"\nFATTO ✓  Report: {REPORT}")
+
+
+if __name__ == "__main__":
+    main()
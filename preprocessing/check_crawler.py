@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Verifica del crawler (preprocessing.py) contro un server HTTP locale, senza rete:
+- pagina utf-8 senza charset nell'header → testo estratto senza mojibake ("è già")
+- pagina con charset=iso-8859-1 dichiarato → decodificata con quel charset
+- seconda passata con la cache: richiesta condizionale (ETag) → 304 → "unchanged"
+
+Esegui:
+    python preprocessing/check_crawler.py
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os, sys, tempfile, threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import preprocessing as crawler
+
+# ====== CONFIG ======
+TEXT = "Visura catastale è già qui: però l'ipoteca è iscritta."
+PAGES = {
+    # path: (Content-Type, corpo in byte)
+    "/utf8-senza-charset": ("text/html", f"<html><body><p>{TEXT}</p></body></html>".encode("utf-8")),
+    "/latin1-dichiarato": ("text/html; charset=iso-8859-1",
+                           f"<html><body><p>{TEXT}</p></body></html>".encode("latin-1")),
+}
+# ====================
+
+requests_seen = []
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        ctype, body = PAGES.get(self.path, (None, None))
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = f'"{hash(body) & 0xffffffff:x}"'
+        requests_seen.append((self.path, self.headers.get("If-None-Match")))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    urls = [base + p for p in PAGES]
+    failures = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            out, cache = os.path.join(tmp, "out"), os.path.join(tmp, "cache")
+            kw = dict(output_dir=out, cache_dir=cache, host_interval=0, extract_procs=1)
+
+            for url, status, info in crawler.crawl(urls, **kw):
+                if status != "ok":
+                    failures.append(f"{url}: {status} {info}")
+                    continue
+                with open(info, "r", encoding="utf-8") as f:
+                    text = f.read()
+                if "è già" not in text or "Ã" in text:
+                    failures.append(f"{url}: testo decodificato male → {text[:80]!r}")
+                else:
+                    print(f"[ok] {url}: codifica corretta")
+
+            for url, status, info in crawler.crawl(urls, **kw):
+                if status != "unchanged":
+                    failures.append(f"{url}: seconda passata {status}, attesa 'unchanged'")
+                else:
+                    print(f"[ok] {url}: 304 dalla cache")
+            if not all(etag for _, etag in requests_seen[len(urls):]):
+                failures.append("seconda passata senza If-None-Match")
+    finally:
+        server.shutdown()
+
+    for f in failures:
+        print(f"[warn] {f}")
+    if failures:
+        raise SystemExit(1)
+    print("\nFATTO ✓  Crawler verificato sul server locale")
+
+
+if __name__ == "__main__":
+    main()
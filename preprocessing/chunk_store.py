@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Store locale dei testi dei chunk (SQLite) per i punti "payload-lite":
+- in Qdrant restano solo chunk_id e i campi filtrabili (vedi upload_to_qdrant.py, PAYLOAD_MODE)
+- qui: chunk_id -> testo + metadati completi (path, modello, sources, ...)
+- ogni sorgente (source_dir + source_name) viene riscritta per intero: alla prima scrittura
+  di una sorgente in questa sessione le sue righe precedenti si cancellano, nella stessa
+  transazione dei nuovi chunk (niente chunk ri-chunkati o rimossi che restano nello store);
+  a fine ingest completo prune() toglie le sorgenti che non esistono più
+
+Il plugin ai_rag_retriever legge lo stesso file (data/ è montata in
+/app/cat/data) con un'unica query per i soli top-k finali.
+"""
+
+from pathlib import Path
+import json, sqlite3
+
+DEFAULT_PATH = Path("data") / "chunk_store.sqlite"
+
+
+class ChunkStore:
+    def __init__(self, path=DEFAULT_PATH, flush_every: int = 500):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.flush_every = flush_every
+        self._buf = []
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " chunk_id TEXT PRIMARY KEY, text TEXT NOT NULL, meta TEXT NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS chunks_source ON chunks("
+            " json_extract(meta, '$.source_dir'), json_extract(meta, '$.source_name'))"
+        )
+        self.db.commit()
+        self._written = set()   # sorgenti già ripulite e riscritte in questa sessione
+
+    def add(self, chunk_id: str, text: str, meta: dict):
+        """Accoda un chunk; scrittura a blocchi di `flush_every` (una transazione ciascuno)."""
+        source = (meta.get("source_dir"), meta.get("source_name"))
+        self._buf.append((source, (chunk_id, text, json.dumps(meta, ensure_ascii=False))))
+        if len(self._buf) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            with self.db:   # una transazione: righe vecchie della sorgente via, nuove dentro
+                for source in dict.fromkeys(src for src, _ in self._buf):
+                    if source not in self._written and source != (None, None):
+                        self.db.execute(
+                            "DELETE FROM chunks WHERE json_extract(meta, '$.source_dir') IS ?"
+                            " AND json_extract(meta, '$.source_name') IS ?", source)
+                        self._written.add(source)
+                self.db.executemany("INSERT OR REPLACE INTO chunks(chunk_id, text, meta) VALUES (?,?,?)",
+                                    [row for _, row in self._buf])
+            self._buf = []
+
+    def prune(self) -> int:
+        """Cancella le sorgenti non riscritte in questa sessione (solo dopo un ingest completo)."""
+        self.flush()
+        stale = [src for src in self.db.execute(
+            "SELECT DISTINCT json_extract(meta, '$.source_dir'), json_extract(meta, '$.source_name') FROM chunks")
+            if tuple(src) not in self._written]
+        with self.db:
+            for source in stale:
+                self.db.execute("DELETE FROM chunks WHERE json_extract(meta, '$.source_dir') IS ?"
+                                " AND json_extract(meta, '$.source_name') IS ?", source)
+        return len(stale)
+
+    def get_many(self, chunk_ids) -> dict:
+        """chunk_id -> {"text", "metadata"} per gli id presenti."""
+        self.flush()
+        found = {}
+        uniq = list(dict.fromkeys(chunk_ids))
+        for s in range(0, len(uniq), 500):   # limite parametri SQLite
+            part = uniq[s:s + 500]
+            marks = ",".join("?" * len(part))
+            for cid, text, meta in self.db.execute(
+                f"SELECT chunk_id, text, meta FROM chunks WHERE chunk_id IN ({marks})", part
+            ):
+                found[cid] = {"text": text, "metadata": json.loads(meta)}
+        return found
+
+    def __len__(self):
+        self.flush()
+        return self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -2,7 +2,11 @@
 """
 Chunker semplice:
 - Scansiona cartelle di input per trovare .txt
-- Divide ogni file in chunk (size, overlap configurabili)
+- Divide ogni file in chunk (size, overlap configurabili):
+    CHUNK_MODE="chars"  → finestra fissa di caratteri
+    CHUNK_MODE="tokens" → frasi/paragrafi interi impacchettati fino a TARGET_TOKENS
+                          (tokenizer del modello di embedding), overlap in token,
+                          file letti in streaming in un solo passaggio
 - Salva i chunk come .txt in data_chunks/<sottocartella_input>/
 - Scrive anche un manifest.jsonl con metadata utili
 
@@ -11,7 +15,7 @@ Esegui:
 """
 
 from pathlib import Path
-import json
+import json, re
 
 # ====== CONFIG ======
 INPUT_DIRS = [
@@ -23,8 +27,17 @@ INPUT_DIRS = [
 OUTPUT_DIR = Path("data_chunks")
 CHUNK_SIZE = 900        # ~150–200 token
 CHUNK_OVERLAP = 150     # continuità tra spezzoni
+
+CHUNK_MODE = "chars"    # "chars" | "tokens"
+TOKENIZER_ID = "jinaai/jina-embeddings-v4"   # stesso modello di embed_chunks_v4.py
+TARGET_TOKENS = 480     # < MAX_LEN=512 degli embedder: margine per token speciali
+OVERLAP_TOKENS = 48     # continuità tra spezzoni (frasi intere)
 # ====================
 
+# fine frase: punteggiatura forte seguita da spazio e da maiuscola/cifra/virgolette
+_SENT_END = re.compile(r"(?<=[.!?…;])\s+(?=[A-ZÀ-ÖØ-Ý0-9\"«(\[])")
+_tokenizer = None
+
 
 def chunk_text(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP):
     """Divide il testo in blocchi con sovrapposizione."""
@@ -43,9 +56,118 @@ def chunk_text(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP):
     return chunks
 
 
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        from transformers import AutoTokenizer
+        _tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_ID, trust_remote_code=True)
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    return len(get_tokenizer()(text, add_special_tokens=False)["input_ids"])
+
+
+def iter_paragraphs(lines):
+    """Paragrafi (separati da righe vuote) da un iterabile di righe, senza leggerlo tutto."""
+    buf = []
+    for line in lines:
+        line = line.strip()
+        if line:
+            buf.append(line)
+        elif buf:
+            yield " ".join(buf)
+            buf = []
+    if buf:
+        yield " ".join(buf)
+
+
+def split_long(text: str, max_tokens: int):
+    """Spezza sui confini di token un'unità più lunga del budget."""
+    enc = get_tokenizer()(text, add_special_tokens=False, return_offsets_mapping=True)
+    offsets = enc["offset_mapping"]
+    for s in range(0, len(offsets), max_tokens):
+        part = offsets[s:s + max_tokens]
+        piece = text[part[0][0]:part[-1][1]].strip()
+        if piece:
+            yield piece, len(part)
+
+
+def iter_units(lines, max_tokens: int):
+    """(testo, n_token, inizio_paragrafo) per ogni frase, mai oltre max_tokens."""
+    for para in iter_paragraphs(lines):
+        first = True
+        for sent in _SENT_END.split(para):
+            n = count_tokens(sent)
+            pieces = [(sent, n)] if n <= max_tokens else split_long(sent, max_tokens)
+            for piece, n in pieces:
+                yield piece, n, first
+                first = False
+
+
+def chunk_tokens(lines, target: int = TARGET_TOKENS, overlap: int = OVERLAP_TOKENS):
+    """
+    Impacchetta frasi intere fino a `target` token; il chunk successivo riparte
+    dalle ultime frasi del precedente che stanno in `overlap` token.
+    """
+    cur, cur_tokens, fresh = [], 0, 0   # fresh = unità nuove (non di overlap) nel chunk
+
+    def render(units):
+        out = ""
+        for text, _, para_start in units:
+            out += (("\n\n" if para_start else " ") if out else "") + text
+        return out
+
+    for unit in iter_units(lines, target):
+        if cur and cur_tokens + unit[1] > target:
+            yield render(cur)
+            keep, kept = [], 0
+            for u in reversed(cur):
+                if kept + u[1] > overlap or len(keep) + 1 >= len(cur):
+                    break
+                keep.insert(0, u)
+                kept += u[1]
+            # l'overlap non deve impedire all'unità nuova di entrare nel budget
+            while keep and kept + unit[1] > target:
+                kept -= keep.pop(0)[1]
+            cur, cur_tokens, fresh = keep, kept, 0
+        cur.append(unit)
+        cur_tokens += unit[1]
+        fresh += 1
+    if cur and fresh:
+        yield render(cur)
+
+
+def chunk_document(text: str):
+    """Chunk di un intero documento (un solo chunk se il testo è corto)."""
+    if CHUNK_MODE == "tokens":
+        return list(chunk_tokens(text.splitlines()))
+    if len(text) > CHUNK_SIZE:
+        return chunk_text(text)
+    return [text.strip()] if text.strip() else []
+
+
+def iter_file_chunks(f: Path):
+    """Chunk di un file; in modalità "tokens" il file viene letto riga per riga."""
+    if CHUNK_MODE == "tokens":
+        with f.open("r", encoding="utf-8", errors="ignore") as fh:
+            yield from chunk_tokens(fh)
+        return
+    try:
+        text = f.read_text(encoding="utf-8", errors="ignore")
+    except Exception:
+        text = f.read_text(errors="ignore")
+    yield from chunk_document(text)
+
+
 def main():
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
     manifest_path = OUTPUT_DIR / "manifest.jsonl"
+    dedup_path = OUTPUT_DIR / "manifest_dedup.jsonl"
+    if dedup_path.exists():
+        # la dedup va rifatta sui chunk nuovi: quella vecchia escluderebbe i chunk aggiunti
+        dedup_path.unlink()
+        print(f"[warn] Rimosso {dedup_path} (superato): riesegui python dedup_chunks.py")
     total_files = 0
     total_chunks = 0
 
@@ -62,27 +184,15 @@ def main():
 
             for f in d.rglob("*.txt"):
                 total_files += 1
-                try:
-                    text = f.read_text(encoding="utf-8", errors="ignore")
-                except Exception:
-                    text = f.read_text(errors="ignore")
-
-                parts = (
-                    chunk_text(text)
-                    if len(text) > CHUNK_SIZE
-                    else ([text.strip()] if text.strip() else [])
-                )
-                if not parts:
-                    print(f"[empty] {f}")
-                    continue
-
-                # salva i chunk come .txt numerati
+                # salva i chunk come .txt numerati (man mano che vengono prodotti)
                 stem = f.stem  # nome base senza .txt
-                for idx, ch in enumerate(parts, start=1):
+                n_parts = 0
+                for idx, ch in enumerate(iter_file_chunks(f), start=1):
                     chunk_name = f"{stem}__chunk{idx:03d}.txt"
                     out_fp = out_subdir / chunk_name
                     out_fp.write_text(ch, encoding="utf-8")
                     total_chunks += 1
+                    n_parts += 1
 
                     # riga nel manifest
                     row = {
@@ -93,9 +203,14 @@ def main():
                         "chunk_path": str(out_fp.resolve()),
                         "chunk_size_chars": len(ch),
                     }
+                    if CHUNK_MODE == "tokens":
+                        row["chunk_size_tokens"] = count_tokens(ch)
                     mf.write(json.dumps(row, ensure_ascii=False) + "\n")
 
-                print(f"[ok] {f} -> {len(parts)} chunk")
+                if not n_parts:
+                    print(f"[empty] {f}")
+                    continue
+                print(f"[ok] {f} -> {n_parts} chunk")
 
     print(f"\nFATTO ✓  File processati: {total_files}  |  Chunk salvati: {total_chunks}")
     print(f"Output: {OUTPUT_DIR}  (con manifest.jsonl)")
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Compressione degli embedding jina-v4 (2048-dim float32, 8 KB a vettore):
+- troncamento Matryoshka ai primi TARGET_DIM valori + nuova L2 normalizzazione
+- salvataggio come float32 / float16 / int8 scalare in uno store
+  (embedding_store.py) con il suo manifest_embeddings.jsonl ed EMBEDDING_DIM.txt,
+  pronto per upload_to_qdrant.py (EMB_DIR = OUT_DIR)
+- int8: scala simmetrica per vettore (max |x| → 127), salvata in scales.npy;
+  la similarità coseno non dipende dalla scala, quindi per Qdrant basta il vettore int8
+- report recall@k contro i vettori a piena precisione per ogni combinazione
+  EVAL_DIMS x EVAL_DTYPES, per scegliere la rappresentazione più piccola
+  che mantiene la qualità (query: QUERY_VECTORS .npy, altrimenti un campione
+  di chunk, escludendo il chunk stesso dai risultati)
+
+Esegui:
+    python preprocessing/compress_embeddings.py
+"""
+
+from pathlib import Path, PureWindowsPath
+import json
+import numpy as np
+
+from embedding_store import EmbeddingStore, iter_manifest_vectors
+
+# ====== CONFIG ======
+EMB_DIR      = Path("data_embeddings_v4")           # output di embed_chunks_v4.py
+MANIFEST     = EMB_DIR / "manifest_embeddings.jsonl"
+OUT_DIR      = Path("data_embeddings_v4_compressed")
+TARGET_DIM   = 1024       # 128 | 256 | 512 | 1024 (come create_collection.py)
+OUT_DTYPE    = "float16"  # "float32" | "float16" | "int8"
+EVAL_DIMS    = (128, 256, 512, 1024)
+EVAL_DTYPES  = ("float32", "float16", "int8")
+RECALL_K     = (1, 5, 10)
+MIN_RECALL   = 0.95       # soglia su recall@max(RECALL_K) per la raccomandazione
+QUERY_VECTORS= None       # es. Path("bench_queries_v4.npy"): (Q, 2048) query embeddate
+N_QUERIES    = 200        # query campionate dai chunk se QUERY_VECTORS è None
+SEED         = 42
+# ====================
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.clip(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12, None)
+
+
+def truncate(x: np.ndarray, dim: int) -> np.ndarray:
+    """Prefisso Matryoshka di `dim` valori, rinormalizzato."""
+    if dim > x.shape[-1]:
+        raise ValueError(f"Dim richiesta {dim} > dim originale {x.shape[-1]}")
+    return normalize(x[..., :dim])
+
+
+def quantize_int8(x: np.ndarray):
+    """(int8, scala per riga): x ≈ q * scala."""
+    scale = np.clip(np.abs(x).max(axis=-1, keepdims=True), 1e-12, None) / 127.0
+    q = np.clip(np.rint(x / scale), -127, 127).astype(np.int8)
+    return q, scale[..., 0].astype(np.float32)
+
+
+def compress(x: np.ndarray, dim: int, dtype: str):
+    """(vettori da salvare, scale int8 o None)."""
+    t = truncate(x, dim)
+    if dtype == "int8":
+        return quantize_int8(t)
+    return t.astype(dtype), None
+
+
+def decompress(q: np.ndarray, scales=None) -> np.ndarray:
+    x = q.astype(np.float32)
+    if scales is not None:
+        x *= scales[:, None]
+    return normalize(x)
+
+
+def top_k(queries: np.ndarray, docs: np.ndarray, k: int, exclude=None, block: int = 256):
+    """Indici dei k documenti più simili (prodotto scalare) per ogni query."""
+    out = np.empty((len(queries), k), dtype=np.int64)
+    for s in range(0, len(queries), block):
+        scores = queries[s:s + block] @ docs.T
+        if exclude is not None:
+            scores[np.arange(scores.shape[0]), exclude[s:s + block]] = -np.inf
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.take_along_axis(scores, part, axis=1).argsort(axis=1)[:, ::-1]
+        out[s:s + block] = np.take_along_axis(part, order, axis=1)
+    return out
+
+
+def recall_at_k(truth: np.ndarray, found: np.ndarray, k: int) -> float:
+    return float(np.mean([len(set(t[:k]) & set(f[:k])) / k for t, f in zip(truth, found)]))
+
+
+def evaluate(full: np.ndarray, queries: np.ndarray, exclude=None, dims=EVAL_DIMS,
+             dtypes=EVAL_DTYPES, ks=RECALL_K):
+    """Recall@k di ogni rappresentazione rispetto alla ricerca su `full` (float32, dim piena)."""
+    # con exclude la query stessa non conta tra i documenti trovabili
+    available = len(full) - (1 if exclude is not None else 0)
+    if available < 1:
+        return []
+    kmax = max(1, min(max(ks), available))
+    truth = top_k(queries, full, kmax, exclude)
+    results = []
+    for dim in dims:
+        if dim > full.shape[1]:
+            continue
+        q = truncate(queries, dim)   # le query restano float (embeddate al volo)
+        for dtype in dtypes:
+            vecs, scales = compress(full, dim, dtype)
+            found = top_k(q, decompress(vecs, scales), kmax, exclude)
+            results.append({
+                "dim": dim,
+                "dtype": dtype,
+                "bytes_per_vector": int(dim * np.dtype(dtype).itemsize),
+                "recall": {f"@{k}": round(recall_at_k(truth, found, k), 4) for k in ks if k <= kmax},
+            })
+    return results
+
+
+def load_vectors(manifest: Path, emb_dir: Path):
+    rows, vecs = [], []
+    for rec, vec in iter_manifest_vectors(manifest, emb_dir):
+        rows.append(rec)
+        vecs.append(np.asarray(vec, dtype=np.float32))
+    if not vecs:
+        raise SystemExit(f"Nessun vettore leggibile da {manifest}")
+    return rows, normalize(np.stack(vecs))
+
+
+def chunk_id(rec: dict) -> str:
+    if rec.get("chunk_id"):
+        return rec["chunk_id"]
+    stem = PureWindowsPath(rec.get("chunk_path") or rec.get("embedding_path") or "").stem
+    return f"{rec.get('source_dir') or ''}/{stem}"
+
+
+def report(full: np.ndarray):
+    """Tabella recall@k per dim/dtype e combinazione più piccola sopra MIN_RECALL."""
+    if QUERY_VECTORS:
+        queries, exclude = normalize(np.load(QUERY_VECTORS)), None
+    else:
+        rng = np.random.default_rng(SEED)
+        sample = rng.choice(len(full), size=min(N_QUERIES, len(full)), replace=False)
+        queries, exclude = full[sample], sample
+    results = evaluate(full, queries, exclude)
+
+    # con pochi vettori i k più grandi non sono calcolabili: si giudica sul più grande disponibile
+    kmax = max((int(k[1:]) for r in results for k in r["recall"]), default=max(RECALL_K))
+    print(f"\n{'dim':>5} {'dtype':>8} {'B/vett':>7}  " + "  ".join(f"R@{k:<4}" for k in RECALL_K))
+    for r in results:
+        print(f"{r['dim']:>5} {r['dtype']:>8} {r['bytes_per_vector']:>7}  "
+              + "  ".join(f"{r['recall'].get(f'@{k}', float('nan')):.3f}" for k in RECALL_K))
+    ok = [r for r in results if r["recall"].get(f"@{kmax}", 0.0) >= MIN_RECALL]
+    best = min(ok, key=lambda r: (r["bytes_per_vector"], -r["dim"])) if ok else None
+    if best:
+        print(f"\n👉 Più piccola con recall@{kmax} >= {MIN_RECALL}: {best['dim']} dim {best['dtype']}"
+              f" ({best['bytes_per_vector']} B/vettore)")
+    else:
+        print(f"\n[warn] Nessuna combinazione raggiunge recall@{kmax} >= {MIN_RECALL}")
+
+
+def main():
+    if not MANIFEST.exists():
+        raise SystemExit(f"Manifest non trovato: {MANIFEST}")
+    rows, full = load_vectors(MANIFEST, EMB_DIR)
+    print(f"✅ Vettori: {len(full)} x {full.shape[1]} ({full.nbytes / 1024 ** 2:.1f} MB float32)")
+
+    # --- valutazione ---
+    if len(full) < 2:
+        print("[skip] Report di recall: servono almeno 2 vettori")
+    else:
+        report(full)
+
+    # --- output compresso ---
+    vecs, scales = compress(full, TARGET_DIM, OUT_DTYPE)
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    store = EmbeddingStore(OUT_DIR / "store", dim=TARGET_DIM, dtype=OUT_DTYPE)
+    store.reset()
+    ids = [chunk_id(rec) for rec in rows]
+    store_rows = store.append(ids, vecs)
+    if scales is not None:
+        np.save(OUT_DIR / "store" / "scales.npy", scales)
+
+    with (OUT_DIR / "manifest_embeddings.jsonl").open("w", encoding="utf-8") as mf:
+        for rec, cid, row in zip(rows, ids, store_rows):
+            out = {k: v for k, v in rec.items() if k not in ("embedding_path", "store_path", "store_row")}
+            out.update({
+                "store_path": str((OUT_DIR / "store").resolve()),
+                "store_row": row,
+                "chunk_id": cid,
+                "embedding_dim": TARGET_DIM,
+                "compression": {"truncated_from": int(full.shape[1]), "dtype": OUT_DTYPE},
+            })
+            mf.write(json.dumps(out, ensure_ascii=False) + "\n")
+    (OUT_DIR / "EMBEDDING_DIM.txt").write_text(str(TARGET_DIM), encoding="utf-8")
+
+    report = {
+        "source_manifest": str(MANIFEST),
+        "vectors": len(full),
+        "source_dim": int(full.shape[1]),
+        "queries": len(queries),
+        "query_source": str(QUERY_VECTORS) if QUERY_VECTORS else "chunk_sample",
+        "output": {"dim": TARGET_DIM, "dtype": OUT_DTYPE, "bytes": int(vecs.nbytes)},
+        "recommended": best,
+        "results": results,
+    }
+    (OUT_DIR / "compression_report.json").write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+    print(f"\nFATTO ✓  {len(full)} vettori → {TARGET_DIM} dim {OUT_DTYPE}"
+          f" ({full.nbytes / 1024 ** 2:.1f} MB → {vecs.nbytes / 1024 ** 2:.2f} MB)")
+    print(f"Output: {OUT_DIR} (manifest_embeddings.jsonl, EMBEDDING_DIM.txt, store/, compression_report.json)")
+
+
+if __name__ == "__main__":
+    main()
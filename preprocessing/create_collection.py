@@ -1,12 +1,135 @@
 # create_collection_e5.py
+"""
+Provisioning della collection kb_legale_it a partire da un profilo dichiarativo (PROFILE):
+- HNSW (m, ef_construct), vettori e payload su disco, soglie degli optimizer
+- quantizzazione scalar (int8) o binary, con rescoring sui vettori originali in ricerca
+- indici keyword sui campi del payload usati nei filtri (domain, source_dir, source_name)
+
+Se la collection esiste le modifiche sono applicate in place (update_collection),
+senza cancellare i punti; si ricrea solo se cambia la dimensione dei vettori.
+upload_to_qdrant.py usa apply_profile() in ensure_collection().
+I parametri di ricerca (PROFILE["search"]) stanno in plugins/ai_rag_retriever/search_profile.json,
+letto anche da direct_search.py: bench e plugin cercano con gli stessi valori.
+
+Esegui:
+    python preprocessing/create_collection.py
+"""
+
+from pathlib import Path
+import json
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams
+from qdrant_client.http import models
+
+QDRANT_URL = "http://localhost:6333"
+COLLECTION = "kb_legale_it"
+DIM        = 1024   # e5-large (jina v4: 2048, o la dim di compress_embeddings.py)
+SEARCH_PROFILE = Path(__file__).resolve().parent.parent / "plugins" / "ai_rag_retriever" / "search_profile.json"
+
+PROFILE = {
+    "distance": "Cosine",
+    "on_disk_vectors": True,       # vettori originali su disco (memmap), in RAM solo i quantizzati
+    "on_disk_payload": True,
+    "hnsw": {"m": 16, "ef_construct": 200, "full_scan_threshold": 10000, "on_disk": False},
+    "quantization": {"type": "scalar", "quantile": 0.99, "always_ram": True},  # type: "scalar" | "binary" | None
+    "optimizers": {"indexing_threshold": 20000, "default_segment_number": 2},
+    "payload_indexes": {"domain": "keyword", "source_dir": "keyword", "source_name": "keyword"},
+    # parametri di ricerca (vedi search_params): rescoring con oversampling sui vettori originali
+    "search": json.loads(SEARCH_PROFILE.read_text(encoding="utf-8")),
+}
+
+
+def _hnsw(profile):
+    return models.HnswConfigDiff(**profile["hnsw"]) if profile.get("hnsw") else None
+
+
+def _optimizers(profile):
+    return models.OptimizersConfigDiff(**profile["optimizers"]) if profile.get("optimizers") else None
+
+
+def _quantization(profile, disable: bool = False):
+    """Config di quantizzazione; in update `disable=True` toglie quella esistente."""
+    q = profile.get("quantization") or {}
+    kind = q.get("type")
+    if kind == "scalar":
+        return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+            type=models.ScalarType.INT8, quantile=q.get("quantile"), always_ram=q.get("always_ram")))
+    if kind == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=q.get("always_ram")))
+    if kind:
+        raise ValueError(f"Quantizzazione sconosciuta: {kind} (ammesse: scalar, binary, None)")
+    return models.Disabled.DISABLED if disable else None
+
+
+def search_params(profile=PROFILE) -> models.SearchParams:
+    """SearchParams coerenti col profilo (hnsw_ef, rescore/oversampling se quantizzata)."""
+    s = profile.get("search") or {}
+    quant = None
+    if (profile.get("quantization") or {}).get("type"):
+        quant = models.QuantizationSearchParams(rescore=s.get("rescore", True),
+                                                oversampling=s.get("oversampling"))
+    return models.SearchParams(hnsw_ef=s.get("hnsw_ef"), quantization=quant)
+
+
+def _vector_size(info):
+    try:
+        return info.config.params.vectors.size
+    except AttributeError:
+        return None
+
+
+def apply_profile(client: QdrantClient, collection: str, dim: int, profile=PROFILE,
+                  recreate: bool = False) -> str:
+    """Crea la collection o ne aggiorna i parametri in place; restituisce "created" | "updated"."""
+    exists = client.collection_exists(collection)
+    if exists and not recreate:
+        have = _vector_size(client.get_collection(collection))
+        if have is not None and have != dim:
+            raise ValueError(f"Dim collection {have} != {dim}: la dimensione non si cambia in place"
+                             " (usa recreate=True)")
+
+    if not exists or recreate:
+        if exists:
+            client.delete_collection(collection)
+        client.create_collection(
+            collection_name=collection,
+            vectors_config=models.VectorParams(
+                size=dim, distance=models.Distance(profile["distance"]),
+                on_disk=profile.get("on_disk_vectors")),
+            hnsw_config=_hnsw(profile),
+            optimizers_config=_optimizers(profile),
+            quantization_config=_quantization(profile),
+            on_disk_payload=profile.get("on_disk_payload"),
+        )
+        action = "created"
+    else:
+        client.update_collection(
+            collection_name=collection,
+            # "" = vettore senza nome (quello usato dalla collection)
+            vectors_config={"": models.VectorParamsDiff(on_disk=profile.get("on_disk_vectors"))},
+            hnsw_config=_hnsw(profile),
+            optimizers_config=_optimizers(profile),
+            quantization_config=_quantization(profile, disable=True),
+            collection_params=models.CollectionParamsDiff(on_disk_payload=profile.get("on_disk_payload")),
+        )
+        action = "updated"
+
+    schema = client.get_collection(collection).payload_schema or {}
+    for field, kind in (profile.get("payload_indexes") or {}).items():
+        if field not in schema:
+            client.create_payload_index(collection, field_name=field,
+                                        field_schema=models.PayloadSchemaType(kind))
+    return action
+
 
-client = QdrantClient(url="http://localhost:6333")
+def main():
+    client = QdrantClient(url=QDRANT_URL)
+    action = apply_profile(client, COLLECTION, DIM)
+    q = (PROFILE.get("quantization") or {}).get("type") or "nessuna"
+    print(f"✅ Collection '{COLLECTION}' {'creata' if action == 'created' else 'aggiornata'}"
+          f" ({DIM}-dim, {PROFILE['distance'].upper()}, HNSW m={PROFILE['hnsw']['m']}"
+          f" ef_construct={PROFILE['hnsw']['ef_construct']}, quantizzazione {q},"
+          f" indici: {', '.join(PROFILE.get('payload_indexes') or {})})")
 
-client.recreate_collection(
-    collection_name="kb_legale_it",
-    vectors_config=VectorParams(size=1024, distance=Distance.COSINE),
-)
 
-print("✅ Collection 'kb_legale_it' creata (1024-dim, COSINE, e5-large)")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Deduplica near-duplicate dei chunk (tra chunk_texts.py e gli embedder):
+- shingle di parole (SHINGLE_WORDS) sul testo normalizzato, senza l'header
+  di metadati di trafilatura (blocco iniziale "--- ... ---")
+- firme MinHash (NUM_PERM permutazioni) + LSH a bande per trovare i candidati
+- coppie con Jaccard stimata >= THRESHOLD unite nello stesso cluster
+- per ogni cluster si tiene il chunk più lungo; il manifest registra
+  quali sorgenti/chunk rappresenta (campi "sources" e "duplicates")
+
+Scrive data_chunks/manifest_dedup.jsonl, che gli embedder usano (se presente e
+non più vecchio di manifest.jsonl) al posto di manifest.jsonl.
+StreamingDeduper fa lo stesso controllo un chunk alla volta per ingest_pipeline.py.
+
+Esegui:
+    python dedup_chunks.py
+"""
+
+from pathlib import Path, PureWindowsPath
+import json, re, zlib
+import numpy as np
+
+# ====== CONFIG ======
+CHUNKS_DIR    = Path("data_chunks")
+MANIFEST_IN   = CHUNKS_DIR / "manifest.jsonl"
+MANIFEST_OUT  = CHUNKS_DIR / "manifest_dedup.jsonl"
+SHINGLE_WORDS = 5
+NUM_PERM      = 128
+BANDS         = 16      # 16 bande x 8 righe: soglia LSH ~0.7
+THRESHOLD     = 0.8     # Jaccard stimata minima per considerare due chunk duplicati
+SEED          = 42
+# ====================
+
+_MERSENNE = (1 << 31) - 1
+_HEADER = re.compile(r"\A---\n.*?\n---\n", re.S)
+_WORD = re.compile(r"\w+", re.U)
+
+
+def resolve_chunk_path(rec: dict, chunks_dir: Path = CHUNKS_DIR) -> Path:
+    """Path del chunk; i manifest possono contenere path assoluti di un'altra macchina (Windows)."""
+    p = Path(rec.get("chunk_path") or "")
+    if p.is_file():
+        return p
+    name = PureWindowsPath(rec.get("chunk_path") or "").name
+    return chunks_dir / (rec.get("source_dir") or "") / name
+
+
+def select_manifest(chunks_dir: Path = CHUNKS_DIR):
+    """
+    (manifest da embeddare, deduplicato?). Un manifest_dedup.jsonl più vecchio di
+    manifest.jsonl (chunk rigenerati dopo la dedup) farebbe sparire i chunk nuovi: errore.
+    """
+    full, dedup = Path(chunks_dir) / MANIFEST_IN.name, Path(chunks_dir) / MANIFEST_OUT.name
+    if not dedup.exists():
+        return full, False
+    if full.exists() and dedup.stat().st_mtime < full.stat().st_mtime:
+        raise SystemExit(f"{dedup} è più vecchio di {full}: i chunk nuovi non sarebbero embeddati."
+                         f" Riesegui python dedup_chunks.py (o cancella {dedup.name}).")
+    return dedup, True
+
+
+def shingles(text: str, k: int = SHINGLE_WORDS) -> set:
+    text = _HEADER.sub("", text)
+    words = _WORD.findall(text.lower())
+    if len(words) < k:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = NUM_PERM, seed: int = SEED):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _MERSENNE, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _MERSENNE, size=num_perm, dtype=np.uint64)
+        self.num_perm = num_perm
+
+    def signature(self, shingle_set: set) -> np.ndarray:
+        if not shingle_set:
+            return np.full(self.num_perm, _MERSENNE, dtype=np.uint64)
+        h = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingle_set),
+                        dtype=np.uint64, count=len(shingle_set)) % _MERSENNE
+        # (a*h + b) mod p: a, h < 2^31 → il prodotto sta in uint64
+        return ((self.a[:, None] * h[None, :] + self.b[:, None]) % _MERSENNE).min(axis=1)
+
+
+class StreamingDeduper:
+    """
+    Dedup incrementale con le stesse firme/bande/soglia di find_clusters.
+    A differenza della versione batch tiene il primo chunk visto di ogni cluster
+    (i successivi potrebbero essere già stati caricati), non il più lungo.
+    """
+
+    def __init__(self, bands: int = BANDS, threshold: float = THRESHOLD, hasher: MinHasher = None):
+        self.hasher = hasher or MinHasher()
+        self.bands, self.threshold = bands, threshold
+        self.buckets, self.sigs, self.recs = {}, [], []
+
+    def check(self, rec: dict, text: str):
+        """None se il chunk è nuovo (e lo registra), altrimenti il record del chunk già tenuto."""
+        sig = self.hasher.signature(shingles(text))
+        rows = sig.shape[0] // self.bands
+        keys = [(b, sig[b * rows:(b + 1) * rows].tobytes()) for b in range(self.bands)]
+        checked = set()
+        for key in keys:
+            for j in self.buckets.get(key, ()):
+                if j not in checked:
+                    checked.add(j)
+                    if float(np.mean(self.sigs[j] == sig)) >= self.threshold:
+                        return self.recs[j]
+        self.sigs.append(sig)
+        self.recs.append(rec)
+        for key in keys:
+            self.buckets.setdefault(key, []).append(len(self.sigs) - 1)
+        return None
+
+
+def find_clusters(signatures, bands: int = BANDS, threshold: float = THRESHOLD):
+    """Union-find sulle coppie candidate LSH con similarità stimata >= threshold."""
+    n = len(signatures)
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    rows = signatures[0].shape[0] // bands if n else 0   # righe per banda
+    checked = set()
+    for band in range(bands):
+        buckets = {}
+        for i, sig in enumerate(signatures):
+            buckets.setdefault(sig[band * rows:(band + 1) * rows].tobytes(), []).append(i)
+        for members in buckets.values():
+            for x in range(len(members)):
+                for y in range(x + 1, len(members)):
+                    i, j = members[x], members[y]
+                    if (i, j) in checked:
+                        continue
+                    checked.add((i, j))
+                    sim = float(np.mean(signatures[i] == signatures[j]))
+                    if sim >= threshold:
+                        ri, rj = find(i), find(j)
+                        if ri != rj:
+                            parent[max(ri, rj)] = min(ri, rj)
+
+    clusters = {}
+    for i in range(n):
+        clusters.setdefault(find(i), []).append(i)
+    return list(clusters.values())
+
+
+def main():
+    if not MANIFEST_IN.exists():
+        raise SystemExit(f"Manifest non trovato: {MANIFEST_IN}. Esegui prima: python chunk_texts.py")
+
+    rows, texts = [], []
+    with MANIFEST_IN.open("r", encoding="utf-8") as mf:
+        for line in mf:
+            rec = json.loads(line)
+            p = resolve_chunk_path(rec)
+            if not p.is_file():
+                print(f"[skip] Chunk non trovato: {p}")
+                continue
+            rows.append(rec)
+            texts.append(p.read_text(encoding="utf-8", errors="ignore"))
+    if not rows:
+        raise SystemExit("Nessun chunk da deduplicare.")
+
+    hasher = MinHasher()
+    sigs = [hasher.signature(shingles(t)) for t in texts]
+    clusters = find_clusters(sigs)
+
+    kept = 0
+    with MANIFEST_OUT.open("w", encoding="utf-8") as out:
+        # ordine del manifest originale: il cluster compare alla posizione del suo primo chunk
+        for members in sorted(clusters, key=min):
+            keep = max(members, key=lambda i: (len(texts[i].strip()), -i))
+            row = dict(rows[keep])
+            dups = [i for i in members if i != keep]
+            row["sources"] = sorted({rows[i].get("source_name") for i in members if rows[i].get("source_name")})
+            row["duplicates"] = [
+                {
+                    "source_dir": rows[i].get("source_dir"),
+                    "source_name": rows[i].get("source_name"),
+                    "chunk_index": rows[i].get("chunk_index"),
+                    "similarity": round(float(np.mean(sigs[i] == sigs[keep])), 3),
+                }
+                for i in dups
+            ]
+            out.write(json.dumps(row, ensure_ascii=False) + "\n")
+            kept += 1
+
+    dropped = len(rows) - kept
+    print(f"\nFATTO ✓  Chunk: {len(rows)}  |  tenuti: {kept}  |  duplicati rimossi: {dropped}"
+          f" ({dropped / len(rows):.1%})")
+    print(f"Output: {MANIFEST_OUT}")
+
+
+if __name__ == "__main__":
+    main()
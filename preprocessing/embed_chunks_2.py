@@ -4,27 +4,78 @@ import json, numpy as np, torch
 from tqdm import tqdm
 from transformers import AutoModel, AutoTokenizer
 
+from batching import length_sorted_batches
+from embedding_store import EmbeddingStore, chunk_id_for
+from embedding_cache import EmbeddingCache, make_key
+from dedup_chunks import resolve_chunk_path, select_manifest
+
 CHUNKS_DIR = Path("data_chunks")
 EMB_DIR    = Path("data_embeddings_e5")
 MODEL_ID   = "intfloat/multilingual-e5-large"
 DEVICE     = "cpu"      # "cuda" se hai GPU
 MAX_LEN    = 512        # va bene per chunk ~900 caratteri
+VECTOR_TYPE = "mean_pooling"
+BATCH_SIZE = 16         # chunk per forward pass (1 = un chunk alla volta)
+MAX_BATCH_TOKENS = 8192 # tetto token per batch (batch_size * lunghezza max), None = nessuno
+OUTPUT_FORMAT = "npy"  # "npy" (un .npy per chunk) | "store" (matrice unica memory-mapped)
+STORE_DIR   = EMB_DIR / "store"
+STORE_DTYPE = "float32"  # "float32" | "float16" (solo OUTPUT_FORMAT="store")
+USE_CACHE   = True     # riusa gli embedding di chunk già visti (stesso modello/testo)
+CACHE_PATH  = EMB_DIR / "embedding_cache.sqlite"
+CACHE_MAX_BYTES = 2 * 1024 ** 3  # oltre questa soglia eviction LRU
 
 def iter_chunk_files(root: Path):
     for f in root.rglob("*.txt"):
         yield f
 
-def main():
+def load_model():
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+    model = AutoModel.from_pretrained(MODEL_ID).to(DEVICE).eval()
+    return model, tokenizer
+
+def token_lengths(tokenizer, texts):
+    """Lunghezza in token (troncata a MAX_LEN) di ogni testo, senza padding."""
+    enc = tokenizer(texts, truncation=True, max_length=MAX_LEN)
+    return [len(ids) for ids in enc["input_ids"]]
+
+def embed_texts(model, tokenizer, texts):
+    """Mean pooling + L2 normalize, shape (len(texts), EMB_DIM)."""
+    # tokenizza (padding solo fino al testo più lungo del batch)
+    inputs = tokenizer(
+        texts,
+        padding=True,
+        truncation=True,
+        max_length=MAX_LEN,
+        return_tensors="pt"
+    ).to(DEVICE)
+
+    with torch.no_grad():
+        out = model(**inputs)
+        # media sui token embeddings (sentence embedding standard),
+        # escludendo i token di padding tramite attention_mask
+        mask = inputs["attention_mask"].unsqueeze(-1).to(out.last_hidden_state.dtype)
+        emb = (out.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        emb = torch.nn.functional.normalize(emb, p=2, dim=1)
+        return emb.cpu().numpy()
+
+def embed_missing(texts, todo):
+    """(indici, vettori) per i testi `todo`, a batch ordinati per lunghezza (un solo processo)."""
+    tqdm.write(f"🔹 Carico {MODEL_ID} … ({len(todo)} chunk da embeddare)")
+    model, tokenizer = load_model()
+    lengths = token_lengths(tokenizer, [texts[i] for i in todo])
+    for b in length_sorted_batches(lengths, BATCH_SIZE, MAX_BATCH_TOKENS):
+        idx = [todo[k] for k in b]
+        yield idx, embed_texts(model, tokenizer, [texts[i] for i in idx])
+
+def main(embed_fn=embed_missing):
+    """`embed_fn(texts, todo)` genera (indici, vettori); embed_sharded.py lo sostituisce con i worker."""
     if not CHUNKS_DIR.exists():
         raise SystemExit(f"Cartella chunk non trovata: {CHUNKS_DIR}")
 
     EMB_DIR.mkdir(parents=True, exist_ok=True)
-    manifest_in  = CHUNKS_DIR / "manifest.jsonl"
+    manifest_in, dedup = select_manifest(CHUNKS_DIR)   # errore se manifest_dedup è superato
     manifest_out = EMB_DIR / "manifest_embeddings.jsonl"
 
-    print(f"🔹 Carico {MODEL_ID} …")
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
-    model = AutoModel.from_pretrained(MODEL_ID).to(DEVICE).eval()
     EMB_DIM = 1024
     (EMB_DIR / "EMBEDDING_DIM.txt").write_text(str(EMB_DIM), encoding="utf-8")
     print(f"✅ Dim embedding: {EMB_DIM}")
@@ -36,62 +87,102 @@ def main():
             for line in mf:
                 try:
                     rec = json.loads(line)
-                    src_by_chunk[Path(rec["chunk_path"]).resolve()] = rec
+                    src_by_chunk[resolve_chunk_path(rec, CHUNKS_DIR).resolve()] = rec
                 except Exception:
                     pass
 
     files = list(iter_chunk_files(CHUNKS_DIR))
     if not files:
         raise SystemExit("Nessun chunk trovato. Esegui prima: python chunk_texts.py")
+    if dedup:
+        # i duplicati scartati da dedup_chunks.py non vengono embeddati
+        files = [f for f in files if f.resolve() in src_by_chunk]
+        print(f"🔹 Manifest deduplicato: {len(files)} chunk ({manifest_in.name})")
 
-    total = 0
-    with open(manifest_out, "w", encoding="utf-8") as mf_out:
-        for f in tqdm(files, desc="Embeddings e5-large"):
-            text = f.read_text(encoding="utf-8", errors="ignore").strip()
-            if not text:
-                continue
-
-            # tokenizza
-            inputs = tokenizer(
-                text,
-                padding=True,
-                truncation=True,
-                max_length=MAX_LEN,
-                return_tensors="pt"
-            ).to(DEVICE)
-
-            with torch.no_grad():
-                out = model(**inputs)
-                # media sui token embeddings (sentence embedding standard)
-                emb = out.last_hidden_state.mean(dim=1)
-                emb = torch.nn.functional.normalize(emb, p=2, dim=1)
-                emb = emb[0].cpu().numpy()
-
-            # salva npy in cartelle parallele a data_chunks
-            rel = f.relative_to(CHUNKS_DIR)
-            out_dir = EMB_DIR / rel.parent
-            out_dir.mkdir(parents=True, exist_ok=True)
-            out_npy = out_dir / (rel.stem + ".npy")
-            np.save(out_npy, emb)
+    # legge i testi una volta sola; l'ordine di `items` è quello del manifest in uscita
+    items = []
+    for f in files:
+        text = f.read_text(encoding="utf-8", errors="ignore").strip()
+        if text:
+            items.append((f, text))
+
+    texts = [text for _, text in items]
+    rows = [None] * len(items)
+
+    store = None
+    if OUTPUT_FORMAT == "store":
+        store = EmbeddingStore(STORE_DIR, dim=EMB_DIM, dtype=STORE_DTYPE)
+        store.reset()   # re-embed completo: si riparte da una matrice vuota
+
+    def emit(idx, embs):
+        """Scrive gli output (npy o store) e le righe di manifest per gli indici `idx`."""
+        chunk_ids = [chunk_id_for(items[i][0], CHUNKS_DIR) for i in idx]
+        if store is not None:
+            store_rows = store.append(chunk_ids, embs)
+
+        for j, (i, emb) in enumerate(zip(idx, embs)):
+            f = items[i][0]
+            if store is not None:
+                out = {
+                    "store_path": str(STORE_DIR.resolve()),
+                    "store_row": store_rows[j],
+                    "chunk_id": chunk_ids[j],
+                }
+            else:
+                # salva npy in cartelle parallele a data_chunks
+                rel = f.relative_to(CHUNKS_DIR)
+                out_dir = EMB_DIR / rel.parent
+                out_dir.mkdir(parents=True, exist_ok=True)
+                out_npy = out_dir / (rel.stem + ".npy")
+                np.save(out_npy, emb)
+                out = {"embedding_path": str(out_npy.resolve())}
 
             info = src_by_chunk.get(f.resolve(), {})
-            row = {
+            rows[i] = {
                 "chunk_path": str(f.resolve()),
-                "embedding_path": str(out_npy.resolve()),
+                **out,
                 "embedding_dim": EMB_DIM,
                 "source_path": info.get("source_path"),
                 "source_name": info.get("source_name"),
                 "source_dir": info.get("source_dir"),
                 "chunk_index": info.get("chunk_index"),
                 "chunk_size_chars": info.get("chunk_size_chars"),
+                "sources": info.get("sources"),
                 "model_name": MODEL_ID,
-                "vector_type": "mean_pooling",
+                "vector_type": VECTOR_TYPE,
             }
+        bar.update(len(idx))
+
+    cache = EmbeddingCache(CACHE_PATH, max_bytes=CACHE_MAX_BYTES) if USE_CACHE else None
+    keys = [make_key(MODEL_ID, None, MAX_LEN, t) for t in texts]
+    cached = cache.get_many(keys) if cache is not None else {}
+    todo = [i for i, k in enumerate(keys) if k not in cached]
+
+    with tqdm(total=len(items), desc="Embeddings e5-large") as bar:
+        hit = [i for i, k in enumerate(keys) if k in cached]
+        for s in range(0, len(hit), 256):
+            idx = hit[s:s + 256]
+            emit(idx, np.stack([cached[keys[i]] for i in idx]))
+
+        # solo i chunk nuovi o modificati passano dal modello (caricato solo se serve)
+        for idx, embs in (embed_fn(texts, todo) if todo else ()):
+            if cache is not None:
+                cache.put_many([keys[i] for i in idx], embs)
+            emit(idx, embs)
+
+    if cache is not None:
+        st = cache.stats()
+        print(f"🗃️  Cache: hit {st['hits']} | miss {st['misses']} | hit rate {st['hit_rate']:.1%}"
+              f" | voci {st['entries']} ({st['bytes'] / 1024 ** 2:.1f} MB) | evict {st['evicted']}")
+        cache.close()
+
+    with open(manifest_out, "w", encoding="utf-8") as mf_out:
+        for row in rows:
             mf_out.write(json.dumps(row, ensure_ascii=False) + "\n")
-            total += 1
 
-    print(f"\nFATTO ✓  Chunk embeddati: {total}")
-    print(f"Output: {EMB_DIR} (manifest_embeddings.jsonl, EMBEDDING_DIM.txt)")
+    print(f"\nFATTO ✓  Chunk embeddati: {len(rows)}")
+    print(f"Output: {EMB_DIR} (manifest_embeddings.jsonl, EMBEDDING_DIM.txt"
+          + (f", {STORE_DIR.name}/)" if store is not None else ")"))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Embedding multi-processo a shard (stessi output di embed_chunks_*.py):
+- i chunk non in cache vengono divisi in shard contigui, elaborati da
+  NUM_WORKERS processi; ogni processo carica il proprio modello con
+  THREADS_PER_WORKER thread (meglio di un solo processo con tutti i core)
+- ogni shard finito viene salvato in <EMB_DIR>/shards/ (scrittura atomica):
+  se un worker fallisce si ripetono solo gli shard mancanti, fino a SHARD_RETRIES
+  volte; se un worker muore (BrokenProcessPool) gli shard in volo si riprovano uno
+  alla volta e il tentativo si scala solo a quello che lo fa morire di nuovo;
+  anche rilanciando lo script gli shard già completati vengono riusati
+- il coordinatore unisce gli shard nell'ordine originale: manifest_embeddings.jsonl
+  (e lo store) sono identici a quelli di un'esecuzione a processo singolo
+
+Esegui:
+    python preprocessing/embed_sharded.py
+"""
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import hashlib, importlib, math, multiprocessing as mp, os, shutil
+import numpy as np
+from tqdm import tqdm
+
+from batching import length_sorted_batches
+from embedding_cache import make_key
+
+# ====== CONFIG ======
+EMBED_MODULE       = "embed_chunks_v4"   # "embed_chunks_v4" (jina v4) | "embed_chunks_2" (e5-large)
+THREADS_PER_WORKER = 4       # thread torch per processo
+NUM_WORKERS        = None    # None = core disponibili / THREADS_PER_WORKER
+SHARD_SIZE         = 256     # chunk massimi per shard
+SHARD_RETRIES      = 2       # tentativi extra per shard fallito
+KEEP_SHARDS        = False   # True = non cancellare <EMB_DIR>/shards/ a fine lavoro
+# ====================
+
+# stato del processo worker (impostato da _init_worker)
+_EMB = _MODEL = _TOK = None
+
+
+def _init_worker(module_name: str, threads: int):
+    global _EMB, _MODEL, _TOK
+    import torch
+
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass   # già impostato: ammesso solo prima del primo lavoro parallelo
+    _EMB = importlib.import_module(module_name)
+    _MODEL, _TOK = _EMB.load_model()
+
+
+def _embed_shard(path: str, texts) -> int:
+    """Worker: embedda uno shard e lo salva come matrice .npy nell'ordine di `texts`."""
+    lengths = _EMB.token_lengths(_TOK, texts)
+    vecs = [None] * len(texts)
+    for b in length_sorted_batches(lengths, _EMB.BATCH_SIZE, _EMB.MAX_BATCH_TOKENS):
+        for k, v in zip(b, _EMB.embed_texts(_MODEL, _TOK, [texts[k] for k in b])):
+            vecs[k] = v
+    tmp = path[:-len(".npy")] + ".tmp.npy"
+    np.save(tmp, np.stack(vecs).astype(np.float32))
+    os.replace(tmp, path)   # lo shard esiste solo se completo
+    return len(texts)
+
+
+def plan_shards(emb, texts, todo, shards_dir, workers: int, shard_size: int = SHARD_SIZE):
+    """Shard contigui di `todo`: [(indici, path)], il nome dipende dai testi (riuso sicuro)."""
+    size = max(1, min(shard_size, math.ceil(len(todo) / workers)))
+    task_label = getattr(emb, "TASK_LABEL", None)
+    shards = []
+    for n, s in enumerate(range(0, len(todo), size)):
+        idx = todo[s:s + size]
+        h = hashlib.sha1("\n".join(make_key(emb.MODEL_ID, task_label, emb.MAX_LEN, texts[i])
+                                   for i in idx).encode("utf-8")).hexdigest()[:16]
+        shards.append((idx, shards_dir / f"shard_{n:05d}_{h}.npy"))
+    return shards
+
+
+def run_shards(emb, texts, todo, shards_dir, workers: int, threads: int = THREADS_PER_WORKER):
+    """(indici, vettori) shard per shard, in ordine, mentre i worker continuano a lavorare."""
+    shards_dir.mkdir(parents=True, exist_ok=True)
+    shards = plan_shards(emb, texts, todo, shards_dir, workers)
+    pending = [k for k, (_, p) in enumerate(shards) if not p.exists()]
+    tqdm.write(f"🔹 {len(todo)} chunk in {len(shards)} shard | worker: {min(workers, len(pending))}"
+               f" x {threads} thread | già completati: {len(shards) - len(pending)}")
+
+    next_out = 0
+
+    def flush():
+        # consegna gli shard pronti senza saltarne: l'ordine di output resta deterministico
+        nonlocal next_out
+        while next_out < len(shards) and shards[next_out][1].exists():
+            idx, p = shards[next_out]
+            yield idx, np.load(p)
+            next_out += 1
+
+    failures = Counter()
+    suspects = set()   # shard in volo quando un worker è morto: il colpevole non si conosce
+
+    def charge(k, e):
+        failures[k] += 1
+        if failures[k] > SHARD_RETRIES:
+            raise RuntimeError(f"Shard {shards[k][1].name} fallito {failures[k]} volte") from e
+        tqdm.write(f"[warn] Shard {shards[k][1].name} fallito ({e!r}):"
+                   f" riprovo ({failures[k]}/{SHARD_RETRIES})")
+
+    while pending:
+        # dopo un BrokenProcessPool i sospetti girano uno alla volta in un pool dedicato:
+        # se il worker muore ancora il colpevole è certo e solo a lui si scala un tentativo
+        isolate = [k for k in pending if k in suspects][:1]
+        batch = isolate or pending
+        pool = ProcessPoolExecutor(
+            max_workers=min(workers, len(batch)),
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(emb.__name__, threads),
+        )
+        try:
+            futs = {pool.submit(_embed_shard, str(shards[k][1]), [texts[i] for i in shards[k][0]]): k
+                    for k in batch}
+            pending = [k for k in pending if k not in batch]
+            for fut in as_completed(futs):
+                k = futs[fut]
+                try:
+                    fut.result()
+                except BrokenProcessPool as e:
+                    if isolate:
+                        charge(k, e)
+                    elif k not in suspects:
+                        suspects.add(k)
+                        tqdm.write(f"[warn] Worker terminato: {shards[k][1].name} verrà riprovato da solo")
+                    pending.append(k)
+                    continue
+                except Exception as e:
+                    charge(k, e)
+                    pending.append(k)
+                    continue
+                suspects.discard(k)
+                yield from flush()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+        pending.sort()
+    yield from flush()
+
+
+def main():
+    emb = importlib.import_module(EMBED_MODULE)
+    shards_dir = emb.EMB_DIR / "shards"
+    workers = NUM_WORKERS or max(1, (os.cpu_count() or 1) // THREADS_PER_WORKER)
+    # ereditate dai worker (spawn): evitano che ogni processo apra un thread per core
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[var] = str(THREADS_PER_WORKER)
+
+    def embed_fn(texts, todo):
+        yield from run_shards(emb, texts, todo, shards_dir, workers)
+
+    emb.main(embed_fn=embed_fn)
+    if not KEEP_SHARDS:
+        shutil.rmtree(shards_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
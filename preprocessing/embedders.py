@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Embedder CPU per models/all-MiniLM-L6-v2 con backend intercambiabili:
+- "torch"        → transformers (fp32, riferimento)
+- "onnxruntime"  → onnx/model_*.onnx (varianti ottimizzate / quantizzate)
+- "openvino"     → openvino/openvino_model*.xml
+- "auto"         → il primo backend installato tra onnxruntime, openvino, torch
+
+La variante ONNX viene scelta in base alle flag della CPU (avx512_vnni, avx512,
+avx2, arm64). Pooling come 1_Pooling/config.json: mean sui token (mask) + L2 normalize.
+Base comune e backend ONNX sono in plugins/intent_classifier/onnx_embedder.py.
+
+Il modulo espone anche l'interfaccia degli script di embedding
+(MODEL_ID, MAX_LEN, load_model, token_lengths, embed_texts), quindi si può usare
+come EMBED_MODULE in ingest_pipeline.py.
+"""
+
+from pathlib import Path
+import importlib.util, os
+import numpy as np
+
+MODEL_DIR  = Path("models/all-MiniLM-L6-v2")
+MODEL_ID   = "sentence-transformers/all-MiniLM-L6-v2"
+BACKEND    = "auto"    # "auto" | "torch" | "onnxruntime" | "openvino"
+VARIANT    = None      # es. "model_O3.onnx"; None = scelta automatica
+NUM_THREADS= None      # None = default del runtime
+MAX_LEN    = 256       # max_seq_length di sentence_bert_config.json
+TASK_LABEL = None
+VECTOR_TYPE= "mean_pooling"
+BATCH_SIZE = 32
+MAX_BATCH_TOKENS = None
+
+BACKENDS = ("onnxruntime", "openvino", "torch")
+
+# Embedder base, scelta della variante ONNX e OnnxEmbedder stanno nel plugin intent_classifier,
+# che li usa a runtime (nel container c'è solo plugins/): si caricano da lì per path, come
+# create_collection.py fa con search_profile.json, così esiste una sola copia del codice
+_SHARED = Path(__file__).resolve().parent.parent / "plugins" / "intent_classifier" / "onnx_embedder.py"
+_spec = importlib.util.spec_from_file_location("onnx_embedder", _SHARED)
+onnx_embedder = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(onnx_embedder)
+
+Embedder, OnnxEmbedder = onnx_embedder.Embedder, onnx_embedder.OnnxEmbedder
+cpu_flags, _is_model_file = onnx_embedder.cpu_flags, onnx_embedder._is_model_file
+
+
+def pick_onnx_variant(model_dir: Path = MODEL_DIR, flags: set = None) -> Path:
+    """Come onnx_embedder.pick_onnx_variant, con models/all-MiniLM-L6-v2 come default."""
+    return onnx_embedder.pick_onnx_variant(model_dir, flags)
+
+
+class TorchEmbedder(Embedder):
+    backend = "torch"
+
+    def __init__(self, model_dir: Path = MODEL_DIR, max_len: int = MAX_LEN, num_threads: int = None):
+        super().__init__(model_dir, max_len)
+        import torch
+        from transformers import AutoModel
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self._torch = torch
+        self.model = AutoModel.from_pretrained(str(self.model_dir)).eval()
+        self.variant = "pytorch_fp32"
+
+    def _forward(self, ids, mask, types):
+        t = self._torch
+        with t.no_grad():
+            out = self.model(input_ids=t.from_numpy(ids), attention_mask=t.from_numpy(mask),
+                             token_type_ids=t.from_numpy(types))
+        return out.last_hidden_state.numpy()
+
+
+class OpenVinoEmbedder(Embedder):
+    backend = "openvino"
+
+    def __init__(self, model_dir: Path = MODEL_DIR, max_len: int = MAX_LEN,
+                 num_threads: int = None, variant: str = None):
+        super().__init__(model_dir, max_len)
+        import openvino as ov
+
+        path = (self.model_dir / "openvino" / variant) if variant else pick_openvino_variant(self.model_dir)
+        core = ov.Core()
+        config = {"PERFORMANCE_HINT": "LATENCY"}
+        if num_threads:
+            config["INFERENCE_NUM_THREADS"] = num_threads
+        self.compiled = core.compile_model(core.read_model(str(path)), "CPU", config)
+        self.input_names = {i.get_any_name() for i in self.compiled.inputs}
+        self.variant = path.name
+
+    def _forward(self, ids, mask, types):
+        feed = {"input_ids": ids, "attention_mask": mask, "token_type_ids": types}
+        feed = {k: v for k, v in feed.items() if k in self.input_names}
+        return self.compiled(feed)[0]
+
+
+_CLASSES = {"torch": TorchEmbedder, "onnxruntime": OnnxEmbedder, "openvino": OpenVinoEmbedder}
+
+
+def load_embedder(backend: str = BACKEND, model_dir: Path = MODEL_DIR, variant: str = VARIANT,
+                  num_threads: int = NUM_THREADS, max_len: int = MAX_LEN) -> Embedder:
+    """Istanzia l'embedder richiesto; con "auto" prova i backend in ordine di velocità."""
+    if backend != "auto":
+        if backend not in _CLASSES:
+            raise ValueError(f"Backend sconosciuto: {backend} (ammessi: auto, {', '.join(BACKENDS)})")
+        kwargs = {"variant": variant} if backend != "torch" else {}
+        return _CLASSES[backend](model_dir, max_len, num_threads, **kwargs)
+    errors = []
+    for name in BACKENDS:
+        # la variante esplicita vale solo per il backend del suo formato (.onnx / .xml)
+        ext = {"onnxruntime": ".onnx", "openvino": ".xml"}.get(name)
+        own_variant = variant if (variant and ext and variant.endswith(ext)) else None
+        try:
+            return load_embedder(name, model_dir, own_variant, num_threads, max_len)
+        except (ImportError, FileNotFoundError) as e:
+            errors.append(f"{name}: {e}")
+    raise RuntimeError("Nessun backend di embedding disponibile:\n  " + "\n  ".join(errors))
+
+
+# --- interfaccia comune agli script embed_chunks_*.py (vedi ingest_pipeline.py) ---
+def load_model():
+    emb = load_embedder()
+    print(f"🔹 Embedder {emb.backend} ({emb.variant}), threads={NUM_THREADS or os.cpu_count()}")
+    return emb, emb
+
+
+def token_lengths(embedder: Embedder, texts):
+    return embedder.token_lengths(texts)
+
+
+def embed_texts(embedder: Embedder, _tok, texts):
+    return embedder.encode(texts)
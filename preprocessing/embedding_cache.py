@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Cache persistente degli embedding (SQLite):
+- chiave = sha256(model id, task_label, max_len, sha256 del testo normalizzato)
+- valore = vettore float32
+- statistiche hit/miss ed eviction LRU quando si supera `max_bytes`
+
+Gli script di embedding la consultano prima di chiamare il modello:
+i chunk identici alla run precedente non vengono ricalcolati.
+"""
+
+from pathlib import Path
+import hashlib, re, sqlite3, time, unicodedata
+import numpy as np
+
+_WS = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """NFC + spazi compattati: chunk che differiscono solo per whitespace coincidono."""
+    return _WS.sub(" ", unicodedata.normalize("NFC", text or "")).strip()
+
+
+def make_key(model_id: str, task_label, max_len: int, text: str) -> str:
+    text_hash = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    raw = f"{model_id}\x1f{task_label or '-'}\x1f{max_len}\x1f{text_hash}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path, max_bytes: int = 2 * 1024 ** 3):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, dim INTEGER NOT NULL, vector BLOB NOT NULL,"
+            " nbytes INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings(last_used)")
+        self.db.commit()
+
+    def get_many(self, keys) -> dict:
+        """key -> vettore per le chiavi presenti; aggiorna last_used e le statistiche."""
+        found = {}
+        uniq = list(dict.fromkeys(keys))
+        for s in range(0, len(uniq), 500):   # limite parametri SQLite
+            part = uniq[s:s + 500]
+            marks = ",".join("?" * len(part))
+            for key, dim, blob in self.db.execute(
+                f"SELECT key, dim, vector FROM embeddings WHERE key IN ({marks})", part
+            ):
+                found[key] = np.frombuffer(blob, dtype=np.float32).reshape(dim)
+        if found:
+            now = time.time()
+            self.db.executemany("UPDATE embeddings SET last_used=? WHERE key=?",
+                                [(now, k) for k in found])
+            self.db.commit()
+        hits = sum(1 for k in keys if k in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, keys, vectors):
+        now = time.time()
+        rows = []
+        for key, vec in zip(keys, vectors):
+            blob = np.ascontiguousarray(vec, dtype=np.float32).tobytes()
+            rows.append((key, int(np.shape(vec)[-1]), blob, len(blob), now))
+        self.db.executemany(
+            "INSERT OR REPLACE INTO embeddings(key, dim, vector, nbytes, last_used) VALUES (?,?,?,?,?)",
+            rows,
+        )
+        self.db.commit()
+        self.evict()
+
+    def size_bytes(self) -> int:
+        return self.db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+
+    def evict(self):
+        """Elimina le voci usate meno di recente finché la cache sta in `max_bytes`."""
+        excess = self.size_bytes() - self.max_bytes
+        if excess <= 0:
+            return
+        victims, freed = [], 0
+        for key, nbytes in self.db.execute("SELECT key, nbytes FROM embeddings ORDER BY last_used"):
+            victims.append((key,))
+            freed += nbytes
+            if freed >= excess:
+                break
+        self.db.executemany("DELETE FROM embeddings WHERE key=?", victims)
+        self.db.commit()
+        self.evicted += len(victims)
+
+    def stats(self) -> dict:
+        entries = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        looked_up = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / looked_up) if looked_up else 0.0,
+            "evicted": self.evicted,
+            "entries": entries,
+            "bytes": self.size_bytes(),
+        }
+
+    def close(self):
+        self.db.close()
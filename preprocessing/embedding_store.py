@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Store consolidato degli embedding:
+- una sola matrice contigua (float32/float16/int8) in `vectors.bin`, leggibile via memory-map
+- `index.jsonl` con una riga per vettore: row -> chunk_id
+- `store.json` con dim, dtype, numero di righe valide e byte validi dell'indice
+
+Gli scrittori fanno append (nessun file per chunk), i lettori ottengono
+slice zero-copy della matrice con `matrix()` / `get()`.
+"""
+
+from pathlib import Path, PureWindowsPath
+import json
+import numpy as np
+
+VECTORS_FILE = "vectors.bin"
+INDEX_FILE   = "index.jsonl"
+META_FILE    = "store.json"
+DTYPES       = ("float32", "float16", "int8")   # int8: vedi compress_embeddings.py
+
+
+def chunk_id_for(chunk_file: Path, chunks_dir: Path) -> str:
+    """Id stabile del chunk: path relativo a data_chunks senza estensione."""
+    return chunk_file.relative_to(chunks_dir).with_suffix("").as_posix()
+
+
+class EmbeddingStore:
+    def __init__(self, root, dim: int = None, dtype: str = "float32"):
+        self.root = Path(root)
+        meta_path = self.root / META_FILE
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            if dim is not None and dim != meta["dim"]:
+                raise ValueError(f"Dim store {meta['dim']} != richiesta {dim}: {self.root}")
+            self.dim, self.dtype, self.count = meta["dim"], meta["dtype"], meta["count"]
+            self.index_bytes = meta.get("index_bytes")
+            if self.index_bytes is None:   # store più vecchi: si ricava dalle righe valide
+                self.index_bytes = self._valid_index_bytes()
+        else:
+            if dim is None:
+                raise FileNotFoundError(f"Store embedding non trovato: {self.root}")
+            if dtype not in DTYPES:
+                raise ValueError(f"dtype non supportato: {dtype} (ammessi: {DTYPES})")
+            self.dim, self.dtype, self.count = int(dim), dtype, 0
+            self.index_bytes = 0
+            self.root.mkdir(parents=True, exist_ok=True)
+            self._write_meta()
+        self._ids = None
+        self._mm = None
+
+    # --- scrittura ---
+    def _write_meta(self):
+        meta = {"dim": self.dim, "dtype": self.dtype, "count": self.count, "index_bytes": self.index_bytes}
+        tmp = self.root / (META_FILE + ".tmp")
+        tmp.write_text(json.dumps(meta), encoding="utf-8")
+        tmp.replace(self.root / META_FILE)
+
+    def reset(self):
+        """Svuota lo store (per un re-embed completo)."""
+        for name in (VECTORS_FILE, INDEX_FILE):
+            (self.root / name).unlink(missing_ok=True)
+        self.count, self.index_bytes = 0, 0
+        self._ids, self._mm = None, None
+        self._write_meta()
+
+    def append(self, chunk_ids, vectors) -> list:
+        """Aggiunge righe in coda e restituisce i loro row id."""
+        vectors = np.ascontiguousarray(vectors, dtype=self.dtype).reshape(-1, self.dim)
+        if len(chunk_ids) != len(vectors):
+            raise ValueError(f"{len(chunk_ids)} chunk_id per {len(vectors)} vettori")
+        rows = list(range(self.count, self.count + len(vectors)))
+        # prima i dati, poi l'indice, infine il contatore (store.json). Un crash prima di
+        # store.json lascia byte oltre la parte valida dei due file: si scrivono sempre a
+        # partire dalla fine valida (troncando il resto), altrimenti le righe successive
+        # finirebbero dopo gli orfani e i row id punterebbero ai vettori sbagliati
+        with self._open_at(VECTORS_FILE, self.count * self.dim * np.dtype(self.dtype).itemsize) as vf:
+            vf.write(vectors.tobytes())
+        lines = "".join(json.dumps({"row": row, "chunk_id": cid}, ensure_ascii=False) + "\n"
+                        for row, cid in zip(rows, chunk_ids)).encode("utf-8")
+        with self._open_at(INDEX_FILE, self.index_bytes) as xf:
+            xf.write(lines)
+            self.index_bytes = xf.tell()
+        self.count += len(vectors)
+        self._write_meta()
+        if self._ids is not None:
+            self._ids.update(zip(chunk_ids, rows))
+        self._mm = None
+        return rows
+
+    def _open_at(self, name: str, offset: int):
+        """File aperto in scrittura alla fine valida `offset`, senza quello che segue."""
+        path = self.root / name
+        f = path.open("r+b" if path.exists() else "w+b")
+        f.truncate(offset)
+        f.seek(offset)
+        return f
+
+    def _valid_index_bytes(self) -> int:
+        """Byte delle righe di index.jsonl con row < count (scritte in ordine di row)."""
+        xp, size = self.root / INDEX_FILE, 0
+        if xp.exists():
+            with xp.open("rb") as xf:
+                for line in xf:
+                    if not line.endswith(b"\n") or json.loads(line)["row"] >= self.count:
+                        break
+                    size += len(line)
+        return size
+
+    # --- lettura ---
+    def __len__(self):
+        return self.count
+
+    def matrix(self) -> np.ndarray:
+        """Matrice (count, dim) memory-mapped in sola lettura."""
+        if self.count == 0:
+            return np.empty((0, self.dim), dtype=self.dtype)
+        if self._mm is None:
+            self._mm = np.memmap(self.root / VECTORS_FILE, dtype=self.dtype,
+                                 mode="r", shape=(self.count, self.dim))
+        return self._mm
+
+    def ids(self) -> dict:
+        """chunk_id -> row (l'ultima riga vince se un chunk è stato riscritto)."""
+        if self._ids is None:
+            self._ids = {}
+            xp = self.root / INDEX_FILE
+            if xp.exists():
+                with xp.open("r", encoding="utf-8") as xf:
+                    for line in xf:
+                        rec = json.loads(line)
+                        if rec["row"] < self.count:
+                            self._ids[rec["chunk_id"]] = rec["row"]
+        return self._ids
+
+    def get(self, chunk_id: str) -> np.ndarray:
+        return self.matrix()[self.ids()[chunk_id]]
+
+
+def iter_manifest_vectors(manifest_path: Path, emb_dir: Path = None):
+    """
+    Itera (record, vettore) su un manifest_embeddings.jsonl, qualunque sia il formato:
+    righe con `embedding_path` (.npy per chunk) o con `store_path` + `store_row`.
+    Per lo store il vettore è una view sulla matrice memory-mapped.
+    Con `emb_dir`, i .npy con path di un'altra macchina si cercano in emb_dir/<source_dir>/.
+    """
+    stores = {}
+    with Path(manifest_path).open("r", encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            if rec.get("store_path"):
+                sp = rec["store_path"]
+                if sp not in stores:
+                    stores[sp] = EmbeddingStore(sp)
+                yield rec, stores[sp].matrix()[rec["store_row"]]
+            else:
+                emb_path = Path(rec.get("embedding_path") or "")
+                if not emb_path.is_file() and emb_dir is not None:
+                    name = PureWindowsPath(rec.get("embedding_path") or "").name
+                    emb_path = Path(emb_dir) / (rec.get("source_dir") or "") / name
+                if not emb_path.is_file():
+                    continue
+                yield rec, np.load(emb_path)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline di ingestione in streaming:
+    kb_rag_* (.txt) → chunk → embedding → upsert su Qdrant (kb_legale_it)
+
+- i tre stadi girano in parallelo, collegati da code limitate (QUEUE_SIZE):
+  se Qdrant rallenta l'embedding si ferma, se l'embedding rallenta il chunking aspetta
+- nessun file intermedio: chunk e vettori passano in memoria
+  (DEBUG_DIR salva opzionalmente chunk .txt + manifest per ispezione)
+- l'embedding riusa batching per lunghezza e cache di embed_chunks_*.py
+- near-duplicate scartati come in dedup_chunks.py (DEDUP), ma in streaming:
+  resta il primo chunk visto del cluster invece del più lungo
+
+Esegui:
+    python preprocessing/ingest_pipeline.py
+"""
+
+from pathlib import Path
+import importlib, json, queue, threading, time
+import numpy as np
+
+import chunk_texts
+from dedup_chunks import StreamingDeduper
+from batching import length_sorted_batches
+from embedding_cache import EmbeddingCache, make_key
+from chunk_store import ChunkStore
+from upload_to_qdrant import (
+    CHUNK_STORE, COLLECTION, PAYLOAD_MODE, QDRANT_URL, ParallelUploader, build_point,
+    ensure_collection, make_client, store_chunk, write_version,
+)
+
+# ====== CONFIG ======
+INPUT_DIRS   = chunk_texts.INPUT_DIRS
+EMBED_MODULE = "embed_chunks_v4"   # "embed_chunks_v4" (jina v4) | "embed_chunks_2" (e5-large)
+EMBED_WINDOW = 64       # chunk raccolti prima di ordinarli per lunghezza e fare i batch
+QUEUE_SIZE   = 4        # finestre/batch in attesa per coda (backpressure)
+TEXT_LIMIT   = 6000     # caratteri di testo nel payload (come upload_to_qdrant.py)
+USE_CACHE    = True
+CACHE_PATH   = Path("data_embeddings_cache") / "embedding_cache.sqlite"
+DEDUP        = True     # scarta i near-duplicate (MinHash/LSH di dedup_chunks.py)
+DEBUG_DIR    = None     # es. Path("data_chunks_debug"): salva chunk .txt + manifest.jsonl
+# ====================
+
+_DONE = object()
+
+
+def iter_chunks(input_dirs, debug_dir=None):
+    """Stadio 1: (record, testo) per ogni chunk, con gli stessi campi di data_chunks/manifest.jsonl."""
+    mf = None
+    if debug_dir:
+        debug_dir = Path(debug_dir)
+        debug_dir.mkdir(parents=True, exist_ok=True)
+        mf = (debug_dir / "manifest.jsonl").open("w", encoding="utf-8")
+    try:
+        for in_dir in input_dirs:
+            d = Path(in_dir)
+            if not d.exists():
+                print(f"[skip] Cartella non trovata: {d}")
+                continue
+            for f in d.rglob("*.txt"):
+                text = f.read_text(encoding="utf-8", errors="ignore")
+                parts = chunk_texts.chunk_document(text)
+                if not parts:
+                    print(f"[empty] {f}")
+                    continue
+                for idx, ch in enumerate(parts, start=1):
+                    chunk_name = f"{f.stem}__chunk{idx:03d}"
+                    rec = {
+                        "chunk_id": f"{d.name}/{chunk_name}",
+                        "source_path": str(f.resolve()),
+                        "source_dir": str(d.name),
+                        "source_name": f.name,
+                        "chunk_index": idx,
+                        "chunk_path": None,
+                        "chunk_size_chars": len(ch),
+                    }
+                    if mf is not None:
+                        out_fp = debug_dir / d.name / f"{chunk_name}.txt"
+                        out_fp.parent.mkdir(parents=True, exist_ok=True)
+                        out_fp.write_text(ch, encoding="utf-8")
+                        rec["chunk_path"] = str(out_fp.resolve())
+                        mf.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                    yield rec, ch
+    finally:
+        if mf is not None:
+            mf.close()
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """put bloccante che si interrompe se un altro stadio è fallito."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def _stage(target, out_q, stop, errors):
+    """Esegue uno stadio in un thread: in caso di errore ferma tutta la pipeline."""
+    def run():
+        try:
+            target()
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            try:
+                out_q.put_nowait(_DONE)
+            except queue.Full:
+                _put(out_q, _DONE, stop)
+    t = threading.Thread(target=run, name=getattr(target, "__name__", "stage"), daemon=True)
+    t.start()
+    return t
+
+
+def main():
+    emb = importlib.import_module(EMBED_MODULE)
+    task_label = getattr(emb, "TASK_LABEL", None)
+    stop = threading.Event()
+    errors = []
+    q_chunks = queue.Queue(maxsize=QUEUE_SIZE)   # finestre di (record, testo)
+    q_points = queue.Queue(maxsize=QUEUE_SIZE)   # batch di (record, testo, vettore)
+    dim = None
+    stats = {"chunks": 0, "duplicates": 0, "embedded": 0, "cached": 0, "upserted": 0}
+
+    def chunk_stage():
+        window = []
+        dedup = StreamingDeduper() if DEDUP else None
+        for item in iter_chunks(INPUT_DIRS, DEBUG_DIR):
+            stats["chunks"] += 1
+            if dedup is not None and dedup.check(*item) is not None:
+                stats["duplicates"] += 1
+                continue
+            window.append(item)
+            if len(window) >= EMBED_WINDOW:
+                if not _put(q_chunks, window, stop):
+                    return
+                window = []
+        if window:
+            _put(q_chunks, window, stop)
+
+    def embed_stage():
+        cache = EmbeddingCache(CACHE_PATH) if USE_CACHE else None
+        model = tok = None
+        try:
+            while True:
+                window = _get(q_chunks, stop)
+                if window is _DONE:
+                    return
+                texts = [t for _, t in window]
+                keys = [make_key(emb.MODEL_ID, task_label, emb.MAX_LEN, t) for t in texts]
+                cached = cache.get_many(keys) if cache is not None else {}
+
+                hit = [i for i, k in enumerate(keys) if k in cached]
+                if hit:
+                    stats["cached"] += len(hit)
+                    vecs = np.stack([cached[keys[i]] for i in hit])
+                    if not _put(q_points, [(window[i][0], texts[i], v) for i, v in zip(hit, vecs)], stop):
+                        return
+
+                todo = [i for i, k in enumerate(keys) if k not in cached]
+                if not todo:
+                    continue
+                if model is None:
+                    print(f"🔹 Carico {emb.MODEL_ID} …")
+                    model, tok = emb.load_model()
+                lengths = emb.token_lengths(tok, [texts[i] for i in todo])
+                for b in length_sorted_batches(lengths, emb.BATCH_SIZE, emb.MAX_BATCH_TOKENS):
+                    idx = [todo[k] for k in b]
+                    vecs = emb.embed_texts(model, tok, [texts[i] for i in idx])
+                    if cache is not None:
+                        cache.put_many([keys[i] for i in idx], vecs)
+                    stats["embedded"] += len(idx)
+                    if not _put(q_points, [(window[i][0], texts[i], v) for i, v in zip(idx, vecs)], stop):
+                        return
+        finally:
+            if cache is not None:
+                cache.close()
+
+    t0 = time.time()
+    threads = [
+        _stage(chunk_stage, q_chunks, stop, errors),
+        _stage(embed_stage, q_points, stop, errors),
+    ]
+
+    # Stadio 3 (thread principale): upsert paralleli mentre gli altri stadi continuano a lavorare
+    client = make_client()
+    uploader = None
+    chunk_store = ChunkStore(CHUNK_STORE) if PAYLOAD_MODE == "lite" else None
+    batch = []
+    ok = False
+    try:
+        while True:
+            items = _get(q_points, stop)
+            if items is _DONE:
+                break
+            for rec, text, vec in items:
+                if uploader is None:
+                    dim = int(vec.shape[-1])
+                    ensure_collection(client, COLLECTION, dim)
+                    uploader = ParallelUploader(client, COLLECTION)
+                row = {**rec, "model_name": emb.MODEL_ID, "vector_type": emb.VECTOR_TYPE}
+                batch.append(build_point(row, vec.astype(np.float32).tolist(), text[:TEXT_LIMIT]))
+                if chunk_store is not None:
+                    store_chunk(chunk_store, row, text[:TEXT_LIMIT])
+                if len(batch) >= uploader.batch_size:
+                    if chunk_store is not None:
+                        chunk_store.flush()
+                    uploader.submit(batch)
+                    batch = []
+        if batch and not errors:
+            if chunk_store is not None:
+                chunk_store.flush()
+            uploader.submit(batch)
+        ok = True
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        if uploader is not None:
+            # con un errore già in corso quelli dei worker non devono sostituirlo
+            stats["upserted"] = uploader.close(raise_errors=ok and not errors)
+        if chunk_store is not None:
+            removed = chunk_store.prune() if ok and not errors else 0
+            if removed:
+                print(f"[ok] Chunk store: rimosse {removed} sorgenti non più presenti")
+            chunk_store.close()
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+    write_version(stats["upserted"], emb.MODEL_ID, dim)
+
+    print(f"\nFATTO ✓  Chunk: {stats['chunks']} | duplicati scartati: {stats['duplicates']} | embeddati: {stats['embedded']}"
+          f" | da cache: {stats['cached']} | inseriti: {stats['upserted']}"
+          f" | {time.time() - t0:.1f}s")
+    print(f"Collection: {COLLECTION} @ {QDRANT_URL}")
+
+
+if __name__ == "__main__":
+    main()
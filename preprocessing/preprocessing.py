@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
-# Scarica testi "puliti" da Wikipedia per base RAG (con fallback via requests)
+# Scarica testi "puliti" da Wikipedia per base RAG (con fallback via trafilatura)
+#
+# - download concorrenti (thread pool) con limite di connessioni e intervallo minimo per host
+# - cache HTTP su disco: richieste condizionali (ETag / If-Modified-Since),
+#   le pagine invariate (304) non vengono ri-estratte se il .txt esiste già
+# - estrazione del testo (trafilatura) in un pool di processi
 
-import os, re, time
+import os, re, time, json, hashlib, threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 import trafilatura
 import requests
@@ -26,7 +32,13 @@ URLS = [
 
 
 OUTPUT_DIR = "kb_rag_wikipedia"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+CACHE_DIR  = ".http_cache"        # cache HTTP (corpo + ETag/Last-Modified) per URL
+LINKS_FILE = "link db.txt"        # URL aggiuntivi (tra virgolette) se il file esiste
+MAX_WORKERS   = 8                 # download contemporanei in totale
+PER_HOST      = 2                 # download contemporanei per host
+HOST_INTERVAL = 0.5               # secondi minimi tra due richieste allo stesso host
+EXTRACT_PROCS = None              # processi per l'estrazione (None = os.cpu_count())
+TIMEOUT       = (5, 20)           # (connect, read) secondi
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
@@ -40,19 +52,127 @@ def safe_slug(url: str) -> str:
     last = re.sub(r"[^A-Za-z0-9._-]+", "_", last)
     return f"{p.netloc}__{last}.txt"
 
-def fetch_html(url: str) -> str | None:
-    # 1) tentativo con trafilatura
-    html = trafilatura.fetch_url(url)
-    if html:
-        return html
-    # 2) fallback via requests
+def load_links(path: str = LINKS_FILE) -> list:
+    """URL tra virgolette presenti nel file (le righe descrittive vengono ignorate)."""
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return re.findall(r'"(https?://[^"\s]+)"', f.read())
+
+
+class HttpCache:
+    """Un file .json (metadati) + un file .html (corpo) per URL, in CACHE_DIR."""
+
+    def __init__(self, root: str = CACHE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _base(self, url: str) -> str:
+        return os.path.join(self.root, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    def get(self, url: str):
+        """(metadati, html) oppure (None, None)."""
+        base = self._base(url)
+        try:
+            with open(base + ".json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(base + ".html", "r", encoding="utf-8") as f:
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None, None
+
+    def put(self, url: str, html: str, etag: str = None, last_modified: str = None):
+        base = self._base(url)
+        with open(base + ".html", "w", encoding="utf-8") as f:
+            f.write(html)
+        meta = {"url": url, "etag": etag, "last_modified": last_modified, "fetched_at": time.time()}
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+
+class HostLimiter:
+    """Al massimo `per_host` richieste in corso e `interval` secondi tra due avvii, per host."""
+
+    def __init__(self, per_host: int = PER_HOST, interval: float = HOST_INTERVAL):
+        self.per_host = per_host
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._sems = {}
+        self._next = {}
+
+    def _host_state(self, host: str):
+        with self._lock:
+            if host not in self._sems:
+                self._sems[host] = threading.Semaphore(self.per_host)
+                self._next[host] = [0.0, threading.Lock()]
+            return self._sems[host], self._next[host]
+
+    def acquire(self, host: str):
+        sem, slot = self._host_state(host)
+        sem.acquire()
+        with slot[1]:
+            wait = slot[0] - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            slot[0] = time.monotonic() + self.interval
+
+    def release(self, host: str):
+        self._sems[host].release()
+
+
+_local = threading.local()
+
+def _session() -> requests.Session:
+    # una Session (pool keep-alive) per thread
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+        _local.session.headers.update(HEADERS)
+    return _local.session
+
+def decode_body(r: requests.Response) -> str:
+    """
+    Testo della risposta. Senza charset nell'header requests decodifica come latin-1
+    ("è" → "Ã¨"): in quel caso utf-8 se valido, altrimenti la codifica rilevata dai byte.
+    """
+    if "charset=" in r.headers.get("Content-Type", "").lower():
+        return r.text
     try:
-        r = requests.get(url, headers=HEADERS, timeout=20)
-        if r.ok and r.text:
-            return r.text
+        return r.content.decode("utf-8")
+    except UnicodeDecodeError:
+        r.encoding = r.apparent_encoding
+        return r.text
+
+def fetch_html(url: str, cache: HttpCache = None):
+    """
+    (html, changed). Con la cache invia una richiesta condizionale:
+    304 → html dalla cache e changed=False.
+    """
+    meta, cached = cache.get(url) if cache is not None else (None, None)
+    headers = {}
+    if cached is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    # 1) tentativo con requests (supporta le richieste condizionali)
+    try:
+        r = _session().get(url, headers=headers, timeout=TIMEOUT)
+        if r.status_code == 304 and cached is not None:
+            return cached, False
+        html = decode_body(r) if r.ok else ""
+        if html:
+            if cache is not None:
+                cache.put(url, html, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+            return html, True
     except Exception:
         pass
-    return None
+    # 2) fallback via trafilatura
+    html = trafilatura.fetch_url(url)
+    if html:
+        if cache is not None:
+            cache.put(url, html)
+        return html, (html != cached)
+    return None, False
 
 def extract_text(html: str) -> str | None:
     return trafilatura.extract(
@@ -63,32 +183,88 @@ def extract_text(html: str) -> str | None:
         with_metadata=True
     )
 
-def fetch_and_save(url: str) -> str:
-    html = fetch_html(url)
-    if not html:
-        raise RuntimeError("download fallito (fetch_html)")
-    text = extract_text(html)
+def save_text(url: str, html: str, text: str | None, output_dir: str = OUTPUT_DIR) -> str:
     if not text:
         # Se l’estrazione “pulita” fallisce, salvo almeno l’HTML grezzo come backup
-        path_fallback = os.path.join(OUTPUT_DIR, safe_slug(url).replace(".txt", ".html"))
+        path_fallback = os.path.join(output_dir, safe_slug(url).replace(".txt", ".html"))
         with open(path_fallback, "w", encoding="utf-8") as f:
             f.write(html)
         raise RuntimeError("estrazione testo fallita (salvato .html di fallback)")
-    path = os.path.join(OUTPUT_DIR, safe_slug(url))
+    path = os.path.join(output_dir, safe_slug(url))
     with open(path, "w", encoding="utf-8") as f:
         f.write(text)
     return path
 
+def fetch_and_save(url: str, output_dir: str = OUTPUT_DIR) -> str:
+    """Versione sequenziale (nessuna cache) per un singolo URL."""
+    os.makedirs(output_dir, exist_ok=True)
+    html, _ = fetch_html(url)
+    if not html:
+        raise RuntimeError("download fallito (fetch_html)")
+    return save_text(url, html, extract_text(html), output_dir)
+
+def crawl(urls, output_dir: str = OUTPUT_DIR, cache_dir: str = CACHE_DIR,
+          max_workers: int = MAX_WORKERS, per_host: int = PER_HOST,
+          host_interval: float = HOST_INTERVAL, extract_procs: int = EXTRACT_PROCS):
+    """
+    Scarica ed estrae gli URL in parallelo.
+    Restituisce una lista di (url, stato, path|errore) con stato in
+    "ok" | "unchanged" | "error", nell'ordine di `urls`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    cache = HttpCache(cache_dir) if cache_dir else None
+    limiter = HostLimiter(per_host, host_interval)
+    urls = list(dict.fromkeys(urls))
+    results = {}
+
+    def fetch(url):
+        host = urlparse(url).netloc
+        limiter.acquire(host)
+        try:
+            return fetch_html(url, cache)
+        finally:
+            limiter.release(host)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as fetch_pool, \
+         ProcessPoolExecutor(max_workers=extract_procs) as extract_pool:
+        fetches = {fetch_pool.submit(fetch, u): u for u in urls}
+        extractions = {}
+        for fut in as_completed(fetches):
+            url = fetches[fut]
+            try:
+                html, changed = fut.result()
+            except Exception as e:
+                results[url] = (url, "error", str(e))
+                continue
+            if not html:
+                results[url] = (url, "error", "download fallito (fetch_html)")
+                continue
+            path = os.path.join(output_dir, safe_slug(url))
+            if not changed and os.path.exists(path):
+                results[url] = (url, "unchanged", path)
+                continue
+            # l'estrazione (CPU-bound) va nei processi mentre i download continuano
+            extractions[extract_pool.submit(extract_text, html)] = (url, html)
+
+        for fut in as_completed(extractions):
+            url, html = extractions[fut]
+            try:
+                results[url] = (url, "ok", save_text(url, html, fut.result(), output_dir))
+            except Exception as e:
+                results[url] = (url, "error", str(e))
+
+    return [results[u] for u in urls]
+
 if __name__ == "__main__":
     saved = []
-    for u in URLS:
-        try:
-            fp = fetch_and_save(u)
-            print(f"✅ Salvato: {fp}")
-            saved.append(fp)
-            time.sleep(0.5)  # piccola pausa
-        except Exception as e:
-            print(f"❌ Errore con {u}: {e}")
+    for url, status, info in crawl(URLS + load_links()):
+        if status == "ok":
+            print(f"✅ Salvato: {info}")
+            saved.append(info)
+        elif status == "unchanged":
+            print(f"⏭️  Invariato: {info}")
+        else:
+            print(f"❌ Errore con {url}: {info}")
 
     # riepilogo
     if saved:
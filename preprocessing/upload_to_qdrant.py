@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 from pathlib import Path
-import json, uuid, time
+import json, random, threading, uuid, time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import numpy as np
 from tqdm import tqdm
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import PointStruct, Distance, VectorParams
-from qdrant_client.http.exceptions import UnexpectedResponse
+from qdrant_client.http.models import PointStruct
+
+from chunk_store import ChunkStore
+from create_collection import apply_profile
+from embedding_store import iter_manifest_vectors
 
 # === Percorsi e settaggi ===
 CHUNKS_DIR = Path("data_chunks")            # dove stanno i .txt
@@ -14,35 +18,50 @@ MANIFEST   = EMB_DIR / "manifest_embeddings.jsonl"
 DIM_FILE   = EMB_DIR / "EMBEDDING_DIM.txt"
 
 QDRANT_URL = "http://localhost:6333"
+PREFER_GRPC= True      # upsert via gRPC (porta 6334 esposta in compose.yaml)
+GRPC_PORT  = 6334
 COLLECTION = "kb_legale_it"
-BATCH_SIZE = 256
+BATCH_SIZE = 256       # dimensione iniziale; poi si adatta tra MIN e MAX
+MIN_BATCH  = 32
+MAX_BATCH  = 2048
+TARGET_BATCH_SEC = 1.0 # durata obiettivo di un upsert: più veloce → batch più grandi
+PARALLEL   = 4         # batch in volo contemporaneamente
 RETRIES    = 3
-RETRY_SLEEP= 1.5  # sec
+RETRY_SLEEP= 1.5  # sec, base del backoff esponenziale con jitter
+
+# namespace fisso: gli id dei punti dipendono solo dall'identità del chunk,
+# quindi ricaricare il corpus sovrascrive i punti invece di duplicarli
+POINT_NAMESPACE = uuid.UUID("6f0c8d1e-4a53-5b7e-9a62-1d3c2b7f9e40")
 
 DEFAULT_DOMAIN = "wesafe_cert_notarile"     # utile per filtrare lato recall
 
+# "full": testo + metadati nel payload | "lite": in Qdrant solo chunk_id + campi filtrabili,
+# testo e metadati in CHUNK_STORE (letto dal plugin ai_rag_retriever per i top-k)
+PAYLOAD_MODE = "full"
+CHUNK_STORE  = Path("data") / "chunk_store.sqlite"   # montata nel container come /app/cat/data
+LITE_FIELDS  = ("domain", "source_dir", "source_name", "chunk_index")
+
+# riscritto a ogni ingestione: il plugin ai_rag_retriever svuota la cache di recall se cambia
+VERSION_FILE = Path("data") / f"{COLLECTION}.version"
+
 def ensure_collection(client: QdrantClient, collection: str, want_dim: int):
-    """Controlla/ricrea la collection con la dimensione desiderata."""
-    try:
+    """Crea/aggiorna la collection col profilo di create_collection.py (ricrea solo se cambia la dim)."""
+    # collection_exists vale sia per REST sia per gRPC (dove get_collection su una
+    # collection mancante non solleva UnexpectedResponse)
+    recreate = False
+    if client.collection_exists(collection):
         info = client.get_collection(collection)
         # alcune versioni espongono la size sotto config.params.vectors.size
         try:
             have_dim = info.config.params.vectors.size
         except Exception:
-            # fallback grossolano: prova a usare vectors_count (non è la dim!)
             have_dim = want_dim
         if have_dim != want_dim:
             print(f"[!] Mismatch dim: collection={have_dim} vs embeddings={want_dim}. Ricreo…")
-            client.recreate_collection(
-                collection_name=collection,
-                vectors_config=VectorParams(size=want_dim, distance=Distance.COSINE),
-            )
-    except UnexpectedResponse:
+            recreate = True
+    else:
         print(f"[i] Collection '{collection}' non trovata. La creo…")
-        client.recreate_collection(
-            collection_name=collection,
-            vectors_config=VectorParams(size=want_dim, distance=Distance.COSINE),
-        )
+    apply_profile(client, collection, want_dim, recreate=recreate)
 
 def load_chunk_text(chunk_path_str: str, limit_chars: int = 6000) -> str:
     """Legge il testo del chunk per metterlo nel payload (utile per il recall)."""
@@ -58,6 +77,140 @@ def load_chunk_text(chunk_path_str: str, limit_chars: int = 6000) -> str:
     except Exception:
         return ""
 
+def chunk_key(rec: dict) -> str:
+    """Id compatto e stabile del chunk: sorgente + indice (base anche dell'id del punto)."""
+    if rec.get("source_name") and rec.get("chunk_index") is not None:
+        return f"{rec.get('source_dir') or ''}/{rec['source_name']}#{rec['chunk_index']}"
+    # manifest senza metadati di sorgente: si ripiega sull'id/percorso del chunk
+    return rec.get("chunk_id") or rec.get("chunk_path") or ""
+
+def build_payload(rec: dict, chunk_text: str, mode: str = None) -> dict:
+    """Payload del punto a partire da una riga di manifest (+ testo del chunk)."""
+    payload = {
+        "chunk_id": chunk_key(rec),
+        "text": chunk_text,                    # <— importante per il recall
+        "chunk_path": rec.get("chunk_path") or "",
+        "source_path": rec.get("source_path"),
+        "source_name": rec.get("source_name"),
+        "source_dir":  rec.get("source_dir"),
+        "chunk_index": rec.get("chunk_index"),
+        "chunk_size_chars": rec.get("chunk_size_chars"),
+        "model_name":  rec.get("model_name"),
+        "vector_type": rec.get("vector_type"),
+        "domain": DEFAULT_DOMAIN,              # per filtri lato Cheshire/Qdrant
+    }
+    if rec.get("sources"):
+        payload["sources"] = rec["sources"]    # sorgenti dei near-duplicate accorpati (dedup_chunks.py)
+    if (mode or PAYLOAD_MODE) == "lite":
+        return {k: payload[k] for k in ("chunk_id",) + LITE_FIELDS}
+    return payload
+
+def store_chunk(store: ChunkStore, rec: dict, chunk_text: str):
+    """Payload-lite: testo e metadati completi nel chunk store locale."""
+    meta = build_payload(rec, "", mode="full")
+    del meta["text"]
+    store.add(meta["chunk_id"], chunk_text, meta)
+
+def point_id(rec: dict) -> str:
+    """uuid5 deterministico da sorgente + indice del chunk."""
+    return str(uuid.uuid5(POINT_NAMESPACE, chunk_key(rec)))
+
+def build_point(rec: dict, vector: list, chunk_text: str) -> PointStruct:
+    return PointStruct(
+        id=point_id(rec),
+        vector=vector,
+        payload=build_payload(rec, chunk_text),
+    )
+
+def write_version(points: int, model_name: str = None, dim: int = None, path: Path = VERSION_FILE):
+    """
+    Segnala una nuova versione della collection (invalida le cache di recall).
+    Modello e dimensione servono al plugin per embeddare le query come i chunk (RAG_MODE=direct).
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    info = {"collection": COLLECTION, "points": points, "ingested_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "model_name": model_name, "dim": dim}
+    path.write_text(json.dumps(info), encoding="utf-8")
+
+def make_client() -> QdrantClient:
+    return QdrantClient(url=QDRANT_URL, grpc_port=GRPC_PORT, prefer_grpc=PREFER_GRPC)
+
+def upsert_with_retry(client: QdrantClient, collection: str, points: list):
+    for attempt in range(RETRIES):
+        try:
+            client.upsert(collection_name=collection, points=points)
+            return
+        except Exception as e:
+            if attempt == RETRIES - 1:
+                raise
+            # backoff esponenziale con "full jitter": i worker non riprovano all'unisono
+            delay = random.uniform(0, RETRY_SLEEP * 2 ** attempt)
+            print(f"[warn] upsert batch failed ({e}), retry in {delay:.1f}s…")
+            time.sleep(delay)
+
+class ParallelUploader:
+    """
+    Upsert concorrenti con al massimo `parallel` batch in volo.
+    `batch_size` si adatta alla latenza osservata: raddoppia se un upsert
+    dura meno di metà di TARGET_BATCH_SEC, si dimezza se supera il doppio o fallisce.
+    """
+
+    def __init__(self, client: QdrantClient, collection: str, parallel: int = PARALLEL):
+        self.client = client
+        self.collection = collection
+        self.parallel = max(1, parallel)
+        self.batch_size = BATCH_SIZE
+        self.total = 0
+        self._pool = ThreadPoolExecutor(max_workers=self.parallel, thread_name_prefix="qdrant-upsert")
+        self._inflight = set()
+        self._lock = threading.Lock()
+
+    def _send(self, points: list) -> int:
+        t0 = time.perf_counter()
+        try:
+            upsert_with_retry(self.client, self.collection, points)
+        except Exception:
+            with self._lock:
+                self.batch_size = max(MIN_BATCH, self.batch_size // 2)
+            raise
+        elapsed = time.perf_counter() - t0
+        with self._lock:
+            if elapsed < TARGET_BATCH_SEC / 2 and len(points) >= self.batch_size:
+                self.batch_size = min(MAX_BATCH, self.batch_size * 2)
+            elif elapsed > TARGET_BATCH_SEC * 2:
+                self.batch_size = max(MIN_BATCH, self.batch_size // 2)
+        return len(points)
+
+    def _collect(self, done, raise_errors: bool = True):
+        for fut in done:
+            self._inflight.discard(fut)
+            try:
+                self.total += fut.result()   # rilancia l'errore del worker
+            except Exception as e:
+                if raise_errors:
+                    raise
+                print(f"[!] Upsert fallito durante la chiusura: {e}")
+
+    def submit(self, points: list):
+        """Accoda un batch; blocca se ci sono già `parallel` batch in volo (backpressure)."""
+        while len(self._inflight) >= self.parallel:
+            done, _ = wait(self._inflight, return_when=FIRST_COMPLETED)
+            self._collect(done)
+        self._inflight.add(self._pool.submit(self._send, points))
+
+    def close(self, raise_errors: bool = True) -> int:
+        """
+        Attende i batch in volo. Con raise_errors=False (chiusura mentre si propaga
+        già un'eccezione) gli errori dei worker si stampano senza sostituire l'originale.
+        """
+        try:
+            if self._inflight:
+                done, _ = wait(self._inflight)
+                self._collect(done, raise_errors)
+        finally:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+        return self.total
+
 def main():
     if not MANIFEST.exists():
         raise SystemExit(f"Manifest non trovato: {MANIFEST}")
@@ -68,68 +221,55 @@ def main():
     if emb_dim <= 0:
         raise SystemExit(f"Dimensione embedding non valida: {emb_dim}")
 
-    client = QdrantClient(url=QDRANT_URL)
+    client = make_client()
     ensure_collection(client, COLLECTION, emb_dim)
+    uploader = ParallelUploader(client, COLLECTION)
+    chunk_store = ChunkStore(CHUNK_STORE) if PAYLOAD_MODE == "lite" else None
 
     batch = []
-    total = 0
-
-    with MANIFEST.open("r", encoding="utf-8") as f:
-        for line in tqdm(f, desc="Upload Qdrant"):
-            rec = json.loads(line)
-            emb_path = Path(rec["embedding_path"])
-            if not emb_path.exists():
-                continue
-
-            vec = np.load(emb_path)
+    model_name = None
+    ok = False
+    try:
+        # righe .npy per chunk oppure store memory-mapped (vec è una view, nessuna copia)
+        for rec, vec in tqdm(iter_manifest_vectors(MANIFEST), desc="Upload Qdrant"):
             if vec.shape[-1] != emb_dim:
-                print(f"[!] Skip: dim vettore {vec.shape[-1]} != attesa {emb_dim}  → {emb_path}")
+                where = rec.get("embedding_path") or f"{rec.get('store_path')}#{rec.get('store_row')}"
+                print(f"[!] Skip: dim vettore {vec.shape[-1]} != attesa {emb_dim}  → {where}")
                 continue
 
             vector = vec.astype(np.float32).tolist()
+            model_name = model_name or rec.get("model_name")
 
             # testo del chunk per il recall
-            chunk_path = rec.get("chunk_path") or ""
-            chunk_text = load_chunk_text(chunk_path)
-
-            payload = {
-                "text": chunk_text,                    # <— importante per il recall
-                "chunk_path": chunk_path,
-                "source_path": rec.get("source_path"),
-                "source_name": rec.get("source_name"),
-                "source_dir":  rec.get("source_dir"),
-                "chunk_index": rec.get("chunk_index"),
-                "chunk_size_chars": rec.get("chunk_size_chars"),
-                "model_name":  rec.get("model_name"),
-                "vector_type": rec.get("vector_type"),
-                "domain": DEFAULT_DOMAIN,              # per filtri lato Cheshire/Qdrant
-            }
-
-            batch.append(PointStruct(
-                id=str(uuid.uuid4()),
-                vector=vector,
-                payload=payload,
-            ))
-
-            if len(batch) >= BATCH_SIZE:
-                for attempt in range(RETRIES):
-                    try:
-                        client.upsert(collection_name=COLLECTION, points=batch)
-                        total += len(batch)
-                        batch = []
-                        break
-                    except Exception as e:
-                        if attempt == RETRIES - 1:
-                            raise
-                        print(f"[warn] upsert batch failed ({e}), retry in {RETRY_SLEEP}s…")
-                        time.sleep(RETRY_SLEEP)
-
-    if batch:
-        client.upsert(collection_name=COLLECTION, points=batch)
-        total += len(batch)
+            chunk_text = load_chunk_text(rec.get("chunk_path") or "")
+            batch.append(build_point(rec, vector, chunk_text))
+            if chunk_store is not None:
+                store_chunk(chunk_store, rec, chunk_text)
+
+            if len(batch) >= uploader.batch_size:
+                if chunk_store is not None:
+                    chunk_store.flush()   # il testo è nello store prima che il punto sia cercabile
+                uploader.submit(batch)
+                batch = []
+
+        if batch:
+            if chunk_store is not None:
+                chunk_store.flush()
+            uploader.submit(batch)
+        ok = True
+    finally:
+        total = uploader.close(raise_errors=ok)
+        if chunk_store is not None:
+            removed = chunk_store.prune() if ok else 0
+            if removed:
+                print(f"[ok] Chunk store: rimosse {removed} sorgenti non più nel manifest")
+            chunk_store.close()
 
+    write_version(total, model_name, emb_dim)
     print(f"\n✅ Upload completato. Chunk inseriti: {total}")
-    print(f"Collection: {COLLECTION} @ {QDRANT_URL} | dim={emb_dim}")
+    print(f"Collection: {COLLECTION} @ {QDRANT_URL}{' (gRPC)' if PREFER_GRPC else ''} | dim={emb_dim}"
+          f" | batch finale={uploader.batch_size} | payload={PAYLOAD_MODE}"
+          + (f" (testi in {CHUNK_STORE})" if PAYLOAD_MODE == "lite" else ""))
 
 if __name__ == "__main__":
     main()